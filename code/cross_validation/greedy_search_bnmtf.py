@@ -26,6 +26,18 @@ We expect the following arguments:
 - iterations    - number of iterations to run 
 - restarts      - we run the classifier this many times and use the one with 
                   the highest log likelihood
+- P             - the number of processes to run the restarts in (default 1). 
+                  With P > 1 the three candidates of each step are trained at 
+                  the same time, in a pool of P processes (with the restarts 
+                  seeded as in GridSearch).
+- speculative   - if True (and P > 1), we also start the candidates of the step
+                  after, for each of the possible moves. The ones the search 
+                  does not go to are cancelled if they have not started yet,
+                  and otherwise ignored.
+- journal, fold - if given, the journal (see journal.py) in which we store the
+                  qualities of each (K,L) as soon as we have them, under key
+                  'search K=<K> L=<L>' and the given fold of the cross-
+                  validation. A search that is run again skips the (K,L) in it.
 
 The greedy grid search can be started by running search(search_metric), where 
 we stop searching after our specified metric's performance drops.
@@ -41,13 +53,35 @@ all_values(metric) returns a list of tuples detailing the performances: (K,L,met
 We use the optimised Variational Bayes algorithm for BNMTF.
 """
 
+from grid_search_bnmtf import run_restart
+from line_search_bnmf import best_restart
+
+from multiprocessing import Array, Pool
 import numpy
 
 metrics = ['BIC','AIC','loglikelihood','MSE','ELBO']
 
+
+# Flags for the (K,L) cells whose runs have been cancelled, shared with the processes in the pool
+cancelled = None
+def init_pool(cancelled_cells):
+    global cancelled
+    cancelled = cancelled_cells
+
+# Run one restart for a (K,L) cell, or return None if the cell has been cancelled
+def run_cell_restart(params):
+    if cancelled is not None and cancelled[params['cell']]:
+        return None
+    return run_restart(params)
+
+
 class GreedySearch:
-    def __init__(self,classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts=1):
+    def __init__(self,classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts=1,P=1,speculative=False,journal=None,fold=None):
         self.classifier = classifier
+        self.journal = journal
+        self.fold = fold
+        self.P = P
+        self.speculative = speculative
         self.values_K = values_K
         self.values_L = values_L
         self.R = R
@@ -68,7 +102,21 @@ class GreedySearch:
     
     def search(self,search_metric,burn_in=None,thinning=None,minimum_TN=None):
         assert search_metric in metrics, "Unrecognised metric name: %s." % search_metric    
+        if self.P > 1:
+            self.cancelled = Array('b',len(self.values_K)*len(self.values_L),lock=False)
+            self.pool = Pool(self.P,initializer=init_pool,initargs=(self.cancelled,))
+            self.started = {}
+            self.run_args = { 'burn_in':burn_in, 'thinning':thinning, 'minimum_TN':minimum_TN }
+        try:
+            self.greedy_search(search_metric,burn_in,thinning,minimum_TN)
+        finally:
+            if self.P > 1:
+                # This also stops any speculative runs that are still going
+                self.pool.terminate()
+                self.pool = None
+        
         
+    def greedy_search(self,search_metric,burn_in,thinning,minimum_TN):
         def try_KL(K,L):
             # First see if we already tried this combination     
             existing = self.find_KL(search_metric,K,L)
@@ -76,8 +124,19 @@ class GreedySearch:
                 print "Running greedy search for BNMTF. Already tried K = %s, L = %s." % (K,L)         
                 return existing[0][2] # first result = (K,L,performance)
             
+            # Or whether the journal has it from an earlier run
+            qualities = self.journal_result(K,L)
+            if qualities is not None:
+                print "Running greedy search for BNMTF. Journal has K = %s, L = %s." % (K,L)
+                return add_qualities(K,L,qualities)
+            
             # Otherwise, we try it
             print "Running greedy search for BNMTF. Trying K = %s, L = %s." % (K,L)
+            if self.P > 1:
+                qualities = self.wait_cell(self.values_K.index(K),self.values_L.index(L))
+                self.journal_add(K,L,qualities)
+                return add_qualities(K,L,qualities)
+                
             best_BNMTF = None
             for r in range(0,self.restarts):
                 print "Restart %s for K = %s, L = %s." % (r+1,K,L) 
@@ -95,22 +154,28 @@ class GreedySearch:
                 if best_BNMTF is None or BNMTF.quality(**args) > best_BNMTF.quality(**args):
                     best_BNMTF = BNMTF
             
+            if burn_in is not None and thinning is not None:
+                qualities = { metric : best_BNMTF.quality(metric,burn_in,thinning) for metric in metrics }
+            else:
+                qualities = { metric : best_BNMTF.quality(metric) for metric in metrics }
+            self.journal_add(K,L,qualities)
+            return add_qualities(K,L,qualities)
+        
+        # Store the qualities of (K,L) for each metric, and return the one for the search metric
+        def add_qualities(K,L,qualities):
             for metric in metrics:
-                if burn_in is not None and thinning is not None:
-                    quality = best_BNMTF.quality(metric,burn_in,thinning)
-                else:
-                    quality = best_BNMTF.quality(metric)
-                self.all_performances[metric].append((K,L,quality))
-                
-            return self.all_performances[search_metric][-1][2] # return the quality of the last appended value (K,L,quality)
+                self.all_performances[metric].append((K,L,qualities[metric]))
+            return qualities[search_metric]
             
         # Get the initial starting point
         ik, il = 0, 0 #current indices for values of K and L
         current_K, current_L = self.values_K[ik], self.values_L[il]
+        self.start_step(ik,il,[(0,0),(1,0),(0,1),(1,1)]) # the starting point and the first step
         performance_so_far = try_KL(current_K,current_L)
         
         while ik < len(self.values_K)-1 and il < len(self.values_L)-1: 
             print "Currently at K = %s, L = %s." % (current_K,current_L)
+            self.start_step(ik,il,[(1,0),(0,1),(1,1)])
             new_K, new_L = self.values_K[ik+1], self.values_L[il+1]
             performance_new_K = try_KL(new_K,current_L)
             performance_new_L = try_KL(current_K,new_L)
@@ -141,6 +206,7 @@ class GreedySearch:
         if ik == len(self.values_K)-1:
             while il < len(self.values_L)-1:
                 print "Currently at K = %s, L = %s." % (current_K,current_L)
+                self.start_step(ik,il,[(0,1)])
                 new_L = self.values_L[il+1]
                 performance_new_L = try_KL(current_K,new_L)
                 if performance_so_far < performance_new_L:
@@ -154,6 +220,7 @@ class GreedySearch:
         elif il == len(self.values_L)-1:
             while ik < len(self.values_K)-1:
                 print "Currently at K = %s, L = %s." % (current_K,current_L)
+                self.start_step(ik,il,[(1,0)])
                 new_K = self.values_K[ik+1]
                 performance_new_K = try_KL(new_K,current_L)
                 if performance_so_far < performance_new_K:
@@ -165,6 +232,64 @@ class GreedySearch:
                     performance_so_far = performance_new_L
                 
         print "Finished running line search for BNMF."
+        
+        
+    # When running in parallel, start the cells for the step from the indices (ik,il)
+    # with the given moves (a list of (dk,dl)), and if speculative also the cells of
+    # the step after that. Cancel the cells the search can no longer go to.
+    def start_step(self,ik,il,moves):
+        if self.P == 1:
+            return
+        for (jk,jl) in self.started:
+            if jk < ik or jl < il:
+                self.cancelled[jk*len(self.values_L)+jl] = 1
+        cells = [(ik+dk,il+dl) for (dk,dl) in moves]
+        if self.speculative:
+            cells += [(jk+dk,jl+dl) for (jk,jl) in cells for (dk,dl) in moves]
+        for (jk,jl) in cells:
+            self.start_cell(jk,jl)
+            
+    # Start the restarts for cell (ik,il) in the pool, unless it is outside the grid,
+    # already started, or in the journal
+    def start_cell(self,ik,il):
+        if ik >= len(self.values_K) or il >= len(self.values_L) or (ik,il) in self.started:
+            return
+        if self.journal_result(self.values_K[ik],self.values_L[il]) is not None:
+            return
+        (K,L) = (self.values_K[ik],self.values_L[il])
+        params = {
+            'classifier' : self.classifier,
+            'R' : self.R,
+            'M' : self.M,
+            'K' : K,
+            'L' : L,
+            'priors' : self.priors,
+            'initS' : self.initS,
+            'initFG' : self.initFG,
+            'iterations' : self.iterations,
+            'cell' : ik*len(self.values_L)+il
+        }
+        params.update(self.run_args)
+        self.started[(ik,il)] = [
+            self.pool.apply_async(run_cell_restart,(dict(params,seed=numpy.random.randint(0,2**31-1)),))
+            for r in range(0,self.restarts)
+        ]
+        
+    # Wait for the restarts of cell (ik,il) to finish, and return the qualities of the best one
+    def wait_cell(self,ik,il):
+        self.start_cell(ik,il)
+        all_qualities = [result.get() for result in self.started[(ik,il)]]
+        assert None not in all_qualities, "Cancelled the runs for K = %s, L = %s, but still needed them." % (self.values_K[ik],self.values_L[il])
+        return best_restart(all_qualities)
+    
+    
+    # Return the qualities of (K,L) stored in the journal, or None
+    def journal_result(self,K,L):
+        return self.journal.result('search K=%s L=%s' % (K,L),self.fold) if self.journal is not None else None
+        
+    def journal_add(self,K,L,qualities):
+        if self.journal is not None:
+            self.journal.add_result('search K=%s L=%s' % (K,L),self.fold,qualities)
     
     
     def all_values(self,metric):
@@ -5,7 +5,7 @@ probabilistic NMTF models (VB, Gibbs, ICM).
 Arguments:
 - classifier        - the classifier we train
 - R                 - the dataset
-- M                 - mask matrix
+- M                 - mask matrix, which we store bit-packed (see packed_mask.py)
 - values_K          - list specifying search range for K
 - values_L          - list specifying search range for L
 - folds             - number of folds
@@ -16,6 +16,10 @@ Arguments:
 - restarts          - the number of times we try each model when doing model selection
 - quality_metric    - the metric we use to measure model quality - MSE, AIC, or BIC
 - file_performance  - the file in which we store the performances
+- file_journal      - if given, the journal of finished work (see journal.py): the
+                      qualities of each model the search of a fold tries, as 
+                      soon as it has them, and the results of the finished folds.
+                      Running again after a crash skips everything in it.
 
 We start the search using run(). If we use ICM we use run(minimum_TN=<>)
 run(burn_in=<>,thinning=<>).
@@ -23,6 +27,8 @@ run(burn_in=<>,thinning=<>).
 
 import mask
 from greedy_search_bnmtf import GreedySearch
+from journal import Journal
+from packed_mask import PackedMask, PackedFolds
 
 import numpy
 
@@ -31,10 +37,10 @@ measures = ['R^2','MSE','Rp']
 attempts_generate_M = 1000
 
 class GreedySearchCrossValidation:
-    def __init__(self,classifier,R,M,values_K,values_L,folds,priors,init_S,init_FG,iterations,restarts,quality_metric,file_performance):
+    def __init__(self,classifier,R,M,values_K,values_L,folds,priors,init_S,init_FG,iterations,restarts,quality_metric,file_performance,file_journal=None):
         self.classifier = classifier
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M)
+        self.R = numpy.asarray(R,dtype=float)
+        self.M = PackedMask(M)
         self.values_K = values_K
         self.values_L = values_L
         self.folds = folds
@@ -46,6 +52,7 @@ class GreedySearchCrossValidation:
         self.quality_metric = quality_metric
         
         self.fout = open(file_performance,'w')
+        self.journal = Journal(file_journal) if file_journal is not None else None
         (self.I,self.J) = self.R.shape
         assert (self.R.shape == self.M.shape), "R and M are of different shapes: %s and %s respectively." % (self.R.shape,self.M.shape)
         
@@ -56,37 +63,24 @@ class GreedySearchCrossValidation:
         
     # Run the cross-validation
     def run(self,burn_in=None,thinning=None,minimum_TN=None):
-        folds_test = mask.compute_folds_attempts(I=self.I,J=self.J,no_folds=self.folds,attempts=attempts_generate_M,M=self.M)
-        folds_training = mask.compute_Ms(folds_test)
+        compute = lambda: mask.compute_fold_indices_attempts(I=self.I,J=self.J,no_folds=self.folds,attempts=attempts_generate_M,M=self.M)
+        fold_indices = compute() if self.journal is None else self.journal.fold_indices('folds',compute)
 
         performances_test = {measure:[] for measure in measures}
-        for i,(train,test) in enumerate(zip(folds_training,folds_test)):
+        for i,(train,test) in enumerate(PackedFolds(fold_indices,self.folds)):
             print "Fold %s." % (i+1)
             
-            # Run the greedy grid search
-            greedy_search = GreedySearch(
-                classifier=self.classifier,
-                values_K=self.values_K,
-                values_L=self.values_L,
-                R=self.R,
-                M=self.M,
-                priors=self.priors,
-                initS=self.init_S,
-                initFG=self.init_FG,
-                iterations=self.iterations,
-                restarts=self.restarts)
-            greedy_search.search(self.quality_metric,burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
+            # Run the fold, unless the journal has its result already
+            result = self.journal.result('search',i) if self.journal is not None else None
+            if result is None:
+                result = self.run_fold(train,test,burn_in,thinning,minimum_TN,fold=i)
+                if self.journal is not None:
+                    self.journal.add_result('search',i,result)
+            (all_performances,best_KL,performance) = \
+                ([tuple(values) for values in result['all_values']],tuple(result['best_value']),result['performances'])
             
-            # Store the model fits, and find the best one according to the metric    
-            all_performances = greedy_search.all_values(metric=self.quality_metric)
             self.fout.write("All model fits for fold %s, metric %s: %s.\n" % (i+1,self.quality_metric,all_performances)) 
-            self.fout.flush()
-            
-            best_KL = greedy_search.best_value(metric=self.quality_metric)
             self.fout.write("Best K,L for fold %s: %s.\n" % (i+1,best_KL))
-            
-            # Train a model with this K and measure performance on the test set
-            performance = self.run_model(train,test,best_KL[0],best_KL[1],burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
             self.fout.write("Performance: %s.\n\n" % performance)
             self.fout.flush()
             
@@ -99,8 +93,37 @@ class GreedySearchCrossValidation:
         print message
         self.fout.write(message)        
         self.fout.flush()
-          
-          
+        
+
+    # Run the greedy search on the training data of a fold, train a model with the best
+    # K and L, and return a dictionary with the model fits of the search, the best K,L,
+    # and the performances on the test set
+    def run_fold(self,train,test,burn_in=None,thinning=None,minimum_TN=None,fold=None):
+        greedy_search = GreedySearch(
+            classifier=self.classifier,
+            values_K=self.values_K,
+            values_L=self.values_L,
+            R=self.R,
+            M=self.M,
+            priors=self.priors,
+            initS=self.init_S,
+            initFG=self.init_FG,
+            iterations=self.iterations,
+            restarts=self.restarts,
+            journal=self.journal,
+            fold=fold)
+        greedy_search.search(self.quality_metric,burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
+        
+        # Find the best model fit according to the metric, and measure its performance on the test set
+        best_KL = greedy_search.best_value(metric=self.quality_metric)
+        performance = self.run_model(train,test,best_KL[0],best_KL[1],burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
+        return {
+            'all_values' : greedy_search.all_values(metric=self.quality_metric),
+            'best_value' : best_KL,
+            'performances' : performance
+        }
+
+
     # Compute the average performance of the given list of performances (MSE, R^2, Rp)
     def compute_average_performance(self,performances):
         return { measure:(sum(values)/float(len(values))) for measure,values in performances.iteritems() }
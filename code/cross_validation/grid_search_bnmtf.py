@@ -21,6 +21,19 @@ We expect the following arguments:
 - iterations    - number of iterations to run 
 - restarts      - we run the classifier this many times and use the one with 
                   the highest log likelihood
+- P             - the number of processes to run the restarts in (default 1). 
+                  With P > 1 the restarts for all (K,L) cells are run in a pool 
+                  of P processes, which only return the quality of each restart
+                  for each metric, and each set their own random seed (drawn 
+                  from numpy.random).
+- warm_start    - if True, we initialise the models for each (K,L) cell from the
+                  best model for the previous cell in the grid (K,L-1), or for 
+                  the first value of L the cell (K-1,L), using their warm_start() 
+                  method: after the usual initialisation, its factors replace 
+                  the first ones (so we add fresh columns, or drop the last ones).
+                  Not with P > 1. Default False.
+- warm_iterations - the number of iterations to run for the warm started models
+                  (default None: the same as iterations)
 
 The grid search can be started by running search().
 If we use Gibbs then we run search(burn_in,thinning).
@@ -38,13 +51,45 @@ project_location = "/home/tab43/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-import numpy
+from line_search_bnmf import best_restart
+
+from multiprocessing import Pool
+import numpy, random
 
 metrics = ['BIC','AIC','loglikelihood','MSE','ELBO']
 
+
+# Run one restart for a (K,L) cell in its own process, and return a dictionary
+# from metric to the quality of the model. We pass minimum_TN to run() if it is
+# given (not None) in params, for ICM.
+def run_restart(params):
+    (classifier,R,M,K,L,priors,initS,initFG,iterations,burn_in,thinning,seed) = \
+        (params['classifier'],params['R'],params['M'],params['K'],params['L'],params['priors'],params['initS'],
+         params['initFG'],params['iterations'],params['burn_in'],params['thinning'],params['seed'])
+    minimum_TN = params.get('minimum_TN',None)
+    numpy.random.seed(seed)
+    random.seed(seed)
+    
+    BNMTF = classifier(R,M,K,L,priors)
+    BNMTF.initialise(init_S=initS,init_FG=initFG)
+    if minimum_TN is None:
+        BNMTF.run(iterations=iterations)
+    else:
+        BNMTF.run(iterations=iterations,minimum_TN=minimum_TN)
+    
+    if burn_in is not None and thinning is not None:
+        return { metric : BNMTF.quality(metric,burn_in,thinning) for metric in metrics }
+    else:
+        return { metric : BNMTF.quality(metric) for metric in metrics }
+    
+
 class GridSearch:
-    def __init__(self,classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts=1):
+    def __init__(self,classifier,values_K,values_L,R,M,priors,initS,initFG,iterations,restarts=1,P=1,warm_start=False,warm_iterations=None):
         self.classifier = classifier
+        self.P = P
+        self.warm_start = warm_start
+        self.warm_iterations = warm_iterations if warm_iterations is not None else iterations
+        assert not (self.warm_start and self.P > 1), "Cannot warm start in parallel."
         self.values_K = values_K
         self.values_L = values_L
         self.R = R
@@ -63,22 +108,39 @@ class GridSearch:
         }
     
     
+    # Return the priors for the given values of K and L
+    def priors_K_L(self,K,L):
+        priors = self.priors.copy()
+        priors['lambdaF'] = self.priors['lambdaF']*numpy.ones((self.I,K))
+        priors['lambdaS'] = self.priors['lambdaS']*numpy.ones((K,L))
+        priors['lambdaG'] = self.priors['lambdaG']*numpy.ones((self.J,L))
+        return priors
+    
+    
     def search(self,burn_in=None,thinning=None):
+        if self.P > 1:
+            self.search_parallel(burn_in,thinning)
+            return
+            
+        (previous_BNMTF,first_BNMTF_row) = (None,None)
         for ik,K in enumerate(self.values_K):
             for il,L in enumerate(self.values_L):
                 print "Running line search for BNMF. Trying K = %s, L = %s." % (K,L)
                             
-                priors = self.priors.copy()
-                priors['lambdaF'] = self.priors['lambdaF']*numpy.ones((self.I,K))
-                priors['lambdaS'] = self.priors['lambdaS']*numpy.ones((K,L))
-                priors['lambdaG'] = self.priors['lambdaG']*numpy.ones((self.J,L))
+                priors = self.priors_K_L(K,L)
+                if il == 0:
+                    previous_BNMTF = first_BNMTF_row
                 
                 best_BNMTF = None
                 for r in range(0,self.restarts):
                     print "Restart %s for K = %s, L = %s." % (r+1,K,L)    
                     BNMTF = self.classifier(self.R,self.M,K,L,priors)
                     BNMTF.initialise(init_S=self.initS,init_FG=self.initFG)
-                    BNMTF.run(iterations=self.iterations)
+                    iterations = self.iterations
+                    if self.warm_start and previous_BNMTF is not None:
+                        BNMTF.warm_start(previous_BNMTF)
+                        iterations = self.warm_iterations
+                    BNMTF.run(iterations=iterations)
                     
                     args = {'metric':'loglikelihood'}
                     if burn_in is not None and thinning is not None:
@@ -93,8 +155,50 @@ class GridSearch:
                     else:
                         quality = best_BNMTF.quality(metric)
                     self.all_performances[metric][ik,il] = quality
+                    
+                previous_BNMTF = best_BNMTF
+                if il == 0:
+                    first_BNMTF_row = best_BNMTF
         
         print "Finished running line search for BNMF."
+        
+        
+    # Run the restarts for all (K,L) cells in a pool of P processes
+    def search_parallel(self,burn_in,thinning):
+        print "Running grid search for BNMTF in %s processes." % self.P
+        all_parameters = [
+            {
+                'classifier' : self.classifier,
+                'R' : self.R,
+                'M' : self.M,
+                'K' : K,
+                'L' : L,
+                'priors' : self.priors_K_L(K,L),
+                'initS' : self.initS,
+                'initFG' : self.initFG,
+                'iterations' : self.iterations,
+                'burn_in' : burn_in,
+                'thinning' : thinning,
+                'seed' : numpy.random.randint(0,2**31-1)
+            }
+            for K in self.values_K for L in self.values_L for r in range(0,self.restarts)
+        ]
+        pool = Pool(self.P)
+        try:
+            all_qualities = pool.map(run_restart,all_parameters)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+        
+        for ik,K in enumerate(self.values_K):
+            for il,L in enumerate(self.values_L):
+                start = (ik*len(self.values_L)+il)*self.restarts
+                qualities = best_restart(all_qualities[start:start+self.restarts])
+                for metric in metrics:
+                    self.all_performances[metric][ik,il] = qualities[metric]
+        
+        print "Finished running grid search for BNMTF."
     
     
     def all_values(self,metric):
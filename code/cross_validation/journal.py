@@ -0,0 +1,109 @@
+"""
+Append-only journal of the work done by a cross-validation, so that after a
+crash we can run it again and skip everything that was already finished.
+
+Each line of the file is one JSON record, either:
+- {"key": key, "folds_file": name}, the folds we generated for key. The matrix
+    of fold indices from mask.compute_fold_indices() is stored once, in the .npy
+    file <filename>.folds<n>.npy next to the journal, rather than in the JSON,
+    as nested cross-validations store many of them. A resumed run reuses these,
+    so that the remaining folds are the same as the finished ones.
+- {"key": key, "fold": fold, "result": result}, the result of a finished fold,
+    for example {"performances": {"MSE": .., "R^2": .., "Rp": ..}}.
+The keys are strings, such as the JSON of the parameters. Several cross-
+validations can share one journal using sub(prefix), which adds the prefix to
+all their keys. If the run was killed while writing a record, we drop that
+partial last line when reading the journal back in.
+
+Usage:
+    journal = Journal(filename)
+    journal.folds(key,no_folds,compute)     -> the stored test folds for key, or the
+                                               folds from compute(), which we store
+    journal.fold_indices(key,compute)       -> the same, as a matrix of fold indices
+    journal.result(key,fold)                -> the stored result, or None
+    journal.add_result(key,fold,result)
+"""
+
+import mask
+
+import copy, json, numpy, os
+
+folds_extension = '.folds%s.npy'
+
+# The json module gives us unicode strings, so we convert the keys and string 
+# values of the dictionaries back to str
+def to_str(d):
+    return { str(key) : (str(value) if isinstance(value,unicode) else value) for key,value in d.items() }
+
+
+class Journal:
+    def __init__(self,filename):
+        self.filename = filename
+        self.prefix = ''
+        self.all_folds = {}     # Mapping key to the .npy file with its matrix of fold indices
+        self.results = {}       # Mapping (key,fold) to the result
+
+        self.read()
+        self.fout = open(filename,'ab')
+
+    # Read the records in the journal so far, truncating it after the last complete line
+    def read(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename,'rb+') as fin:
+            position = 0
+            for line in iter(fin.readline,''):
+                if not line.endswith('\n'):
+                    break
+                record = json.loads(line,object_hook=to_str)
+                if 'folds_file' in record:
+                    self.all_folds[record['key']] = os.path.join(os.path.dirname(self.filename),record['folds_file'])
+                else:
+                    self.results[(record['key'],record['fold'])] = record['result']
+                position += len(line)
+            fin.truncate(position)
+
+    # Return a journal sharing the same file, adding the prefix to all keys
+    def sub(self,prefix):
+        journal = copy.copy(self)
+        journal.prefix = self.prefix + prefix
+        return journal
+
+    # Append the record to the file, converting numpy values to lists and floats
+    def write(self,record):
+        self.fout.write(json.dumps(record,sort_keys=True,default=lambda value: value.tolist()) + '\n')
+        self.fout.flush()
+
+
+    # Return the list of test masks for the folds of key, computing them with
+    # compute() and storing them if this is the first time
+    def folds(self,key,no_folds,compute):
+        fold_indices = self.fold_indices(key,lambda: mask.compute_fold_indices(compute()))
+        return [mask.compute_train_test_M(fold_indices,fold)[1] for fold in range(0,no_folds)]
+        
+    # The same, but with compute() giving, and us returning, the matrix of fold indices
+    def fold_indices(self,key,compute):
+        key = self.prefix + key
+        if key not in self.all_folds:
+            self.all_folds[key] = self.write_fold_indices(compute())
+            self.write({'key':key,'folds_file':os.path.basename(self.all_folds[key])})
+        return numpy.load(self.all_folds[key]).astype(mask.fold_index_dtype)
+
+    # Store the matrix in the next .npy file, writing to a temporary file first so
+    # that the journal never refers to a partially written one, and return its name
+    def write_fold_indices(self,fold_indices):
+        location = self.filename + folds_extension % len(self.all_folds)
+        location_tmp = location + '.tmp'
+        with open(location_tmp,'wb') as fout:
+            numpy.save(fout,numpy.asarray(fold_indices,dtype=mask.fold_index_dtype))
+        os.rename(location_tmp,location)
+        return location
+
+    # Return the result for the fold of key, or None if it has not finished yet
+    def result(self,key,fold):
+        return self.results.get((self.prefix + key,fold))
+
+    def add_result(self,key,fold,result):
+        key = self.prefix + key
+        self.results[(key,fold)] = result
+        self.write({'key':key,'fold':fold,'result':result})
@@ -18,6 +18,31 @@ We expect the following arguments:
 - iterations    - number of iterations to run 
 - restarts      - we run the classifier this many times and use the one with 
                   the highest log likelihood
+- batch_classifier - optionally, a class training all restarts at once, with methods:
+                    __init__(R,M,K,priors,restarts),
+                    initialise(init),
+                    run(iterations),
+                    best()                  - the restart with the highest log likelihood,
+                                              as an instance of classifier
+                  (e.g. bnmf_vb_optimised_batch). Only used for VB, so not with
+                  burn_in, thinning, or minimum_TN.
+- P             - the number of processes to run the restarts in (default 1). 
+                  With P > 1 the restarts for all values of K (or with the batch 
+                  classifier, the values of K) are run in a pool of P processes. 
+                  These only return the quality of each restart for each metric, 
+                  and each sets its own random seed, drawn from numpy.random.
+- warm_start    - if True, we initialise the models for each next value of K 
+                  from the best model for the previous K, using its warm_start()
+                  method: after the usual initialisation, its factors replace 
+                  the first ones (so we add fresh columns, or drop the last ones).
+                  Not with the batch classifier or P > 1. Default False.
+- warm_iterations - the number of iterations to run for the warm started models
+                  (default None: the same as iterations)
+- journal, fold - if given, the journal (see journal.py) in which we store the
+                  qualities of each K as soon as we have them, under key 
+                  'search K=<K>' and the given fold of the cross-validation. A
+                  search that is run again skips the values of K in it (and 
+                  does not warm start the value after one it skipped).
 
 The line search can be started by running search().
 If we use Gibbs then we run search(burn_in=<>,thinning=<>).
@@ -28,11 +53,61 @@ be obtained using all_values(metric), and the best value of K can be returned
 using best_value(metric).
 """
 
+from multiprocessing import Pool
+import numpy, random
+
 metrics = ['BIC','AIC','loglikelihood','MSE','ELBO']
 
+
+# Run one restart (or with the batch classifier, all restarts) for a value of K in
+# its own process, and return a dictionary from metric to the quality of the model
+def run_restart(params):
+    (classifier,batch_classifier,R,M,K,priors,initUV,iterations,restarts,burn_in,thinning,minimum_TN,seed) = \
+        (params['classifier'],params['batch_classifier'],params['R'],params['M'],params['K'],params['priors'],params['initUV'],
+         params['iterations'],params['restarts'],params['burn_in'],params['thinning'],params['minimum_TN'],params['seed'])
+    numpy.random.seed(seed)
+    random.seed(seed)
+    
+    if batch_classifier is not None:
+        batch_BNMF = batch_classifier(R,M,K,priors,restarts)
+        batch_BNMF.initialise(init=initUV)
+        batch_BNMF.run(iterations=iterations)
+        BNMF = batch_BNMF.best()
+    else:
+        BNMF = classifier(R,M,K,priors)
+        BNMF.initialise(init=initUV)
+        if minimum_TN is None:
+            BNMF.run(iterations=iterations)
+        else:
+            BNMF.run(iterations=iterations,minimum_TN=minimum_TN)
+    
+    if burn_in is not None and thinning is not None:
+        return { metric : BNMF.quality(metric,burn_in,thinning) for metric in metrics }
+    else:
+        return { metric : BNMF.quality(metric) for metric in metrics }
+        
+        
+# Given a list of dictionaries from metric to quality, one for each restart, return 
+# the one with the highest log likelihood (the first one if tied)
+def best_restart(all_qualities):
+    best_qualities = None
+    for qualities in all_qualities:
+        if best_qualities is None or qualities['loglikelihood'] > best_qualities['loglikelihood']:
+            best_qualities = qualities
+    return best_qualities
+    
+
 class LineSearch:
-    def __init__(self,classifier,values_K,R,M,priors,initUV,iterations,restarts=1):
+    def __init__(self,classifier,values_K,R,M,priors,initUV,iterations,restarts=1,batch_classifier=None,P=1,warm_start=False,warm_iterations=None,journal=None,fold=None):
         self.classifier = classifier
+        self.journal = journal
+        self.fold = fold
+        self.batch_classifier = batch_classifier
+        self.P = P
+        self.warm_start = warm_start
+        self.warm_iterations = warm_iterations if warm_iterations is not None else iterations
+        assert not (self.warm_start and (self.batch_classifier is not None or self.P > 1)), \
+            "Cannot warm start with the batch classifier or in parallel."
         self.values_K = values_K
         self.R = R
         self.M = M
@@ -50,33 +125,116 @@ class LineSearch:
     
     
     def search(self,burn_in=None,thinning=None,minimum_TN=None):
+        if self.batch_classifier is not None:
+            assert burn_in is None and thinning is None and minimum_TN is None, \
+                "Can only use the batch classifier for VB."
+        if self.P > 1:
+            self.search_parallel(burn_in,thinning,minimum_TN)
+            return
+            
+        previous_BNMF = None
         for K in self.values_K:
+            qualities = self.journal_result(K)
+            if qualities is not None:
+                print "Running line search for BNMF. Journal has K = %s." % K
+                self.add_qualities(qualities)
+                previous_BNMF = None
+                continue
+            
             print "Running line search for BNMF. Trying K = %s." % K
             best_BNMF = None
-            for r in range(0,self.restarts):
-                print "Restart %s for K = %s." % (r+1,K)
-                BNMF = self.classifier(self.R,self.M,K,self.priors)
-                BNMF.initialise(init=self.initUV)
-                if minimum_TN is None:
-                    BNMF.run(iterations=self.iterations)
-                else:
-                    BNMF.run(iterations=self.iterations,minimum_TN=minimum_TN)
-                
-                args = {'metric':'loglikelihood'}
-                if burn_in is not None and thinning is not None:
-                    args['burn_in'], args['thinning'] = burn_in, thinning
-                
-                if best_BNMF is None or BNMF.quality(**args) > best_BNMF.quality(**args):
-                    best_BNMF = BNMF
+            if self.batch_classifier is not None:
+                print "Running %s restarts for K = %s." % (self.restarts,K)
+                batch_BNMF = self.batch_classifier(self.R,self.M,K,self.priors,self.restarts)
+                batch_BNMF.initialise(init=self.initUV)
+                batch_BNMF.run(iterations=self.iterations)
+                best_BNMF = batch_BNMF.best()
+            else:
+                for r in range(0,self.restarts):
+                    print "Restart %s for K = %s." % (r+1,K)
+                    BNMF = self.classifier(self.R,self.M,K,self.priors)
+                    BNMF.initialise(init=self.initUV)
+                    iterations = self.iterations
+                    if self.warm_start and previous_BNMF is not None:
+                        BNMF.warm_start(previous_BNMF)
+                        iterations = self.warm_iterations
+                    if minimum_TN is None:
+                        BNMF.run(iterations=iterations)
+                    else:
+                        BNMF.run(iterations=iterations,minimum_TN=minimum_TN)
+                    
+                    args = {'metric':'loglikelihood'}
+                    if burn_in is not None and thinning is not None:
+                        args['burn_in'], args['thinning'] = burn_in, thinning
+                    
+                    if best_BNMF is None or BNMF.quality(**args) > best_BNMF.quality(**args):
+                        best_BNMF = BNMF
             
-            for metric in metrics:
-                if burn_in is not None and thinning is not None:
-                    quality = best_BNMF.quality(metric,burn_in,thinning)
-                else:
-                    quality = best_BNMF.quality(metric)
-                self.all_performances[metric].append(quality)
+            if burn_in is not None and thinning is not None:
+                qualities = { metric : best_BNMF.quality(metric,burn_in,thinning) for metric in metrics }
+            else:
+                qualities = { metric : best_BNMF.quality(metric) for metric in metrics }
+            self.journal_add(K,qualities)
+            self.add_qualities(qualities)
+            previous_BNMF = best_BNMF
         
         print "Finished running line search for BNMF."
+        
+        
+    # Run the restarts for all values of K (that are not in the journal) in a pool of 
+    # P processes, journaling the qualities of each K as soon as its restarts are done
+    def search_parallel(self,burn_in,thinning,minimum_TN):
+        print "Running line search for BNMF in %s processes." % self.P
+        no_tasks_K = 1 if self.batch_classifier is not None else self.restarts
+        values_K = [K for K in self.values_K if self.journal_result(K) is None]
+        all_parameters = [
+            {
+                'classifier' : self.classifier,
+                'batch_classifier' : self.batch_classifier,
+                'R' : self.R,
+                'M' : self.M,
+                'K' : K,
+                'priors' : self.priors,
+                'initUV' : self.initUV,
+                'iterations' : self.iterations,
+                'restarts' : self.restarts,
+                'burn_in' : burn_in,
+                'thinning' : thinning,
+                'minimum_TN' : minimum_TN,
+                'seed' : numpy.random.randint(0,2**31-1)
+            }
+            for K in values_K for r in range(0,no_tasks_K)
+        ]
+        pool = Pool(self.P)
+        try:
+            all_qualities = pool.imap(run_restart,all_parameters)
+            qualities_K = {}
+            for K in values_K:
+                qualities_K[K] = best_restart([next(all_qualities) for r in range(0,no_tasks_K)])
+                self.journal_add(K,qualities_K[K])
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+        
+        for K in self.values_K:
+            self.add_qualities(qualities_K[K] if K in qualities_K else self.journal_result(K))
+        
+        print "Finished running line search for BNMF."
+    
+    
+    # Store the qualities of the next value of K for each metric
+    def add_qualities(self,qualities):
+        for metric in metrics:
+            self.all_performances[metric].append(qualities[metric])
+    
+    # Return the qualities of K stored in the journal, or None
+    def journal_result(self,K):
+        return self.journal.result('search K=%s' % K,self.fold) if self.journal is not None else None
+        
+    def journal_add(self,K,qualities):
+        if self.journal is not None:
+            self.journal.add_result('search K=%s' % K,self.fold,qualities)
     
     
     def all_values(self,metric):
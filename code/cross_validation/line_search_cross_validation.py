@@ -5,7 +5,7 @@ probabilistic NMF models (VB, Gibbs, ICM).
 Arguments:
 - classifier        - the classifier we train
 - R                 - the dataset
-- M                 - mask matrix
+- M                 - mask matrix, which we store bit-packed (see packed_mask.py)
 - values_K          - list specifying search range for K
 - folds             - number of folds
 - priors            - dictionary from hyperparameter names to values
@@ -14,6 +14,10 @@ Arguments:
 - restarts          - the number of times we try each model when doing model selection
 - quality_metric    - the metric we use to measure model quality - MSE, AIC, or BIC
 - file_performance  - the file in which we store the performances
+- file_journal      - if given, the journal of finished work (see journal.py): the
+                      qualities of each model the search of a fold tries, as 
+                      soon as it has them, and the results of the finished folds.
+                      Running again after a crash skips everything in it.
 
 We start the search using run(). If we use ICM we use run(minimum_TN=<>)
 run(burn_in=<>,thinning=<>).
@@ -21,6 +25,8 @@ run(burn_in=<>,thinning=<>).
 
 import mask
 from line_search_bnmf import LineSearch
+from journal import Journal
+from packed_mask import PackedMask, PackedFolds
 
 import numpy
 
@@ -29,10 +35,10 @@ measures = ['R^2','MSE','Rp']
 attempts_generate_M = 100 
 
 class LineSearchCrossValidation:
-    def __init__(self,classifier,R,M,values_K,folds,priors,init_UV,iterations,restarts,quality_metric,file_performance):
+    def __init__(self,classifier,R,M,values_K,folds,priors,init_UV,iterations,restarts,quality_metric,file_performance,file_journal=None):
         self.classifier = classifier
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M)
+        self.R = numpy.asarray(R,dtype=float)
+        self.M = PackedMask(M)
         self.values_K = values_K
         self.folds = folds
         self.priors = priors
@@ -42,6 +48,7 @@ class LineSearchCrossValidation:
         self.quality_metric = quality_metric
         
         self.fout = open(file_performance,'w')
+        self.journal = Journal(file_journal) if file_journal is not None else None
         (self.I,self.J) = self.R.shape
         assert (self.R.shape == self.M.shape), "R and M are of different shapes: %s and %s respectively." % (self.R.shape,self.M.shape)
         
@@ -52,35 +59,23 @@ class LineSearchCrossValidation:
         
     # Run the cross-validation
     def run(self,burn_in=None,thinning=None,minimum_TN=None):
-        folds_test = mask.compute_folds_attempts(I=self.I,J=self.J,no_folds=self.folds,attempts=attempts_generate_M,M=self.M)
-        folds_training = mask.compute_Ms(folds_test)
+        compute = lambda: mask.compute_fold_indices_attempts(I=self.I,J=self.J,no_folds=self.folds,attempts=attempts_generate_M,M=self.M)
+        fold_indices = compute() if self.journal is None else self.journal.fold_indices('folds',compute)
 
         performances_test = {measure:[] for measure in measures}
-        for i,(train,test) in enumerate(zip(folds_training,folds_test)):
+        for i,(train,test) in enumerate(PackedFolds(fold_indices,self.folds)):
             print "Fold %s." % (i+1)
             
-            # Run the line search
-            line_search = LineSearch(
-                classifier=self.classifier,
-                values_K=self.values_K,
-                R=self.R,
-                M=train,
-                priors=self.priors,
-                initUV=self.init_UV,
-                iterations=self.iterations,
-                restarts=self.restarts)
-            line_search.search(burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
+            # Run the fold, unless the journal has its result already
+            result = self.journal.result('search',i) if self.journal is not None else None
+            if result is None:
+                result = self.run_fold(train,test,burn_in,thinning,minimum_TN,fold=i)
+                if self.journal is not None:
+                    self.journal.add_result('search',i,result)
+            (all_performances,best_K,performance) = (result['all_values'],result['best_value'],result['performances'])
             
-            # Store the model fits, and find the best one according to the metric    
-            all_performances = line_search.all_values(metric=self.quality_metric)
             self.fout.write("All model fits for fold %s, metric %s: %s.\n" % (i+1,self.quality_metric,all_performances)) 
-            self.fout.flush()
-            
-            best_K = line_search.best_value(metric=self.quality_metric)
             self.fout.write("Best K for fold %s: %s.\n" % (i+1,best_K))
-            
-            # Train a model with this K and measure performance on the test set
-            performance = self.run_model(train,test,best_K,burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
             self.fout.write("Performance: %s.\n\n" % performance)
             self.fout.flush()
             
@@ -94,7 +89,34 @@ class LineSearchCrossValidation:
         self.fout.write(message)        
         self.fout.flush()
         
-              
+
+    # Run the line search on the training data of a fold, train a model with the best
+    # K, and return a dictionary with the model fits of the search, the best K, and 
+    # the performances on the test set
+    def run_fold(self,train,test,burn_in=None,thinning=None,minimum_TN=None,fold=None):
+        line_search = LineSearch(
+            classifier=self.classifier,
+            values_K=self.values_K,
+            R=self.R,
+            M=train,
+            priors=self.priors,
+            initUV=self.init_UV,
+            iterations=self.iterations,
+            restarts=self.restarts,
+            journal=self.journal,
+            fold=fold)
+        line_search.search(burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
+        
+        # Find the best model fit according to the metric, and measure its performance on the test set
+        best_K = line_search.best_value(metric=self.quality_metric)
+        performance = self.run_model(train,test,best_K,burn_in=burn_in,thinning=thinning,minimum_TN=minimum_TN)
+        return {
+            'all_values' : line_search.all_values(metric=self.quality_metric),
+            'best_value' : best_K,
+            'performances' : performance
+        }
+
+
     # Compute the average performance of the given list of performances (MSE, R^2, Rp)
     def compute_average_performance(self,performances):
         return { measure:(sum(values)/float(len(values))) for measure,values in performances.iteritems() }
@@ -3,14 +3,28 @@ Methods for (randomly) generating a mask M of 1 values if a value is known, and
 0 if a value is unknown
 """
 
-import numpy, random, itertools
+import numpy, random
+
+# The fold indices fit in one byte per entry, for up to 127 folds
+fold_index_dtype = numpy.int8
+
+# Return a numpy RandomState seeded from Python's random module, so that
+# random.seed() still makes the (vectorised) fold generation reproducible
+def random_state():
+    return numpy.random.RandomState(random.randint(0,2**32-1))
+
+# Return a random permutation of range(n), drawn with random.shuffle so that it
+# is the same permutation as when shuffling a list of n indices directly
+def random_permutation(n):
+    order = range(0,n)
+    random.shuffle(order)
+    return numpy.array(order,dtype=int)
 
 # Generate a mask matrix M with <fraction> missing entries
 def generate_M(I,J,fraction):
     M = numpy.ones([I,J])
     values = random.sample(range(0,I*J),int(I*J*fraction))
-    for v in values:
-        M[v / J][v % J] = 0
+    M.flat[values] = 0
     return M
     
 # Given a mask matrix M, generate an even more sparse matrix M_test, and M_train (s.t. M_test+M_train=M)
@@ -25,13 +39,13 @@ def generate_M_from_M(M,fraction):
     
     # Shuffle the observed entries, take the first (I*J)*(1-fraction) and mark those as observed
     M_train, M_test = numpy.zeros((I,J)), numpy.zeros((I,J))
-    random.shuffle(indices)
+    rows, columns = numpy.nonzero(M)
+    order = random_permutation(no_elements)
+    rows, columns = rows[order], columns[order]
     index_last_observed = int(I*J*(1-fraction))
     
-    for i,j in indices[:index_last_observed]:
-        M_train[i,j] = 1
-    for i,j in indices[index_last_observed:]:
-        M_test[i,j] = 1
+    M_train[rows[:index_last_observed],columns[:index_last_observed]] = 1
+    M_test[rows[index_last_observed:],columns[index_last_observed:]] = 1
     assert numpy.array_equal(M,M_train+M_test), "Tried splitting M into M_test and M_train but something went wrong."
     return M_train, M_test
     
@@ -50,35 +64,139 @@ def compute_folds(I,J,no_folds,M=None):
     else:
         M = numpy.array(M)
         
-    no_elements = sum([len([v for v in row if v]) for row in M])
-    indices = nonzero_indices(M)
+    rows, columns = numpy.nonzero(M)
+    no_elements = len(rows)
     
-    random.shuffle(indices)
+    order = random_permutation(no_elements)
     split_places = [int(i*no_elements/no_folds) for i in range(0,no_folds+1)] #find the indices where the next fold start
-    split_indices = [indices[split_places[i]:split_places[i+1]] for i in range(0,no_folds)] #split the indices list into the folds
-    
-    folds_M = [] #list of the M's for the different folds
-    for indices in split_indices:
-        M = numpy.zeros((I,J))
-        for i,j in indices:
-            M[i][j] = 1
-        folds_M.append(M)
+    folds = numpy.zeros(no_elements,dtype=int)
+    for fold in range(0,no_folds):
+        folds[order[split_places[fold]:split_places[fold+1]]] = fold
         
-    return folds_M
+    return folds_to_Ms(I,J,no_folds,rows,columns,folds)
+    
+# Turn the fold index of each observed entry (rows[n],columns[n]) into a list of M's
+def folds_to_Ms(I,J,no_folds,rows,columns,folds):
+    folds_M = numpy.zeros((no_folds,I,J))
+    folds_M[folds,rows,columns] = 1
+    return list(folds_M)
+    
+# Or into the matrix of fold indices (see compute_fold_indices)
+def folds_to_fold_indices(I,J,rows,columns,folds):
+    fold_indices = -numpy.ones((I,J),dtype=fold_index_dtype)
+    fold_indices[rows,columns] = folds
+    return fold_indices
     
-# Make n attempts to generate the folds with the training data having at least 1 observed entry per row and column
+# Generate the folds with the training data having at least 1 observed entry per row and column.
+# The folds are constructed to satisfy this, so we only need another attempt in
+# the rare case that the construction gets stuck (see compute_folds_constructive).
 def compute_folds_attempts(I,J,no_folds,attempts,M=None):
-    for i in range(0,attempts):
-        folds_M = compute_folds(I=I,J=J,no_folds=no_folds,M=M)
-        success = True
-        for M_test in folds_M:
-            M_train = M - M_test
-            if not check_empty_rows_columns(M_train):
-                success = False
-        if success:
-            return folds_M
+    fold_indices = compute_fold_indices_attempts(I,J,no_folds,attempts,M)
+    return [(fold_indices == fold).astype(float) for fold in range(0,no_folds)]
+    
+# The same, but returning the folds as one matrix of fold indices (see compute_fold_indices),
+# which for large matrices is much smaller than the list of M's
+def compute_fold_indices_attempts(I,J,no_folds,attempts,M=None):
+    M = numpy.ones((I,J),dtype=bool) if M is None else numpy.asarray(M) != 0
+    if can_compute_folds(M,no_folds):
+        for i in range(0,attempts):
+            fold_indices = compute_fold_indices_constructive(I=I,J=J,no_folds=no_folds,M=M)
+            if fold_indices is not None:
+                return fold_indices
     assert False, "Failed to generate folds for training and test data, %s attempts." % attempts
     
+# Every training split has an observed entry in each row and column if and only
+# if each row and column has its observed entries in at least two different folds
+def can_compute_folds(M,no_folds):
+    M = numpy.asarray(M) != 0
+    return no_folds > 1 and M.sum(axis=0).min() > 1 and M.sum(axis=1).min() > 1
+    
+""" Compute <no_folds> folds of the observed entries in M (all if None), such that
+    each training split (M minus a test fold) has at least one observed entry per 
+    row and column. We do this by construction rather than trial and error:
+    1. Per row, two random observed entries are put into two different random folds.
+    2. Per column whose entries are not yet in two different folds, we put one or 
+       two more random entries into folds to make it so. If all its entries were 
+       already placed in step 1, we move one to a fold not used by its row partner.
+    3. The remaining entries are distributed randomly, filling up the folds to the 
+       sizes that compute_folds would give them.
+    Returns None if step 2 gets stuck (only possible with two folds), in which case
+    we can simply try again. """
+def compute_folds_constructive(I,J,no_folds,M=None):
+    fold_indices = compute_fold_indices_constructive(I,J,no_folds,M)
+    return None if fold_indices is None else [(fold_indices == fold).astype(float) for fold in range(0,no_folds)]
+    
+def compute_fold_indices_constructive(I,J,no_folds,M=None):
+    M = numpy.ones((I,J),dtype=bool) if M is None else numpy.asarray(M) != 0
+    if not can_compute_folds(M,no_folds):
+        return None
+    rng = random_state()
+    other_fold = lambda fold: (fold + 1 + rng.randint(0,no_folds-1,size=numpy.shape(fold))) % no_folds
+    
+    # The observed entries are ordered by row; column_order gives them ordered by column
+    rows, columns = numpy.nonzero(M)
+    no_elements = len(rows)
+    positions = numpy.zeros((I,J),dtype=int)
+    positions[rows,columns] = numpy.arange(no_elements)
+    column_order = positions.T[M.T != 0]
+    (starts_rows, counts_rows), (starts_columns, counts_columns) = \
+        group_starts_counts(rows,I), group_starts_counts(columns,J)
+    
+    folds = -numpy.ones(no_elements,dtype=int)
+    partners = -numpy.ones(no_elements,dtype=int)
+    
+    # Step 1: two random entries per row, in different folds
+    offsets_first = (rng.rand(I) * counts_rows).astype(int)
+    offsets_second = (offsets_first + 1 + (rng.rand(I) * (counts_rows-1)).astype(int)) % counts_rows
+    first, second = starts_rows + offsets_first, starts_rows + offsets_second
+    folds[first] = rng.randint(0,no_folds,size=I)
+    folds[second] = other_fold(folds[first])
+    partners[first], partners[second] = second, first
+    
+    # Step 2: make sure the entries of each column are in two different folds as well
+    for j in numpy.nonzero(~spans_two_folds(folds[column_order],starts_columns))[0]:
+        entries = column_order[starts_columns[j]:starts_columns[j]+counts_columns[j]]
+        placed, not_placed = entries[folds[entries] >= 0], entries[folds[entries] < 0]
+        if len(placed) == 0:
+            first, second = rng.choice(not_placed,size=2,replace=False)
+            folds[first] = rng.randint(0,no_folds)
+            folds[second] = other_fold(folds[first])
+        elif len(not_placed) > 0:
+            folds[rng.choice(not_placed)] = other_fold(folds[placed[0]])
+        else:
+            # All entries in this column are in the same fold from step 1
+            index = rng.choice(placed)
+            options = [fold for fold in range(0,no_folds) 
+                       if fold not in [folds[index],folds[partners[index]]]]
+            if len(options) == 0:
+                return None
+            folds[index] = options[rng.randint(0,len(options))]
+    
+    # Step 3: distribute the rest over the folds, topping them up to the usual fold sizes
+    not_placed = numpy.nonzero(folds < 0)[0]
+    split_places = numpy.array([int(i*no_elements/no_folds) for i in range(0,no_folds+1)])
+    sizes_to_fill = numpy.maximum(numpy.diff(split_places) - numpy.bincount(folds[folds >= 0],minlength=no_folds),0)
+    remaining_folds = rng.permutation(numpy.repeat(numpy.arange(no_folds),sizes_to_fill))
+    folds[not_placed] = remaining_folds[:len(not_placed)]
+    
+    if not (spans_two_folds(folds,starts_rows).all() and spans_two_folds(folds[column_order],starts_columns).all()):
+        return None
+    return folds_to_fold_indices(I,J,rows,columns,folds)
+    
+# Given the sorted group (row or column index) of a list of entries, return 
+# the index where each group starts in the list, and the size of each group
+def group_starts_counts(groups,no_groups):
+    counts = numpy.bincount(groups,minlength=no_groups)
+    return numpy.cumsum(counts) - counts, counts
+    
+# Given the folds of a list of entries sorted by group, and the (nonempty) groups' 
+# starts, return for each group whether its entries are in at least two different 
+# folds. Entries with fold -1 have not been placed yet, and are ignored.
+def spans_two_folds(folds,starts):
+    min_folds = numpy.minimum.reduceat(numpy.where(folds >= 0,folds,numpy.iinfo(int).max),starts)
+    max_folds = numpy.maximum.reduceat(folds,starts)
+    return (max_folds >= 0) & (min_folds < max_folds)
+    
 ''' Make cross-validation folds, but only use the first amount of specified rows 
     or columns for the cross-validation splitting.
     Return a list of (train,test) matrices M. '''
@@ -122,37 +240,36 @@ def compute_crossval_folds_columns_attempts(M,no_columns,no_folds,attempts):
     
 # Return True if all rows and columns have at least one observation
 def check_empty_rows_columns(M):
-    sums_columns = M.sum(axis=0)
-    sums_rows = M.sum(axis=1)
-                
-    # Assert none of the rows or columns are entirely unknown values
-    for i,c in enumerate(sums_rows):
-        if c == 0:
-            return False
-    for j,c in enumerate(sums_columns):
-        if c == 0:
-            return False
-    return True
+    return bool((M.sum(axis=0) != 0).all() and (M.sum(axis=1) != 0).all())
     
 # Take in the ten fold M's, and construct the masks M for the other nine folds
 def compute_Ms(folds_M):
     no_folds = len(folds_M)
     folds_M = [numpy.array(fold_M) for fold_M in folds_M]
-    return [sum(folds_M[:fold]+folds_M[fold+1:]) for fold in range(0,no_folds)]
+    M_all = sum(folds_M)
+    return [M_all - folds_M[fold] for fold in range(0,no_folds)]
+
+# Take in the test fold M's, and return a single matrix giving for each entry 
+# the index of the fold it is in, or -1 if it is in none of them
+def compute_fold_indices(folds_M):
+    fold_indices = -numpy.ones(numpy.shape(folds_M[0]),dtype=fold_index_dtype)
+    for fold,fold_M in enumerate(folds_M):
+        fold_indices[numpy.array(fold_M) != 0] = fold
+    return fold_indices
+
+# Given the matrix of fold indices, return the training and test M for the given fold
+def compute_train_test_M(fold_indices,fold):
+    train = ((fold_indices >= 0) & (fold_indices != fold)).astype(float)
+    test = (fold_indices == fold).astype(float)
+    return (train,test)
 
 def calc_inverse_M(M):
-    (I,J) = numpy.array(M).shape
-    M_inv = numpy.ones([I,J])
-    for i in range(0,I):
-        for j in range(0,J):
-            if M[i][j] == 1:
-                M_inv[i][j] = 0
-    return M_inv
+    return numpy.where(numpy.array(M) == 1, 0., 1.)
     
 # Return a list of indices of all nonzero indices in M
 def nonzero_indices(M):
-    (I,J) = numpy.array(M).shape
-    return [(i,j) for i,j in itertools.product(range(0,I),range(0,J)) if M[i][j]]
+    rows, columns = numpy.nonzero(numpy.array(M))
+    return zip(rows.tolist(),columns.tolist())
     
 # Return a list of lists, the ith list being of all indices j s.t. M[i,j] != 0
 def nonzero_row_indices(M):
@@ -166,10 +283,5 @@ def nonzero_column_indices(M):
 
 # Return a list of tuples of the actual value vs the predicted value, for nonzero elements in M
 def recover_predictions(M,X_true,X_pred):
-    (I,J) = numpy.array(M).shape
-    actual_vs_predicted = []
-    for i in range(0,I):
-        for j in range(0,J):
-            if M[i][j] == 0:
-                actual_vs_predicted.append((X_true[i][j],X_pred[i][j]))
-    return (actual_vs_predicted)
\ No newline at end of file
+    unobserved = numpy.array(M) == 0
+    return zip(numpy.array(X_true)[unobserved].tolist(),numpy.array(X_pred)[unobserved].tolist())
\ No newline at end of file
@@ -14,14 +14,19 @@ We expect the following arguments:
        we with to evaluate the predictions, and returns a dictionary mapping
        performance measure names to their values.
        {'MSE','R2','Rp'} (Mean Square Error, R^2, Pearson correlation coefficient)
-- X, the data matrix.
+- X, the data matrix. This can be a memory-mapped array (numpy.load(..,mmap_mode='r')),
+    which we then do not copy.
 - M, a mask matrix with 1 values where entries in X are known, and 0 where they are not.
+    We store it, and the folds, as bit-packed masks (see packed_mask.py).
 - K, the number of folds for cross-validation.
 - parameter_search, a list of dictionaries from parameter names to values, 
     defining the space of our parameter search.
 - train_config, the additional parameters to pass to the train function (e.g. no. of iterations).
     This should be a dictionary mapping parameter names to values 
 - file_performance, the location and name of the file in which we store the performances.
+- file_journal, if given the location and name of a journal of the finished folds
+    (see journal.py). If it already exists, we reuse its folds and results, so 
+    that running again after a crash only trains the models that had not finished.
 
 For each of the parameter configurations in <parameter_search>, we split the
 dataset <X> into <K> folds (considering only 1 entries in <M>), and thus form
@@ -39,6 +44,8 @@ Methods:
 """
 
 import mask
+from journal import Journal
+from packed_mask import PackedMask, PackedFolds
 
 import numpy
 import json
@@ -46,15 +53,16 @@ import json
 attempts_generate_M = 1000
 
 class MatrixCrossValidation:
-    def __init__(self,method,X,M,K,parameter_search,train_config,file_performance):
+    def __init__(self,method,X,M,K,parameter_search,train_config,file_performance,file_journal=None):
         self.method = method
-        self.X = numpy.array(X,dtype=float)
-        self.M = numpy.array(M)
+        self.X = numpy.asarray(X,dtype=float)
+        self.M = PackedMask(M)
         self.K = K
         self.train_config = train_config
         self.parameter_search = parameter_search
         
         self.fout = open(file_performance,'w')
+        self.journal = Journal(file_journal) if file_journal is not None else None
         (self.I,self.J) = self.X.shape
         assert (self.X.shape == self.M.shape), "X and M are of different shapes: %s and %s respectively." % (self.X.shape,self.M.shape)
         
@@ -69,14 +77,13 @@ class MatrixCrossValidation:
             print "Trying parameters %s." % (parameters)
             
             try:
-                folds_test = mask.compute_folds_attempts(I=self.I,J=self.J,no_folds=self.K,attempts=attempts_generate_M,M=self.M)
-                folds_training = mask.compute_Ms(folds_test)
+                folds = self.compute_folds(parameters)
                 
                 # We need to put the parameter dict into json to hash it
                 self.all_performances[self.JSON(parameters)] = {}
-                for i,(train,test) in enumerate(zip(folds_training,folds_test)):
+                for i,(train,test) in enumerate(folds):
                     print "Fold %s (parameters: %s)." % (i+1,parameters)
-                    performance_dict = self.run_model(train,test,parameters)
+                    performance_dict = self.run_model_journal(train,test,parameters,i)
                     self.store_performances(performance_dict,parameters)
                     
                 self.log(parameters)
@@ -86,6 +93,35 @@ class MatrixCrossValidation:
                 self.fout.flush()
             
             
+    # Generate the folds for the parameters, or take them from the journal, as
+    # PackedFolds giving the packed (train,test) masks of each fold
+    def compute_folds(self,parameters):
+        return PackedFolds(self.compute_fold_indices(parameters),self.K)
+        
+    # The same, but as the matrix of fold indices
+    def compute_fold_indices(self,parameters):
+        compute = lambda: mask.compute_fold_indices_attempts(I=self.I,J=self.J,no_folds=self.K,attempts=attempts_generate_M,M=self.M)
+        if self.journal is None:
+            return compute()
+        return self.journal.fold_indices(self.JSON(parameters),compute)
+        
+    # Run the model for the fold, unless the journal has its result already. Exceptions
+    # are stored in the journal as well, and raised again when we resume.
+    def run_model_journal(self,train,test,parameters,fold):
+        if self.journal is None:
+            return self.run_model(train,test,parameters)
+        result = self.journal.result(self.JSON(parameters),fold)
+        if result is None:
+            try:
+                result = { 'performances' : self.run_model(train,test,parameters) }
+            except Exception as e:
+                result = { 'exception' : str(e) }
+            self.journal.add_result(self.JSON(parameters),fold,result)
+        if 'exception' in result:
+            raise Exception(result['exception'])
+        return result['performances']
+            
+            
     # Initialises and runs the model, and returns the performance on the test set
     def run_model(self,train,test,parameters):
         model = self.method(self.X,train,**parameters)
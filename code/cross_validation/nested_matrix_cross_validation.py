@@ -15,6 +15,7 @@ We expect the following arguments:
        {'MSE','R2','Rp'} (Mean Square Error, R^2, Pearson correlation coefficient)
 - X, the data matrix.
 - M, a mask matrix with 1 values where entries in X are known, and 0 where they are not.
+    We store it, and the folds, as bit-packed masks (see packed_mask.py).
 - K, the number of folds for cross-validation.
 - P, the number of parallel threads
 - parameter_search, a list of dictionaries from parameter names to values, 
@@ -25,6 +26,10 @@ We expect the following arguments:
     overall performances of the nested cross-validations.
 - files_nested_performances, a list of K locations+names of the files in which
     we store the performances of the parameter search cross-validation.
+- file_journal, if given the location and name of a journal of the finished 
+    work (see journal.py): the outer folds and their performances, and the folds
+    and results of each parameter search. If it already exists, running again
+    after a crash skips everything in it.
 
 We split the dataset <X> up into <K> folds (considering only 1 entries in <M>),
 thus forming our <K> training and test sets. Then for each we run the regular
@@ -32,7 +37,12 @@ cross-validation framework to find the best parameters on the training dataset.
 Then we train a model using these parameters, and evaluate it on the test set.
 The performances are stored in <file_performance>.
 
-We use the parallel matrix cross-validation module.
+We use the parallel matrix cross-validation module. The outer folds are run 
+concurrently: all (outer fold, parameters, inner fold) tasks share a single pool 
+of P processes. As soon as all inner tasks of an outer fold are done, we write 
+its nested performance file, and train the model with the best parameters for 
+that fold on the same pool. The performance of each outer fold is added to the
+journal as soon as it finishes.
 
 Methods:
 - Constructor - simply takes in the arguments requires
@@ -44,17 +54,37 @@ Methods:
 """
 
 import mask
-from parallel_matrix_cross_validation import ParallelMatrixCrossValidation
+from parallel_matrix_cross_validation import ParallelMatrixCrossValidation, run_fold, run_task, share_array
+from journal import Journal
+from packed_mask import PackedMask, PackedFolds
 
-import numpy
+from multiprocessing import Pool
+import numpy, Queue, shutil, tempfile
 
 attempts_generate_M = 1000
 
+
+# Run a task of the parameter search for one of the outer folds, returning a 
+# tuple (outer fold, output of run_task)
+def run_nested_task(params):
+    return (params['outer_fold'],run_task(params))
+
+
+# Train and test the model for an outer fold, catching exceptions so that the
+# main process always hears back. Returns a tuple (outer fold, performance_dict,
+# exception message), with either performance_dict or the message being None.
+def run_outer_task(params):
+    try:
+        return (params['fold'],run_fold(params),None)
+    except Exception as e:
+        return (params['fold'],None,str(e))
+
+
 class MatrixNestedCrossValidation:
-    def __init__(self,method,X,M,K,P,parameter_search,train_config,file_performance,files_nested_performances):
+    def __init__(self,method,X,M,K,P,parameter_search,train_config,file_performance,files_nested_performances,file_journal=None):
         self.method = method
-        self.X = numpy.array(X,dtype=float)
-        self.M = numpy.array(M)
+        self.X = numpy.asarray(X,dtype=float)
+        self.M = PackedMask(M)
         self.K = K
         self.P = P
         self.train_config = train_config
@@ -62,6 +92,7 @@ class MatrixNestedCrossValidation:
         self.files_nested_performances = files_nested_performances        
         
         self.fout = open(file_performance,'w')
+        self.journal = Journal(file_journal) if file_journal is not None else None
         (self.I,self.J) = self.X.shape
         assert (self.X.shape == self.M.shape), "X and M are of different shapes: %s and %s respectively." % (self.X.shape,self.M.shape)
         
@@ -71,39 +102,96 @@ class MatrixNestedCrossValidation:
         
     # Run the cross-validation
     def run(self):
-        folds_test = mask.compute_folds_attempts(I=self.I,J=self.J,no_folds=self.K,attempts=attempts_generate_M,M=self.M)
-        folds_training = mask.compute_Ms(folds_test)       
+        compute = lambda: mask.compute_fold_indices_attempts(I=self.I,J=self.J,no_folds=self.K,attempts=attempts_generate_M,M=self.M)
+        fold_indices = compute() if self.journal is None else self.journal.fold_indices('outer',compute)
+        folds = PackedFolds(fold_indices,self.K)
 
-        for i,(train,test) in enumerate(zip(folds_training,folds_test)):
-            print "Fold %s of nested cross-validation." % (i+1)            
+        folder = tempfile.mkdtemp(prefix='nested_crossval_')
+        pool = Pool(self.P)
+        try:
+            file_X = share_array(folder,'X',self.X)
+            file_fold_indices = share_array(folder,'folds',fold_indices)
             
-            # Run the cross-validation
-            crossval = ParallelMatrixCrossValidation(
-            #crossval = MatrixCrossValidation(
-                method=self.method,
-                X=self.X,
-                M=train,
-                K=self.K,
-                parameter_search=self.parameter_search,
-                train_config=self.train_config,
-                file_performance=self.files_nested_performances[i],
-                P=self.P
-            )
-            crossval.run()
-            
-            try:
-                (best_parameters,_) = crossval.find_best_parameters(evaluation_criterion='MSE',low_better=True)
-                print "Best parameters for fold %s were %s." % (i+1,best_parameters)
-            except KeyError:
-                best_parameters = self.parameter_search[0]
-                print "Found no performances, dataset too sparse? Use first values instead for fold %s, %s." % (i+1,best_parameters)
-            
-            # Train the model and test the performance on the test set
-            performance_dict = self.run_model(train,test,best_parameters)
-            self.store_performances(performance_dict)
-            print "Finished fold %s, with performances %s." % (i+1,performance_dict)            
+            # Create the cross-validation, and its tasks, for each of the outer folds
+            self.crossvals, tasks = [], []
+            for i,(train,_) in enumerate(folds):
+                print "Fold %s of nested cross-validation." % (i+1)            
+                crossval = ParallelMatrixCrossValidation(
+                    method=self.method,
+                    X=self.X,
+                    M=train,
+                    K=self.K,
+                    parameter_search=self.parameter_search,
+                    train_config=self.train_config,
+                    file_performance=self.files_nested_performances[i],
+                    P=self.P
+                )
+                crossval.journal = self.journal.sub('fold %s ' % i) if self.journal is not None else None
+                tasks += [dict(task,outer_fold=i) for task in crossval.create_tasks(folder,file_X,prefix='%s_' % i)]
+                self.crossvals.append(crossval)
+                
+            # Run the tasks, and start training the model for an outer fold once its parameter 
+            # search is done. The pool's callbacks put the outputs of the outer folds on a queue,
+            # and we store them (in this process, as the journal is not thread-safe) as they come in.
+            self.outer_performances = [None for i in range(0,self.K)]
+            self.outer_outputs = Queue.Queue()
+            for i,crossval in enumerate(self.crossvals):
+                if crossval.finished():
+                    self.run_outer_fold(pool,i,file_X,file_fold_indices)
+            for (i,output) in pool.imap_unordered(run_nested_task,tasks):
+                self.crossvals[i].store_output(*output)
+                if self.crossvals[i].finished():
+                    self.run_outer_fold(pool,i,file_X,file_fold_indices)
+                while not self.outer_outputs.empty():
+                    self.store_outer_output(*self.outer_outputs.get())
+            while None in self.outer_performances:
+                self.store_outer_output(*self.outer_outputs.get())
+                    
+            for i,performance_dict in enumerate(self.outer_performances):
+                self.store_performances(performance_dict)
+                print "Finished fold %s, with performances %s." % (i+1,performance_dict)            
+            pool.close()
+        finally:
+            pool.terminate()
+            shutil.rmtree(folder,ignore_errors=True)
             
         self.log()
+        
+    # Find the best parameters for outer fold i, close its nested performance file, 
+    # and start training the model on the pool. If the journal already has the 
+    # performance of this outer fold, we use that instead.
+    def run_outer_fold(self,pool,i,file_X,file_fold_indices):
+        crossval = self.crossvals[i]
+        try:
+            (best_parameters,_) = crossval.find_best_parameters(evaluation_criterion='MSE',low_better=True)
+            print "Best parameters for fold %s were %s." % (i+1,best_parameters)
+        except KeyError:
+            best_parameters = self.parameter_search[0]
+            print "Found no performances, dataset too sparse? Use first values instead for fold %s, %s." % (i+1,best_parameters)
+        crossval.fout.close()
+        if self.journal is not None and self.journal.result('outer',i) is not None:
+            self.outer_performances[i] = self.journal.result('outer',i)['performances']
+            return
+            
+        # Train the model and test the performance on the test set
+        params = {
+            'parameters' : best_parameters,
+            'file_X' : file_X,
+            'file_fold_indices' : file_fold_indices,
+            'fold' : i,
+            'method' : self.method,
+            'train_config' : self.train_config
+        }
+        pool.apply_async(run_outer_task,(params,),callback=self.outer_outputs.put)
+        
+    # Store the output of an outer fold from run_outer_task(), and add it to the
+    # journal straight away, or raise its exception
+    def store_outer_output(self,i,performance_dict,exception):
+        if exception is not None:
+            raise Exception(exception)
+        self.outer_performances[i] = performance_dict
+        if self.journal is not None:
+            self.journal.add_result('outer',i,{'performances':performance_dict})
             
             
     # Initialises and runs the model, and returns the performance on the test set
@@ -0,0 +1,112 @@
+"""
+Bit-packed mask matrices, using one bit per entry rather than the eight bytes
+of a dense float mask (12.5 MB rather than 800 MB for a 10^5 x 10^3 matrix).
+
+PackedMask(M) packs the nonzero entries of the (dense) mask M. It can be given
+anywhere a dense mask is expected: numpy.array(M_packed,dtype) and other numpy
+functions unpack it through __array__, as booleans unless a dtype is given, so
+the models unpack their training mask once when they are constructed (one byte
+per entry), and evaluate on a packed test mask.
+It also provides:
+    M_packed.shape, M_packed.sum(), M_packed.nonzero()
+    M_packed.complement()       -> the packed mask of the zero entries
+    M_packed.minus(M_other)     -> the entries in M_packed but not in M_other
+    M_packed & M_other, M_packed | M_other
+    M_packed.dense(dtype)       -> the dense mask, of 0's and 1's
+
+PackedFolds(fold_indices,no_folds) stores the test folds of a cross-validation,
+given the matrix of fold indices from mask.compute_fold_indices(), as one
+packed mask per fold. Iterating over it gives the (train,test) packed masks of
+each fold, where the training mask is computed with bitwise operations when we
+get to it, rather than storing dense training and test masks for all folds.
+"""
+
+import numpy
+
+# The number of 1 bits in each byte
+popcount = numpy.array([bin(byte).count('1') for byte in range(0,256)],dtype=numpy.int64)
+
+
+class PackedMask:
+    def __init__(self,M=None,shape=None,bits=None):
+        if isinstance(M,PackedMask):
+            (shape,bits) = (M.shape,M.bits.copy())
+        elif M is not None:
+            M = numpy.asarray(M) != 0
+            (shape,bits) = (M.shape,numpy.packbits(M.ravel()))
+        assert shape is not None and bits is not None, "Expected either a mask M, or the shape and bits of one."
+        assert len(bits) == (numpy.prod(shape,dtype=int)+7) / 8, \
+            "Expected %s bytes for a mask of shape %s, but got %s." % ((numpy.prod(shape,dtype=int)+7)/8,shape,len(bits))
+        self.shape = tuple(shape)
+        self.size = int(numpy.prod(shape,dtype=int))
+        self.bits = numpy.asarray(bits,dtype=numpy.uint8)
+
+    # Unpack into a dense array, when the mask is passed to a numpy function
+    def __array__(self,dtype=None):
+        return self.dense(dtype if dtype is not None else bool)
+
+    def dense(self,dtype=float):
+        return numpy.unpackbits(self.bits)[:self.size].reshape(self.shape).astype(dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    # Total number of 1 entries, or the counts per row (axis=1) or column (axis=0)
+    def sum(self,axis=None):
+        if axis is None:
+            return float(popcount[self.bits].sum())
+        return self.dense().sum(axis=axis)
+
+    def nonzero(self):
+        return numpy.nonzero(self.dense(bool))
+
+
+    # Bitwise operations give new packed masks, without unpacking. The last
+    # byte may have padding bits beyond the size, which we keep at 0.
+    def from_bits(self,bits):
+        padding = len(bits)*8 - self.size
+        if padding > 0:
+            bits[-1] &= numpy.uint8((0xFF << padding) & 0xFF)
+        return PackedMask(shape=self.shape,bits=bits)
+
+    def check_shape(self,other):
+        assert self.shape == other.shape, "Masks are of different shapes: %s and %s respectively." % (self.shape,other.shape)
+
+    def complement(self):
+        return self.from_bits(~self.bits)
+
+    def minus(self,other):
+        self.check_shape(other)
+        return self.from_bits(self.bits & ~other.bits)
+
+    def __and__(self,other):
+        self.check_shape(other)
+        return self.from_bits(self.bits & other.bits)
+
+    def __or__(self,other):
+        self.check_shape(other)
+        return self.from_bits(self.bits | other.bits)
+
+
+class PackedFolds:
+    def __init__(self,fold_indices,no_folds):
+        fold_indices = numpy.asarray(fold_indices)
+        self.no_folds = no_folds
+        self.shape = fold_indices.shape
+        self.observed = PackedMask(fold_indices >= 0)
+        self.tests = [PackedMask(fold_indices == fold) for fold in range(0,no_folds)]
+
+    def __len__(self):
+        return self.no_folds
+
+    def __iter__(self):
+        return (self.train_test(fold) for fold in range(0,self.no_folds))
+
+    def train(self,fold):
+        return self.observed.minus(self.tests[fold])
+
+    def test(self,fold):
+        return self.tests[fold]
+
+    def train_test(self,fold):
+        return (self.train(fold),self.test(fold))
@@ -3,13 +3,28 @@ Parallel version of the MatrixCrossValidation class, where we parallelize
 the K-fold cross-validation for each parameter.
 We now have an extra parameter P for the initialisation, defining the number
 of parallel threads we should run.
+
+All (parameters, fold) combinations are run as separate tasks on a single pool
+of P processes, so that the processes do not wait for the slowest fold of each 
+parameter setting. As soon as all folds of a parameter setting (and of the ones
+before it) are done, its performances are stored and logged, in the same order 
+as the sequential MatrixCrossValidation.
+
+Rather than sending each process its own copy of X and the fold masks, we 
+write X (once) and a matrix of fold indices (once per parameter setting) to
+.npy files in a temporary folder. The processes memory-map these, and only 
+receive the filenames and the index of their fold. The folder can be set 
+with the TMPDIR environment variable (e.g. to /dev/shm).
+
+With a journal (file_journal), the folds that already have a result in it are
+not run again, and the results of the others are added to it as they finish.
 """
 
 import mask
 from matrix_cross_validation import MatrixCrossValidation
 
 from multiprocessing import Pool
-import numpy
+import numpy, os, shutil, tempfile
 
 attempts_generate_M = 1000
 
@@ -17,12 +32,33 @@ attempts_generate_M = 1000
 # We try the parameters in parallel. This function either raises an Exception,
 # or returns a tuple (parameters,all_performances,average_performances)
 def run_fold(params):
-    (parameters,X,train,test,method,train_config) = \
-        (params['parameters'],params['X'],params['train'],params['test'],params['method'],params['train_config'])    
+    (parameters,file_X,file_fold_indices,fold,method,train_config) = \
+        (params['parameters'],params['file_X'],params['file_fold_indices'],params['fold'],params['method'],params['train_config'])    
+    X = numpy.load(file_X,mmap_mode='r')
+    fold_indices = numpy.load(file_fold_indices,mmap_mode='r')
+    (train,test) = mask.compute_train_test_M(fold_indices,fold)
     performance_dict = run_model(method,X,train,test,parameters,train_config)
     return performance_dict           
     
     
+# Run one (parameters, fold) task, catching exceptions so that the other tasks 
+# can continue. Returns a tuple (index of the parameters, fold, performance_dict,
+# exception message), with either performance_dict or the message being None.
+def run_task(params):
+    try:
+        return (params['index'],params['fold'],run_fold(params),None)
+    except Exception as e:
+        return (params['index'],params['fold'],None,str(e))
+    
+    
+# Write the array to a .npy file in the folder so that the processes can 
+# memory-map it, and return the filename
+def share_array(folder,name,array):
+    filename = os.path.join(folder,"%s.npy" % name)
+    numpy.save(filename,array)
+    return filename
+    
+    
 # Method for running the model with the given parameters
 def run_model(method,X,train,test,parameters,train_config):
     model = method(X,train,**parameters)
@@ -32,45 +68,95 @@ def run_model(method,X,train,test,parameters,train_config):
 
 # Class, redefining the run function
 class ParallelMatrixCrossValidation(MatrixCrossValidation):
-    def __init__(self,method,X,M,K,parameter_search,train_config,file_performance,P):
-        MatrixCrossValidation.__init__(self,method,X,M,K,parameter_search,train_config,file_performance)
+    def __init__(self,method,X,M,K,parameter_search,train_config,file_performance,P,file_journal=None):
+        MatrixCrossValidation.__init__(self,method,X,M,K,parameter_search,train_config,file_performance,file_journal)
         self.P = P        
         
     # Run the cross-validation
     def run(self):
-        for parameters in self.parameter_search:
+        folder = tempfile.mkdtemp(prefix='crossval_')
+        pool = Pool(self.P)
+        try:
+            tasks = self.create_tasks(folder,share_array(folder,'X',self.X))
+            for output in pool.imap_unordered(run_task,tasks):
+                self.store_output(*output)
+            pool.close()
+        finally:
+            pool.terminate()
+            shutil.rmtree(folder,ignore_errors=True)
+            
+    # Generate the folds for each of the parameters, storing their fold indices 
+    # in the folder (with the given prefix), and return the list of tasks to run.
+    # The results of these tasks should be given to store_output(). Folds with a
+    # result in the journal are stored straight away, rather than run.
+    def create_tasks(self,folder,file_X,prefix=''):
+        tasks = []
+        self.outputs = [[None for fold in range(0,self.K)] for parameters in self.parameter_search]
+        self.exceptions = [None for parameters in self.parameter_search]
+        self.no_remaining = [self.K for parameters in self.parameter_search]
+        self.no_logged = 0
+        for index,parameters in enumerate(self.parameter_search):
             print "Trying parameters %s." % (parameters)
             
             try:
-                folds_test = mask.compute_folds_attempts(I=self.I,J=self.J,no_folds=self.K,attempts=attempts_generate_M,M=self.M)
-                folds_training = mask.compute_Ms(folds_test)
-                
-                # We need to put the parameter dict into json to hash it
-                self.all_performances[self.JSON(parameters)] = {}
-                
-                # Create the threads for the folds, and run them
-                pool = Pool(self.P)
-                all_parameters = [
-                    {
-                        'parameters' : parameters,
-                        'X' : numpy.copy(self.X),
-                        'train' : train,
-                        'test' : test,
-                        'method' : self.method,
-                        'train_config' : self.train_config                
-                    }
-                    for (train,test) in zip(folds_training,folds_test)
-                ]
-                outputs = pool.map(run_fold,all_parameters)
-                pool.close()
+                file_fold_indices = share_array(folder,'folds_%s%s' % (prefix,index),self.compute_fold_indices(parameters))
+            except Exception as e:
+                (self.exceptions[index],self.no_remaining[index]) = (str(e),0)
+                continue
+            
+            # We need to put the parameter dict into json to hash it
+            self.all_performances[self.JSON(parameters)] = {}
+            for fold in range(0,self.K):
+                result = self.journal.result(self.JSON(parameters),fold) if self.journal is not None else None
+                if result is not None:
+                    self.store_output(index,fold,result.get('performances'),result.get('exception'))
+                    continue
+                tasks.append({
+                    'index' : index,
+                    'parameters' : parameters,
+                    'file_X' : file_X,
+                    'file_fold_indices' : file_fold_indices,
+                    'fold' : fold,
+                    'method' : self.method,
+                    'train_config' : self.train_config                
+                })
+        
+        self.log_finished()
+        return tasks
+        
+    # Store the output of a task from run_task(), add it to the journal if it is 
+    # not in there yet, and log the parameters in order as they finish
+    def store_output(self,index,fold,performance_dict,exception):
+        key = self.JSON(self.parameter_search[index])
+        if self.journal is not None and self.journal.result(key,fold) is None:
+            result = { 'performances' : performance_dict } if exception is None else { 'exception' : exception }
+            self.journal.add_result(key,fold,result)
+        self.outputs[index][fold] = performance_dict
+        if exception is not None and self.exceptions[index] is None:
+            self.exceptions[index] = exception
+        self.no_remaining[index] -= 1
+        self.log_finished()
+        
+    # Return True if all parameters have finished and been logged
+    def finished(self):
+        return self.no_logged == len(self.parameter_search)
                 
-                for performance_dict in outputs:
+    # Store and log the performances of the parameters whose folds have all finished,
+    # up until the first one that is still running, or write down their exception
+    def log_finished(self):
+        while self.no_logged < len(self.parameter_search) and self.no_remaining[self.no_logged] == 0:
+            (index,parameters) = (self.no_logged,self.parameter_search[self.no_logged])
+            try:
+                if self.exceptions[index] is not None:
+                    raise Exception(self.exceptions[index])
+                for performance_dict in self.outputs[index]:
                     self.store_performances(performance_dict,parameters)
-                    
                 self.log(parameters)
-                
             except Exception as e:
                 self.fout.write("Tried parameters %s but got exception: %s. \n" % (parameters,e))
+                self.fout.flush()
+            self.outputs[index] = None
+            self.no_logged += 1
                 
     # Undo the function run_model:
     def run_model(self,train,test,parameters):
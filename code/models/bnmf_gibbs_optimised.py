@@ -4,11 +4,17 @@ et al. (2009).
 Optimised to draw all columns in parallel.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
 - K, the number of latent factors
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaU' = [[lambdaUik]], 'lambdaV' = [[lambdaVjk]] },
     a dictionary defining the priors over tau, U, V.
+- dtype, the floating point type used for R, M, U, V, and the stored samples:
+    float (default) or numpy.float32, halving the memory use.
+- seed, if given we draw the random initialisation from our own numpy
+    RandomState with this seed, rather than the global one (default None). The
+    draws in run() still use the global random state.
     
 Initialisation can be done by running the initialise() function, with argument init:
 - init='random' -> draw initial values randomly from priors Exp, Gamma
@@ -22,11 +28,27 @@ Usage of class:
 Or:
     BNMF = bnmf_gibbs(R,M,K,priors)
     BNMF.train(init,iterations)
+To warm start from a trained model BNMF_prev with a different K, we run
+BNMF.warm_start(BNMF_prev) after initialise(init).
+To save a checkpoint every N iterations, we run
+    BNMF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with BNMF.save_state(filename) and 
+BNMF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    BNMF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
     
 This returns a tuple (Us,Vs,taus) of lists of U, V, tau values - of size <iterations>.
 
 The expectation can be computed by specifying a burn-in and thinning rate, and using:
     BNMF.approx_expectation(burn_in,thinning)
+If we already know the burn-in and thinning, we can give them to run instead:
+    BNMF.run(iterations,burn_in,thinning,running_sums,folder)
+so that we only store the retained samples (see sample_store.py), or with 
+running_sums=True only their running sums and sums of squares. If folder is 
+given, the samples are stored in memory-mapped files <folder>/<name>.npy.
+The samples are stored in the dtype given to the constructor.
 
 We can test the performance of our model on a test dataset, specifying our test set with a mask M. 
     performance = BNMF.predict(M_pred,burn_in,thinning)
@@ -47,13 +69,19 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 from distributions.exponential import exponential_draw
 from distributions.gamma import gamma_draw
 from distributions.truncated_normal_vector import TN_vector_draw
+from sample_store import SampleStore
+from model_state import save_model_state, load_model_state
 
-import numpy, itertools, math, time
+import numpy, itertools, math, os, time
 
 class bnmf_gibbs_optimised:
-    def __init__(self,R,M,K,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,priors,dtype=float,seed=None):
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype in [numpy.float32,numpy.float64], "Unsupported dtype: %s. Should be float32 or float64." % self.dtype
+        self.R = numpy.asarray(R,dtype=self.dtype)
+        self.M = numpy.array(M,dtype=self.dtype)
+        self.rng = numpy.random.RandomState(seed) if seed is not None else numpy.random
+        self.seed = seed
         self.K = K
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
@@ -62,17 +90,18 @@ class bnmf_gibbs_optimised:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        self.samples = None
+        self.size_Omega = float(self.M.sum())
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaU, self.lambdaV = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU']), numpy.array(priors['lambdaV'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU'],dtype=self.dtype), numpy.array(priors['lambdaV'],dtype=self.dtype)
         
         # If lambdaU or lambdaV are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaU.shape == ():
-            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
+            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K),dtype=self.dtype)
         if self.lambdaV.shape == ():
-            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
+            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K),dtype=self.dtype)
                 
         assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
         assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
@@ -99,61 +128,95 @@ class bnmf_gibbs_optimised:
     # Initialise U, V, and tau. If init='random', draw values from an Exp and Gamma distribution. If init='exp', set it to the expectation values.
     def initialise(self,init='random'):
         assert init in ['random','exp'], "Unknown initialisation option: %s. Should be 'random' or 'exp'." % init
-        self.U = numpy.zeros((self.I,self.K))
-        self.V = numpy.zeros((self.J,self.K))
+        self.U = numpy.zeros((self.I,self.K),dtype=self.dtype)
+        self.V = numpy.zeros((self.J,self.K),dtype=self.dtype)
         
         if init == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):
-                self.U[i,k] = exponential_draw(self.lambdaU[i][k])
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = exponential_draw(self.lambdaV[j][k])
+            self.U[:] = exponential_draw(self.lambdaU,rng=self.rng)
+            self.V[:] = exponential_draw(self.lambdaV,rng=self.rng)
             
         elif init == 'exp':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):
-                self.U[i,k] = 1.0/self.lambdaU[i][k]
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = 1.0/self.lambdaV[j][k]
+            self.U[:] = 1.0/self.lambdaU
+            self.V[:] = 1.0/self.lambdaV
         
         self.tau = self.alpha_s() / self.beta_s()
         
 
-    # Run the Gibbs sampler
-    def run(self,iterations):
-        self.all_U = numpy.zeros((iterations,self.I,self.K))  
-        self.all_V = numpy.zeros((iterations,self.J,self.K))   
-        self.all_tau = numpy.zeros(iterations) 
-        self.all_times = [] # to plot performance against time
+    # Warm start from a trained model with a different number of factors. After
+    # initialise(), we copy over its current U and V for the first min(K,model.K)
+    # factors, keeping the fresh initialisation for the others.
+    def warm_start(self,model):
+        assert (model.I,model.J) == (self.I,self.J), "Cannot warm start from a model of size (%s, %s) instead of (%s, %s)." % (model.I,model.J,self.I,self.J)
+        K = min(self.K,model.K)
+        self.U[:,:K], self.V[:,:K] = model.U[:,:K], model.V[:,:K]
+        self.tau = self.alpha_s() / self.beta_s()
+        
+
+    # Save the state of the model - U, V, tau, the samples, the iteration, and the
+    # random states - to a compressed .npz file, or load it back in.
+    def save_state(self,filename):
+        save_model_state(self,filename,['U','V','tau'])
         
+    def load_state(self,filename):
+        load_model_state(self,filename)
+        
+
+    # Run the Gibbs sampler. If checkpoint is given, we save the state to it every
+    # <checkpoint_every> iterations, and resume from it if it already exists.
+    def run(self,iterations,burn_in=0,thinning=1,running_sums=False,folder=None,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
         metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
-        
-        time_start = time.time()
-        for it in range(0,iterations):      
-            for k in range(0,self.K):   
-                tauUk = self.tauU(k)
-                muUk = self.muU(tauUk,k)
-                self.U[:,k] = TN_vector_draw(muUk,tauUk)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+            assert self.samples.iterations == iterations, "Checkpoint %s is for a run of %s iterations, not %s." % (checkpoint,self.samples.iterations,iterations)
+        else:
+            self.samples = SampleStore([('U',(self.I,self.K)),('V',(self.J,self.K)),('tau',())],iterations,burn_in,thinning,running_sums,folder,self.dtype)
+            self.all_times = [] # to plot performance against time
+            
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in metrics:
+                self.all_performances[metric] = []
+            self.iteration = 0
+        
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration,iterations):      
+                for k in range(0,self.K):   
+                    tauUk = self.tauU(k)
+                    muUk = self.muU(tauUk,k)
+                    self.U[:,k] = TN_vector_draw(muUk,tauUk)
                 
-            for k in range(0,self.K):
-                tauVk = self.tauV(k)
-                muVk = self.muV(tauVk,k)
-                self.V[:,k] = TN_vector_draw(muVk,tauVk)
+                for k in range(0,self.K):
+                    tauVk = self.tauV(k)
+                    muVk = self.muV(tauVk,k)
+                    self.V[:,k] = TN_vector_draw(muVk,tauVk)
                 
-            self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+                self.tau = gamma_draw(self.alpha_s(),self.beta_s())
             
-            self.all_U[it], self.all_V[it], self.all_tau[it] = numpy.copy(self.U), numpy.copy(self.V), self.tau
+                self.samples.add(it,{'U':self.U,'V':self.V,'tau':self.tau})
             
-            perf = self.predict_while_running()
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
+                perf = self.predict_while_running()
+                for metric in metrics:
+                    self.all_performances[metric].append(perf[metric])
                 
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+                print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+            
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)            
             
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                self.iteration = it+1
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
+        finally:
+            if profiler is not None:
+                profiler.detach(self)
             
+        self.samples.flush()
+        (self.all_U, self.all_V, self.all_tau) = (self.samples.get('U'), self.samples.get('V'), self.samples.get('tau'))
         return (self.all_U, self.all_V, self.all_tau)
         
         
@@ -180,6 +243,8 @@ class bnmf_gibbs_optimised:
     # Return the average value for U, V, tau - i.e. our approximation to the expectations. 
     # Throw away the first <burn_in> samples, and then use every <thinning>th after.
     def approx_expectation(self,burn_in,thinning):
+        if self.samples is not None:
+            return tuple(self.samples.mean(name,burn_in,thinning) for name in ['U','V','tau'])
         indices = range(burn_in,len(self.all_U),thinning)
         exp_U = numpy.array([self.all_U[i] for i in indices]).sum(axis=0) / float(len(indices))      
         exp_V = numpy.array([self.all_V[i] for i in indices]).sum(axis=0) / float(len(indices))  
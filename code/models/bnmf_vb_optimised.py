@@ -4,11 +4,17 @@ We optimise the updates s.t. we compute each column of U and V using matrix
 operations, rather than each element individually.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
 - K, the number of latent factors
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaU' = [[lambdaUik]], 'lambdaV' = [[lambdaVjk]] },
     a dictionary defining the priors over tau, U, V.
+- dtype, the floating point type used for R, M, and the variational parameters:
+    float (default) or numpy.float32, halving the memory use. The updates of tau
+    only use sums over these, so they are accurate enough in single precision.
+- seed, if given we draw the random initialisation from our own numpy
+    RandomState with this seed, rather than the global one (default None).
     
 Initialisation can be done by running the initialise(init,tauUV) function. We initialise as follows:
 - init = 'exp'       -> muU[i,k] = 1/lambdaU[i,k], muV[j,k] = 1/lambdaV[j,k]
@@ -23,6 +29,16 @@ Usage of class:
 Or:
     BNMF = bnmf_vb(R,M,K,priors)
     BNMF.train(init,iterations)
+To warm start from a trained model BNMF_prev with a different K, we run
+BNMF.warm_start(BNMF_prev) after initialise(init).
+To save a checkpoint every N iterations, we run
+    BNMF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with BNMF.save_state(filename) and 
+BNMF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    BNMF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
 
 We can test the performance of our model on a test dataset, specifying our test set with a mask M. 
     performance = BNMF.predict(M_pred)
@@ -31,6 +47,15 @@ This gives a dictionary of performances,
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+
+We can also stop early, using BNMF.run(iterations,stop,tolerance,monitor_every):
+- stop = None   -> always run all iterations (default)
+       = 'elbo' -> stop when the relative change in the ELBO is at most tolerance
+       = 'tau'  -> stop when the relative change in exptau is at most tolerance
+- monitor_every = N -> only compute the performances and ELBO every N iterations
+    (and at the last one), as these need several passes over the data. The 
+    iterations at which we did are stored in BNMF.all_monitored, and the ELBOs
+    in BNMF.all_elbo.
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -42,17 +67,22 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 """
 
 from distributions.gamma import gamma_expectation, gamma_expectation_log, gamma_draw
-from distributions.truncated_normal_vector import TN_vector_expectation, TN_vector_variance
+from distributions.truncated_normal_vector import TN_vector_moments
 from distributions.exponential import exponential_draw
+from model_state import save_model_state, load_model_state
 
-import numpy, itertools, math, scipy, time
+import numpy, itertools, math, os, scipy, time
 from scipy.stats import norm
 import matplotlib.pyplot as plt
 
 class bnmf_vb_optimised:
-    def __init__(self,R,M,K,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,priors,dtype=float,seed=None):
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype in [numpy.float32,numpy.float64], "Unsupported dtype: %s. Should be float32 or float64." % self.dtype
+        self.R = numpy.asarray(R,dtype=self.dtype)
+        self.M = numpy.array(M,dtype=self.dtype)
+        self.rng = numpy.random.RandomState(seed) if seed is not None else numpy.random
+        self.seed = seed
         self.K = K
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
@@ -61,17 +91,17 @@ class bnmf_vb_optimised:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        self.size_Omega = float(self.M.sum())
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaU, self.lambdaV = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU']), numpy.array(priors['lambdaV'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU'],dtype=self.dtype), numpy.array(priors['lambdaV'],dtype=self.dtype)
         
         # If lambdaU or lambdaV are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaU.shape == ():
-            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
+            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K),dtype=self.dtype)
         if self.lambdaV.shape == ():
-            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
+            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K),dtype=self.dtype)
         
         assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
         assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
@@ -91,20 +121,18 @@ class bnmf_vb_optimised:
 
     # Initialise U, V, and tau. 
     def initialise(self,init='exp',tauUV={}):
-        self.tauU = tauUV['tauU'] if 'tauU' in tauUV else numpy.ones((self.I,self.K))
-        self.tauV = tauUV['tauV'] if 'tauV' in tauUV else numpy.ones((self.J,self.K))
+        self.tauU = tauUV['tauU'] if 'tauU' in tauUV else numpy.ones((self.I,self.K),dtype=self.dtype)
+        self.tauV = tauUV['tauV'] if 'tauV' in tauUV else numpy.ones((self.J,self.K),dtype=self.dtype)
         
         assert init in ['exp','random'], "Unrecognised init option for F,G: %s." % init
         self.muU, self.muV = 1./self.lambdaU, 1./self.lambdaV
         if init == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.muU[i,k] = exponential_draw(self.lambdaU[i,k])
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.muV[j,k] = exponential_draw(self.lambdaV[j,k])  
+            self.muU[:] = exponential_draw(self.lambdaU,rng=self.rng)
+            self.muV[:] = exponential_draw(self.lambdaV,rng=self.rng)
         
         # Initialise the expectations and variances
-        self.expU, self.varU = numpy.zeros((self.I,self.K)), numpy.zeros((self.I,self.K))
-        self.expV, self.varV = numpy.zeros((self.J,self.K)), numpy.zeros((self.J,self.K))
+        self.expU, self.varU = numpy.zeros((self.I,self.K),dtype=self.dtype), numpy.zeros((self.I,self.K),dtype=self.dtype)
+        self.expV, self.varV = numpy.zeros((self.J,self.K),dtype=self.dtype), numpy.zeros((self.J,self.K),dtype=self.dtype)
         
         for k in xrange(0,self.K):
             self.update_exp_U(k)
@@ -117,38 +145,104 @@ class bnmf_vb_optimised:
         self.update_exp_tau()
         
 
-    # Run the Gibbs sampler
-    def run(self,iterations):
-        self.all_exp_tau = []  # to check for convergence 
-        self.all_times = [] # to plot performance against time
+    # Warm start from a trained model with a different number of factors. After
+    # initialise(), we copy over its variational parameters for the first 
+    # min(K,model.K) factors, keeping the fresh initialisation for the others.
+    def warm_start(self,model):
+        assert (model.I,model.J) == (self.I,self.J), "Cannot warm start from a model of size (%s, %s) instead of (%s, %s)." % (model.I,model.J,self.I,self.J)
+        K = min(self.K,model.K)
+        self.muU[:,:K], self.tauU[:,:K] = model.muU[:,:K], model.tauU[:,:K]
+        self.muV[:,:K], self.tauV[:,:K] = model.muV[:,:K], model.tauV[:,:K]
+        for k in xrange(0,K):
+            self.update_exp_U(k)
+        for k in xrange(0,K):
+            self.update_exp_V(k)
+        self.update_tau()
+        self.update_exp_tau()
         
+
+    # Save the state of the model - the variational parameters, the iteration, and
+    # the random states - to a compressed .npz file, or load it back in.
+    def save_state(self,filename):
+        save_model_state(self,filename,['muU','tauU','muV','tauV','expU','varU','expV','varV','alpha_s','beta_s','exptau','explogtau'])
+        
+    def load_state(self,filename):
+        load_model_state(self,filename)
+        
+
+    # Run the Gibbs sampler. If checkpoint is given, we save the state to it every
+    # <checkpoint_every> iterations, and resume from it if it already exists.
+    def run(self,iterations,stop=None,tolerance=1e-6,monitor_every=1,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert stop in [None,'elbo','tau'], "Unknown stopping criterion: %s. Should be None, 'elbo', or 'tau'." % stop
+        assert monitor_every >= 1, "monitor_every should be at least 1, not %s." % monitor_every
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
         metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
-        
-        time_start = time.time()
-        for it in range(0,iterations):
-            for k in xrange(0,self.K):
-                self.update_U(k)
-                self.update_exp_U(k)    
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+            if self.converged:
+                return
+        else:
+            self.all_exp_tau = []  # to check for convergence 
+            self.all_times = [] # to plot performance against time
+            
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in metrics:
+                self.all_performances[metric] = []
+            self.all_elbo = []
+            self.all_monitored = [] # the iterations at which we computed the performances and ELBO
+            self.converged = False
+            self.iteration = 0
+        
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration,iterations):
+                for k in xrange(0,self.K):
+                    self.update_U(k)
+                    self.update_exp_U(k)    
                 
-            for k in xrange(0,self.K):
-                self.update_V(k)
-                self.update_exp_V(k)
+                for k in xrange(0,self.K):
+                    self.update_V(k)
+                    self.update_exp_V(k)
                 
-            self.update_tau()
-            self.update_exp_tau()
-            self.all_exp_tau.append(self.exptau)
+                self.update_tau()
+                self.update_exp_tau()
+                self.all_exp_tau.append(self.exptau)
             
-            perf, elbo = self.predict(self.M), self.elbo()
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
+                # Check whether the expectation of tau has converged
+                if stop == 'tau' and it > 0:
+                    self.converged = abs(self.all_exp_tau[-1] - self.all_exp_tau[-2]) <= tolerance * abs(self.all_exp_tau[-2])
+            
+                # Compute the performances and ELBO every <monitor_every> iterations, at the 
+                # last iteration, or if we have converged, and check whether the ELBO has converged
+                if (it+1) % monitor_every == 0 or it+1 == iterations or self.converged:
+                    perf, elbo = self.predict(self.M), self.elbo()
+                    for metric in metrics:
+                        self.all_performances[metric].append(perf[metric])
+                    self.all_elbo.append(elbo)
+                    self.all_monitored.append(it+1)
+                
+                    print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
                 
-            print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
+                    if stop == 'elbo' and len(self.all_elbo) > 1:
+                        self.converged = abs(self.all_elbo[-1] - self.all_elbo[-2]) <= tolerance * abs(self.all_elbo[-2])
+                    
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)   
+            
+                self.iteration = it+1
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
             
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                if self.converged:
+                    print "Converged after %s iterations." % (it+1)
+                    break
+        finally:
+            if profiler is not None:
+                profiler.detach(self)
             
         return
         
@@ -200,15 +294,13 @@ class bnmf_vb_optimised:
         #tn = TruncatedNormalVector(self.muU[:,k],self.tauU[:,k])
         #self.expU[:,k] = tn.expectation()
         #self.varU[:,k] = tn.variance()
-        self.expU[:,k] = TN_vector_expectation(self.muU[:,k],self.tauU[:,k])
-        self.varU[:,k] = TN_vector_variance(self.muU[:,k],self.tauU[:,k])
+        TN_vector_moments(self.muU[:,k],self.tauU[:,k],out_exp=self.expU[:,k],out_var=self.varU[:,k])
         
     def update_exp_V(self,k):
         #tn = TruncatedNormalVector(self.muV[:,k],self.tauV[:,k])
         #self.expV[:,k] = tn.expectation()
         #self.varV[:,k] = tn.variance()
-        self.expV[:,k] = TN_vector_expectation(self.muV[:,k],self.tauV[:,k])
-        self.varV[:,k] = TN_vector_variance(self.muV[:,k],self.tauV[:,k])
+        TN_vector_moments(self.muV[:,k],self.tauV[:,k],out_exp=self.expV[:,k],out_var=self.varV[:,k])
         
     def update_exp_tau(self):
         self.exptau = gamma_expectation(self.alpha_s,self.beta_s)
@@ -224,23 +316,25 @@ class bnmf_vb_optimised:
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
         
-    # Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation)
+    # Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation).
+    # R_pred can have a leading axis of restarts (see bnmf_vb_optimised_batch), in 
+    # which case we return an array with the value for each restart.
     def compute_MSE(self,M,R,R_pred):
-        return (M * (R-R_pred)**2).sum() / float(M.sum())
+        return (M * (R-R_pred)**2).sum(axis=(-2,-1)) / float(M.sum())
         
     def compute_R2(self,M,R,R_pred):
         mean = (M*R).sum() / float(M.sum())
         SS_total = float((M*(R-mean)**2).sum())
-        SS_res = float((M*(R-R_pred)**2).sum())
-        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf
+        SS_res = (M*(R-R_pred)**2).sum(axis=(-2,-1))
+        return 1. - SS_res / SS_total if SS_total != 0. else numpy.inf * numpy.ones_like(SS_res)
         
     def compute_Rp(self,M,R,R_pred):
         mean_real = (M*R).sum() / float(M.sum())
-        mean_pred = (M*R_pred).sum() / float(M.sum())
-        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum()
+        mean_pred = (M*R_pred).sum(axis=(-2,-1),keepdims=True) / float(M.sum())
+        covariance = (M*(R-mean_real)*(R_pred-mean_pred)).sum(axis=(-2,-1))
         variance_real = (M*(R-mean_real)**2).sum()
-        variance_pred = (M*(R_pred-mean_pred)**2).sum()
-        return covariance / float(math.sqrt(variance_real)*math.sqrt(variance_pred))
+        variance_pred = (M*(R_pred-mean_pred)**2).sum(axis=(-2,-1))
+        return covariance / (math.sqrt(variance_real)*numpy.sqrt(variance_pred))
         
         
     # Functions for model selection, measuring the goodness of fit vs model complexity
@@ -0,0 +1,262 @@
+"""
+Variational Bayesian inference for non-negative matrix factorisation, training
+multiple independent restarts at once.
+We stack the restarts along a leading axis, so U has shape (restarts,I,K) and V
+has shape (restarts,J,K), and do the updates of bnmf_vb_optimised for all of
+them using the same matrix operations. Each restart gives the same results as
+training bnmf_vb_optimised with the same initial values (up to rounding errors).
+The class extends bnmf_vb_optimised, whose constructor checks the arguments, and
+whose functions for the MSE, R^2, and Rp also work for a stack of predictions.
+
+We expect the following arguments:
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
+- K, the number of latent factors
+- priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaU' = [[lambdaUik]], 'lambdaV' = [[lambdaVjk]] },
+    a dictionary defining the priors over tau, U, V.
+- restarts, the number of restarts.
+- dtype, the floating point type used for R, M, and the variational parameters
+    (default float), as for bnmf_vb_optimised.
+- seed, the seed for the random initialisation (default None, using the global
+    numpy random state).
+
+Initialisation can be done by running the initialise(init) function, with init
+'exp' or 'random' as for bnmf_vb_optimised, drawing the values of each restart
+in turn (so 'exp' gives the same initial values for each restart).
+
+Usage of class:
+    BNMF = bnmf_vb_optimised_batch(R,M,K,priors,restarts)
+    BNMF.initialise(init)
+    BNMF.run(iterations)
+Or:
+    BNMF = bnmf_vb_optimised_batch(R,M,K,priors,restarts)
+    BNMF.train(iterations,init)
+To save a checkpoint every N iterations, we run
+    BNMF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with BNMF.save_state(filename) and
+BNMF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    BNMF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
+
+After that, we can obtain the restarts as bnmf_vb_optimised instances:
+    BNMF.restart(r)                 -> the r-th restart
+    BNMF.best()                     -> the restart with the highest log likelihood
+    BNMF.all_restarts()             -> a list of all restarts
+The functions predict(M_pred), elbo(), and log_likelihood() return an array with
+a value for each restart, and the performances of all iterations are stored in
+BNMF.all_performances, a dictionary from 'MSE', 'R^2', or 'Rp' to a list of
+such arrays.
+"""
+
+from distributions.truncated_normal_vector import TN_vector_moments
+from distributions.exponential import exponential_draw
+from bnmf_vb_optimised import bnmf_vb_optimised
+from model_state import save_model_state, load_model_state
+
+import numpy, math, os, scipy, time
+from scipy.special import psi as digamma
+
+class bnmf_vb_optimised_batch(bnmf_vb_optimised):
+    def __init__(self,R,M,K,priors,restarts,dtype=float,seed=None):
+        assert restarts > 0, "Need at least 1 restart."
+        bnmf_vb_optimised.__init__(self,R,M,K,priors,dtype=dtype,seed=seed)
+        self.restarts = restarts
+        self.priors = priors
+
+
+    # Initialise U, V, and tau for each restart.
+    def initialise(self,init='exp'):
+        assert init in ['exp','random'], "Unrecognised init option for F,G: %s." % init
+        (Rr,I,J,K) = (self.restarts,self.I,self.J,self.K)
+        self.tauU, self.tauV = numpy.ones((Rr,I,K),dtype=self.dtype), numpy.ones((Rr,J,K),dtype=self.dtype)
+        self.muU = numpy.array([1./self.lambdaU for r in range(0,Rr)])
+        self.muV = numpy.array([1./self.lambdaV for r in range(0,Rr)])
+        if init == 'random':
+            for r in range(0,Rr):
+                self.muU[r] = exponential_draw(self.lambdaU,rng=self.rng)
+                self.muV[r] = exponential_draw(self.lambdaV,rng=self.rng)
+
+        # Initialise the expectations and variances
+        self.expU, self.varU = numpy.zeros((Rr,I,K),dtype=self.dtype), numpy.zeros((Rr,I,K),dtype=self.dtype)
+        self.expV, self.varV = numpy.zeros((Rr,J,K),dtype=self.dtype), numpy.zeros((Rr,J,K),dtype=self.dtype)
+
+        for k in xrange(0,self.K):
+            self.update_exp_U(k)
+        for k in xrange(0,self.K):
+            self.update_exp_V(k)
+
+        # Update tau using the updates
+        self.update_tau()
+        self.update_exp_tau()
+
+
+    # Save the state of all restarts - the variational parameters, the iteration,
+    # and the random states - to a compressed .npz file, or load it back in.
+    def save_state(self,filename):
+        save_model_state(self,filename,['muU','tauU','muV','tauV','expU','varU','expV','varV','alpha_s','beta_s','exptau','explogtau'])
+
+    def load_state(self,filename):
+        load_model_state(self,filename)
+
+
+    # Run the updates for all restarts. If checkpoint is given, we save the state to
+    # it every <checkpoint_every> iterations, and resume from it if it already exists.
+    def run(self,iterations,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
+        metrics = ['MSE','R^2','Rp']
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+        else:
+            self.all_exp_tau = []  # to check for convergence
+            self.all_times = [] # to plot performance against time
+
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in metrics:
+                self.all_performances[metric] = []
+            self.iteration = 0
+
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration,iterations):
+                for k in xrange(0,self.K):
+                    self.update_U(k)
+                    self.update_exp_U(k)
+
+                for k in xrange(0,self.K):
+                    self.update_V(k)
+                    self.update_exp_V(k)
+
+                self.update_tau()
+                self.update_exp_tau()
+                self.all_exp_tau.append(self.exptau)
+
+                perf, elbo = self.predict(self.M), self.elbo()
+                for metric in metrics:
+                    self.all_performances[metric].append(perf[metric])
+
+                print "Iteration %s. Best ELBO: %s. Best MSE: %s." % (it+1,elbo.max(),perf['MSE'].min())
+
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)
+
+                self.iteration = it+1
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
+        finally:
+            if profiler is not None:
+                profiler.detach(self)
+
+
+    # Method for doing both initialise() and run()
+    def train(self,iterations,init='random'):
+        self.initialise(init=init)
+        self.run(iterations=iterations)
+
+
+    # Compute the ELBO of each restart
+    def elbo(self):
+        return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
+             - self.exptau / 2. * self.exp_square_diff() \
+             + numpy.log(self.lambdaU).sum() - ( self.lambdaU * self.expU ).sum(axis=(1,2)) \
+             + numpy.log(self.lambdaV).sum() - ( self.lambdaV * self.expV ).sum(axis=(1,2)) \
+             + self.alpha * math.log(self.beta) - scipy.special.gammaln(self.alpha) \
+             + (self.alpha - 1.)*self.explogtau - self.beta * self.exptau \
+             - self.alpha_s * numpy.log(self.beta_s) + scipy.special.gammaln(self.alpha_s) \
+             - (self.alpha_s - 1.)*self.explogtau + self.beta_s * self.exptau \
+             - .5*numpy.log(self.tauU).sum(axis=(1,2)) + self.I*self.K/2.*math.log(2*math.pi) \
+             + numpy.log(0.5*scipy.special.erfc(-self.muU*numpy.sqrt(self.tauU)/math.sqrt(2))).sum(axis=(1,2)) \
+             + ( self.tauU / 2. * ( self.varU + (self.expU - self.muU)**2 ) ).sum(axis=(1,2)) \
+             - .5*numpy.log(self.tauV).sum(axis=(1,2)) + self.J*self.K/2.*math.log(2*math.pi) \
+             + numpy.log(0.5*scipy.special.erfc(-self.muV*numpy.sqrt(self.tauV)/math.sqrt(2))).sum(axis=(1,2)) \
+             + ( self.tauV / 2. * ( self.varV + (self.expV - self.muV)**2 ) ).sum(axis=(1,2))
+
+
+    # Compute the dot product U*V.T for each restart
+    def UVT(self,U,V):
+        return numpy.matmul(U,V.transpose(0,2,1))
+
+    # Update the parameters for the distributions
+    def update_tau(self):
+        self.alpha_s = self.alpha + self.size_Omega/2.0
+        self.beta_s = self.beta + 0.5*self.exp_square_diff()
+
+    def exp_square_diff(self): # Compute: sum_Omega E_q(U,V) [ ( Rij - Ui Vj )^2 ] for each restart
+        return (self.M *( ( self.R - self.UVT(self.expU,self.expV) )**2 + \
+                          ( self.UVT(self.varU+self.expU**2, self.varV+self.expV**2) - self.UVT(self.expU**2,self.expV**2) ) ) ).sum(axis=(1,2))
+
+    # In the updates of U and V, rather than adding the outer product for column k
+    # to the residual as bnmf_vb_optimised does, we add its contribution afterwards.
+    def update_U(self,k):
+        Vk = self.expV[:,:,k]
+        residual = self.M * (self.R - self.UVT(self.expU,self.expV))
+        exptau = self.exptau[:,None].astype(self.dtype)
+        self.tauU[:,:,k] = exptau * numpy.dot( self.varV[:,:,k] + Vk**2, self.M.T ) #sum over j, so rows
+        self.muU[:,:,k] = 1./self.tauU[:,:,k] * (-self.lambdaU[:,k] + exptau*(
+            numpy.matmul(residual,Vk[:,:,None])[:,:,0] + self.expU[:,:,k]*numpy.dot(Vk**2,self.M.T) ))
+
+    def update_V(self,k):
+        Uk = self.expU[:,:,k]
+        residual = self.M * (self.R - self.UVT(self.expU,self.expV))
+        exptau = self.exptau[:,None].astype(self.dtype)
+        self.tauV[:,:,k] = exptau * numpy.dot( self.varU[:,:,k] + Uk**2, self.M ) #sum over i, so columns
+        self.muV[:,:,k] = 1./self.tauV[:,:,k] * (-self.lambdaV[:,k] + exptau*(
+            numpy.matmul(Uk[:,None,:],residual)[:,0,:] + self.expV[:,:,k]*numpy.dot(Uk**2,self.M) ))
+
+
+    # Update the expectations and variances
+    def update_exp_U(self,k):
+        TN_vector_moments(self.muU[:,:,k],self.tauU[:,:,k],out_exp=self.expU[:,:,k],out_var=self.varU[:,:,k])
+
+    def update_exp_V(self,k):
+        TN_vector_moments(self.muV[:,:,k],self.tauV[:,:,k],out_exp=self.expV[:,:,k],out_var=self.varV[:,:,k])
+
+    def update_exp_tau(self):
+        self.exptau = self.alpha_s / self.beta_s
+        self.explogtau = digamma(self.alpha_s) - numpy.log(self.beta_s)
+
+
+    # Compute the expectation of U and V, and use it to predict missing values, for each restart
+    def predict(self,M_pred):
+        R_pred = self.UVT(self.expU,self.expV)
+        MSE = self.compute_MSE(M_pred,self.R,R_pred)
+        R2 = self.compute_R2(M_pred,self.R,R_pred)
+        Rp = self.compute_Rp(M_pred,self.R,R_pred)
+        return {'MSE':MSE,'R^2':R2,'Rp':Rp}
+
+
+    # Return the likelihood of the data given the trained model's parameters, for each restart
+    def log_likelihood(self):
+        return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
+             - self.exptau / 2. * (self.M*( self.R - self.UVT(self.expU,self.expV) )**2).sum(axis=(1,2))
+
+
+    # Return restart r as a bnmf_vb_optimised instance
+    def restart(self,r):
+        BNMF = bnmf_vb_optimised(self.R,self.M,self.K,self.priors,dtype=self.dtype)
+        for name in ['muU','tauU','expU','varU','muV','tauV','expV','varV']:
+            setattr(BNMF,name,numpy.copy(getattr(self,name)[r]))
+        BNMF.alpha_s, BNMF.beta_s = self.alpha_s, self.beta_s[r]
+        BNMF.exptau, BNMF.explogtau = self.exptau[r], self.explogtau[r]
+        if hasattr(self,'all_exp_tau'):
+            BNMF.all_exp_tau = [exp_tau[r] for exp_tau in self.all_exp_tau]
+            BNMF.all_times = list(self.all_times)
+            BNMF.all_performances = {
+                metric : [performance[r] for performance in performances]
+                for metric,performances in self.all_performances.items()
+            }
+        return BNMF
+
+    # Return the restart with the highest log likelihood
+    def best(self):
+        return self.restart(numpy.argmax(self.log_likelihood()))
+
+    # Return a list of all restarts
+    def all_restarts(self):
+        return [self.restart(r) for r in range(0,self.restarts)]
@@ -3,17 +3,38 @@ Gibbs sampler for non-negative matrix tri-factorisation.
 Optimised to draw all columns in parallel.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
 - K, the number of row clusters
 - L, the number of column clusters
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaF' = [[lambdaFik]], 'lambdaS' = [[lambdaSkl]], 'lambdaG' = [[lambdaGjl]] },
     a dictionary defining the priors over tau, F, S, G.
+- cache_residual, if True we keep the residual M*(R - F*S*G.T) during run(), and
+    update it with a low-rank correction after each draw of a column of F or G,
+    or an entry of S. The parameters are then computed using matrix-vector 
+    products with the residual, rather than recomputing F*S*G.T each time. This 
+    gives the same draws as before (up to rounding errors). The residual is 
+    recomputed at the start of each iteration (default False).
+- block_S, if True we draw all entries of S in one block in run(). Since F and
+    G do not change while we draw S, we compute the statistics for all K*L 
+    entries at once using a few matrix products (of size K^2 x L^2), and then 
+    draw the entries in the same order as before, using only K x L sized 
+    corrections. This gives the same draws (up to rounding errors) (default False).
+- dtype, the floating point type used for R, M, F, S, G, and the stored samples:
+    float (default) or numpy.float32, halving the memory use.
+- seed, if given we draw the random initialisation from our own numpy
+    RandomState with this seed, rather than the global one, and also use it for
+    the KMeans initialisation (default None). The draws in run() still use the
+    global random state.
     
 Initialisation can be done by running the initialise() function, with argument init:
 - init='random' -> draw initial values randomly from priors Exp, Gamma
 - init='exp'    -> use the expectation of the priors Exp, Gamma
 Alternatively, you can define your own initial values for F, S, G, and tau.
+With init_FG = 'kmeans' or 'kmeans++', we can give initialise() a list of
+kmeans_seeds, in which case we cluster once per seed (in kmeans_P parallel
+processes) and use the clustering with the lowest distortion.
 
 Usage of class:
     BNMF = bnmf_gibbs(R,M,K,L,priors)
@@ -22,11 +43,27 @@ Usage of class:
 Or:
     BNMF = bnmf_gibbs(R,M,K,L,priors)
     BNMF.train(init,iterations)
+To warm start from a trained model BNMF_prev with a different K or L, we run
+BNMF.warm_start(BNMF_prev) after initialise(init).
+To save a checkpoint every N iterations, we run
+    BNMF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with BNMF.save_state(filename) and 
+BNMF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    BNMF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
     
 This returns a tuple (Fs,Ss,Gs,taus) of lists of F, S, G, tau values - of size <iterations>.
 
 The expectation can be computed by specifying a burn-in and thinning rate, and using:
     BNMF.approx_expectation(burn_in,thinning)
+If we already know the burn-in and thinning, we can give them to run instead:
+    BNMF.run(iterations,burn_in,thinning,running_sums,folder)
+so that we only store the retained samples (see sample_store.py), or with 
+running_sums=True only their running sums and sums of squares. If folder is 
+given, the samples are stored in memory-mapped files <folder>/<name>.npy.
+The samples are stored in the dtype given to the constructor.
 
 We can test the performance of our model on a test dataset, specifying our test set with a mask M. 
     performance = BNMF.predict(M_pred,burn_in,thinning)
@@ -44,20 +81,28 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 (we want to maximise these values)
 """
 
-from kmeans.kmeans import KMeans
+from kmeans.kmeans import multistart_kmeans
 from distributions.exponential import exponential_draw
 from distributions.gamma import gamma_draw
 from distributions.truncated_normal import TN_draw
 from distributions.truncated_normal_vector import TN_vector_draw
+from sample_store import SampleStore
+from model_state import save_model_state, load_model_state
 
-import numpy, itertools, math, time
+import numpy, itertools, math, os, time
 
 class bnmtf_gibbs_optimised:
-    def __init__(self,R,M,K,L,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,L,priors,cache_residual=False,block_S=False,dtype=float,seed=None):
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype in [numpy.float32,numpy.float64], "Unsupported dtype: %s. Should be float32 or float64." % self.dtype
+        self.R = numpy.asarray(R,dtype=self.dtype)
+        self.M = numpy.array(M,dtype=self.dtype)
+        self.rng = numpy.random.RandomState(seed) if seed is not None else numpy.random
+        self.seed = seed
         self.K = K
         self.L = L
+        self.cache_residual = cache_residual
+        self.block_S = block_S
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
             "but instead %s-dimensional." % len(self.R.shape)
@@ -65,19 +110,20 @@ class bnmtf_gibbs_optimised:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        self.samples = None
+        self.size_Omega = float(self.M.sum())
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaF, self.lambdaS, self.lambdaG = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF']), numpy.array(priors['lambdaS']), numpy.array(priors['lambdaG'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF'],dtype=self.dtype), numpy.array(priors['lambdaS'],dtype=self.dtype), numpy.array(priors['lambdaG'],dtype=self.dtype)
         
         # If lambdaF, lambdaS, or lambdaG are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaF.shape == ():
-            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K))
+            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K),dtype=self.dtype)
         if self.lambdaS.shape == ():
-            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L))
+            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L),dtype=self.dtype)
         if self.lambdaG.shape == ():
-            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L))
+            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L),dtype=self.dtype)
         
         assert self.lambdaF.shape == (self.I,self.K), "Prior matrix lambdaF has the wrong shape: %s instead of (%s, %s)." % (self.lambdaF.shape,self.I,self.K)
         assert self.lambdaS.shape == (self.K,self.L), "Prior matrix lambdaS has the wrong shape: %s instead of (%s, %s)." % (self.lambdaS.shape,self.K,self.L)
@@ -103,80 +149,131 @@ class bnmtf_gibbs_optimised:
 
 
     # Initialise U, V, and tau. If init='random', draw values from an Exp and Gamma distribution. If init='exp', set it to the expectation values.
-    def initialise(self,init_S='random',init_FG='random'):
+    def initialise(self,init_S='random',init_FG='random',kmeans_seeds=None,kmeans_P=1):
         assert init_S in ['random','exp'], "Unknown initialisation option for S: %s. Should be 'random' or 'exp'." % init_S
-        assert init_FG in ['random','exp','kmeans'], "Unknown initialisation option for S: %s. Should be 'random', 'exp', or 'kmeans." % init_FG
+        assert init_FG in ['random','exp','kmeans','kmeans++'], "Unknown initialisation option for F,G: %s. Should be 'random', 'exp', 'kmeans', or 'kmeans++'." % init_FG
         
         self.S = 1./self.lambdaS
         if init_S == 'random':
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):  
-                self.S[k,l] = exponential_draw(self.lambdaS[k,l])
+            self.S[:] = exponential_draw(self.lambdaS,rng=self.rng)
                 
         self.F, self.G = 1./self.lambdaF, 1./self.lambdaG
         if init_FG == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.F[i,k] = exponential_draw(self.lambdaF[i,k])
-            for j,l in itertools.product(xrange(0,self.J),xrange(0,self.L)):
-                self.G[j,l] = exponential_draw(self.lambdaG[j,l])
-        elif init_FG == 'kmeans':
+            self.F[:] = exponential_draw(self.lambdaF,rng=self.rng)
+            self.G[:] = exponential_draw(self.lambdaG,rng=self.rng)
+        elif init_FG in ['kmeans','kmeans++']:
+            seeds = kmeans_seeds if kmeans_seeds is not None else [self.seed]
             print "Initialising F using KMeans."
-            kmeans_F = KMeans(self.R,self.M,self.K)
-            kmeans_F.initialise()
-            kmeans_F.cluster()
-            self.F = kmeans_F.clustering_results + 0.2            
+            kmeans_F = multistart_kmeans(self.R,self.M,self.K,seeds,init='random' if init_FG == 'kmeans' else 'kmeans++',P=kmeans_P)
+            self.F = (kmeans_F.clustering_results + 0.2).astype(self.dtype)            
             
             print "Initialising G using KMeans."
-            kmeans_G = KMeans(self.R.T,self.M.T,self.L)   
-            kmeans_G.initialise()
-            kmeans_G.cluster()
-            self.G = kmeans_G.clustering_results + 0.2
+            kmeans_G = multistart_kmeans(self.R.T,self.M.T,self.L,seeds,init='random' if init_FG == 'kmeans' else 'kmeans++',P=kmeans_P)
+            self.G = (kmeans_G.clustering_results + 0.2).astype(self.dtype)
 
+        if self.cache_residual:
+            self.update_residual()
         self.tau = self.alpha_s() / self.beta_s()
 
 
-    # Run the Gibbs sampler
-    def run(self,iterations):
-        self.all_F = numpy.zeros((iterations,self.I,self.K))  
-        self.all_S = numpy.zeros((iterations,self.K,self.L))   
-        self.all_G = numpy.zeros((iterations,self.J,self.L))  
-        self.all_tau = numpy.zeros(iterations)
-        self.all_times = [] # to plot performance against time
+    # Warm start from a trained model with a different number of row or column 
+    # clusters. After initialise(), we copy over its current F, S, and G for the
+    # first min(K,model.K) row and min(L,model.L) column clusters, keeping the 
+    # fresh initialisation for the others.
+    def warm_start(self,model):
+        assert (model.I,model.J) == (self.I,self.J), "Cannot warm start from a model of size (%s, %s) instead of (%s, %s)." % (model.I,model.J,self.I,self.J)
+        K, L = min(self.K,model.K), min(self.L,model.L)
+        self.F[:,:K], self.S[:K,:L], self.G[:,:L] = model.F[:,:K], model.S[:K,:L], model.G[:,:L]
+        if self.cache_residual:
+            self.update_residual()
+        self.tau = self.alpha_s() / self.beta_s()
+        
+
+    # Save the state of the model - F, S, G, tau, the samples, the iteration, and 
+    # the random states - to a compressed .npz file, or load it back in.
+    def save_state(self,filename):
+        save_model_state(self,filename,['F','S','G','tau','residual'])
         
+    def load_state(self,filename):
+        load_model_state(self,filename)
+        
+
+    # Run the Gibbs sampler. If checkpoint is given, we save the state to it every
+    # <checkpoint_every> iterations, and resume from it if it already exists.
+    def run(self,iterations,burn_in=0,thinning=1,running_sums=False,folder=None,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
         metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
-        
-        time_start = time.time()
-        for it in range(0,iterations):            
-            for k in range(0,self.K):
-                tauFk = self.tauF(k)
-                muFk = self.muF(tauFk,k)
-                self.F[:,k] = TN_vector_draw(muFk,tauFk)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+            assert self.samples.iterations == iterations, "Checkpoint %s is for a run of %s iterations, not %s." % (checkpoint,self.samples.iterations,iterations)
+        else:
+            self.samples = SampleStore([('F',(self.I,self.K)),('S',(self.K,self.L)),('G',(self.J,self.L)),('tau',())],iterations,burn_in,thinning,running_sums,folder,self.dtype)
+            self.all_times = [] # to plot performance against time
+            
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in metrics:
+                self.all_performances[metric] = []
+            self.iteration = 0
+        
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration,iterations):    
+                if self.cache_residual:
+                    self.update_residual()
+                
+                for k in range(0,self.K):
+                    tauFk = self.tauF(k)
+                    muFk = self.muF(tauFk,k)
+                    new_Fk = TN_vector_draw(muFk,tauFk)
+                    if self.cache_residual:
+                        self.residual -= self.M * numpy.outer(new_Fk-self.F[:,k],numpy.dot(self.S[k],self.G.T))
+                    self.F[:,k] = new_Fk
                 
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
-                tauSkl = self.tauS(k,l)
-                muSkl = self.muS(tauSkl,k,l)
-                self.S[k,l] = TN_draw(muSkl,tauSkl)
+                if self.block_S:
+                    self.draw_S_block()
+                else:
+                    for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+                        tauSkl = self.tauS(k,l)
+                        muSkl = self.muS(tauSkl,k,l)
+                        new_Skl = TN_draw(muSkl,tauSkl)
+                        if self.cache_residual:
+                            self.residual -= (new_Skl-self.S[k,l]) * self.M * numpy.outer(self.F[:,k],self.G[:,l])
+                        self.S[k,l] = new_Skl
                 
-            for l in range(0,self.L):
-                tauGl = self.tauG(l)
-                muGl = self.muG(tauGl,l)
-                self.G[:,l] = TN_vector_draw(muGl,tauGl)
+                for l in range(0,self.L):
+                    tauGl = self.tauG(l)
+                    muGl = self.muG(tauGl,l)
+                    new_Gl = TN_vector_draw(muGl,tauGl)
+                    if self.cache_residual:
+                        self.residual -= self.M * numpy.outer(numpy.dot(self.F,self.S[:,l]),new_Gl-self.G[:,l])
+                    self.G[:,l] = new_Gl
                 
-            self.tau = gamma_draw(self.alpha_s(),self.beta_s())
+                self.tau = gamma_draw(self.alpha_s(),self.beta_s())
             
-            self.all_F[it], self.all_S[it], self.all_G[it], self.all_tau[it] = numpy.copy(self.F), numpy.copy(self.S), numpy.copy(self.G), self.tau
+                self.samples.add(it,{'F':self.F,'S':self.S,'G':self.G,'tau':self.tau})
             
-            perf = self.predict_while_running()
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
+                perf = self.predict_while_running()
+                for metric in metrics:
+                    self.all_performances[metric].append(perf[metric])
                 
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+                print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
         
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)            
+            
+                self.iteration = it+1
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
+        finally:
+            if profiler is not None:
+                profiler.detach(self)
             
+        self.samples.flush()
+        (self.all_F, self.all_S, self.all_G, self.all_tau) = (self.samples.get('F'), self.samples.get('S'), self.samples.get('G'), self.samples.get('tau'))
         return (self.all_F, self.all_S, self.all_G, self.all_tau)
         
 
@@ -185,35 +282,75 @@ class bnmtf_gibbs_optimised:
         return numpy.dot(M1,numpy.dot(M2,M3))
         
         
+    # Draw all entries of S, in the same order as run(). F and G stay the same, 
+    # so we first compute:
+    # - tauS[k,l] = tau * sum_ij M_ij F_ik^2 G_jl^2
+    # - B[k,l] = sum_ij M_ij R_ij F_ik G_jl
+    # - C[k,l,k',l'] = sum_ij M_ij F_ik F_ik' G_jl G_jl'
+    # and then each muS[k,l] only needs the current values of S.
+    def draw_S_block(self):
+        (I,J,K,L) = (self.I,self.J,self.K,self.L)
+        FF = (self.F[:,:,None]*self.F[:,None,:]).reshape(I,K*K)
+        GG = (self.G[:,:,None]*self.G[:,None,:]).reshape(J,L*L)
+        tauS = self.tau * numpy.dot( (self.F**2).T, numpy.dot(self.M,self.G**2) )
+        B = numpy.dot( self.F.T, numpy.dot(self.M*self.R,self.G) )
+        C = numpy.dot( FF.T, numpy.dot(self.M,GG) ).reshape(K,K,L,L).transpose(0,2,1,3)
+        
+        for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+            muSkl = 1./tauS[k,l] * (-self.lambdaS[k,l] + self.tau*(B[k,l] - (C[k,l]*self.S).sum() + self.S[k,l]*C[k,l,k,l]))
+            self.S[k,l] = TN_draw(muSkl,tauS[k,l])
+            
+        if self.cache_residual:
+            self.update_residual()
+        
+        
+    # Recompute the residual M*(R - F*S*G.T) from scratch
+    def update_residual(self):
+        self.residual = self.M * (self.R-self.triple_dot(self.F,self.S,self.G.T))
+        
+        
     # Compute the parameters for the distributions we sample from
     def alpha_s(self):   
         return self.alpha + self.size_Omega/2.0
     
     def beta_s(self):   
+        if self.cache_residual:
+            return self.beta + 0.5*(self.residual**2).sum()
         return self.beta + 0.5*(self.M*(self.R-self.triple_dot(self.F,self.S,self.G.T))**2).sum()
         
     def tauF(self,k):       
         return self.tau * ( self.M * numpy.dot(self.S[k],self.G.T)**2 ).sum(axis=1)
         
     def muF(self,tauFk,k):
+        if self.cache_residual:
+            SkG = numpy.dot(self.S[k],self.G.T)
+            return 1./tauFk * (-self.lambdaF[:,k] + self.tau*(numpy.dot(self.residual,SkG) + self.F[:,k]*numpy.dot(self.M,SkG**2)))
         return 1./tauFk * (-self.lambdaF[:,k] + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+numpy.outer(self.F[:,k],numpy.dot(self.S[k],self.G.T)))*numpy.dot(self.S[k],self.G.T) )).sum(axis=1)) 
         
     def tauS(self,k,l):       
         return self.tau * ( self.M * numpy.outer(self.F[:,k]**2,self.G[:,l]**2) ).sum()
         
     def muS(self,tauSkl,k,l):
+        if self.cache_residual:
+            Fk, Gl = self.F[:,k], self.G[:,l]
+            return 1./tauSkl * (-self.lambdaS[k,l] + self.tau*(numpy.dot(Fk,numpy.dot(self.residual,Gl)) + self.S[k,l]*numpy.dot(Fk**2,numpy.dot(self.M,Gl**2))))
         return 1./tauSkl * (-self.lambdaS[k,l] + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+self.S[k,l]*numpy.outer(self.F[:,k],self.G[:,l]))*numpy.outer(self.F[:,k],self.G[:,l]) )).sum()) 
         
     def tauG(self,l):       
         return self.tau * ( self.M.T * numpy.dot(self.F,self.S[:,l])**2 ).T.sum(axis=0)
         
     def muG(self,tauGl,l):
+        if self.cache_residual:
+            FSl = numpy.dot(self.F,self.S[:,l])
+            return 1./tauGl * (-self.lambdaG[:,l] + self.tau*(numpy.dot(self.residual.T,FSl) + self.G[:,l]*numpy.dot(self.M.T,FSl**2)))
         return 1./tauGl * (-self.lambdaG[:,l] + self.tau*(self.M * ( (self.R-self.triple_dot(self.F,self.S,self.G.T)+numpy.outer(numpy.dot(self.F,self.S[:,l]),self.G[:,l])).T * numpy.dot(self.F,self.S[:,l]) ).T).sum(axis=0)) 
         
 
     # Return the average value for U, V, tau - i.e. our approximation to the expectations. 
     # Throw away the first <burn_in> samples, and then use every <thinning>th after.
     def approx_expectation(self,burn_in,thinning):
+        if self.samples is not None:
+            return tuple(self.samples.mean(name,burn_in,thinning) for name in ['F','S','G','tau'])
         indices = range(burn_in,len(self.all_F),thinning)
         exp_F = numpy.array([self.all_F[i] for i in indices]).sum(axis=0) / float(len(indices))      
         exp_S = numpy.array([self.all_S[i] for i in indices]).sum(axis=0) / float(len(indices))   
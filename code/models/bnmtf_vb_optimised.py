@@ -4,12 +4,34 @@ We optimise the updates s.t. we compute each column of F and G using matrix
 operations, rather than each element individually.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
 - K, the number of row clusters
 - L, the number of column clusters
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaF' = [[lambdaFik]], 'lambdaS' = [[lambdaSkl]], 'lambdaG' = [[lambdaGjl]] },
     a dictionary defining the priors over tau, F, S, G.
+- sparse, if True we store the observed entries (i,j,Rij) as coordinate lists,
+    and compute all updates, the ELBO, and the predictions over Omega only,
+    rather than using dense I x J matrices multiplied by M (default False).
+    We then do not store M, and only keep a reference to R (without converting
+    or copying it) to read the true values of test entries outside Omega.
+- cache_residual, if True we keep the residual R - expF*expS*expG.T (in Omega),
+    and update it with a low-rank correction whenever a column of F or G, or an
+    entry of S, changes. The residual is recomputed once per iteration in run().
+    The updates then use matrix-vector products with M and the residual, rather
+    than recomputing expF*expS*expG.T each time (default False).
+- block_S, if True we update all entries of S in one block in run(). Since F 
+    and G do not change while we update S, we compute the statistics for all 
+    K*L entries at once using a few matrix products (of size K^2 x L^2), and 
+    then do the same coordinate ascent updates, in the same random order, using 
+    only K x L sized corrections (default False).
+- dtype, the floating point type used for R, M (or the lists over Omega if
+    sparse), and the variational parameters: float (default) or numpy.float32,
+    halving the memory use and the cost of the matrix products.
+- seed, if given we draw the random initialisation and the random order of the
+    updates in run() from our own numpy RandomState with this seed, rather than
+    the global random states, and also use it for KMeans (default None).
     
 Initialisation can be done by running the initialise(init_S,init_FG,tauFSG) function, with argument 
 init_S for S, and init_FG for F and G:
@@ -18,6 +40,11 @@ init_S for S, and init_FG for F and G:
 - init_FG = 'exp'       -> muF[i,k] = 1/lambdaF[i,k], muG[j,l] = 1/lambdaG[j,l]
           = 'random'    -> muF[i,k] ~ Exp(lambdaF[i,k]), muG[j,l] ~ Exp(lambdaG[j,l])
           = 'kmeans'    -> muF = KMeans(R,rows)+0.2, muG = KMeans(R,columns)+0.2
+          = 'kmeans++'  -> the same, but seeding KMeans with k-means++ rather than
+                           uniformly random centroids
+With init_FG = 'kmeans' or 'kmeans++', we can give initialise() a list of
+kmeans_seeds, in which case we cluster once per seed (in kmeans_P parallel
+processes) and use the clustering with the lowest distortion.
 - tauF[i,k] = tauS[k,l] = tauG[j,l] = 1 if tauFSG = {}, else tauF = tauFSG['tauF'], etc.
 - alpha_s, beta_s using updates of model
 
@@ -29,6 +56,16 @@ Usage of class:
 Or:
     BNMF = bnmf_vb(R,M,K,L,priors)
     BNMF.train(init_S,init_FG,iterations)
+To warm start from a trained model BNMF_prev with a different K or L, we run
+BNMF.warm_start(BNMF_prev) after initialise(init_S,init_FG).
+To save a checkpoint every N iterations, we run
+    BNMF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with BNMF.save_state(filename) and 
+BNMF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    BNMF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
     
 We can test the performance of our model on a test dataset, specifying our test set with a mask M. 
     performance = BNMF.predict(M_pred)
@@ -37,6 +74,15 @@ This gives a dictionary of performances,
     
 The performances of all iterations are stored in BNMF.all_performances, which 
 is a dictionary from 'MSE', 'R^2', or 'Rp' to a list of performances.
+
+We can also stop early, using BNMF.run(iterations,stop,tolerance,monitor_every):
+- stop = None   -> always run all iterations (default)
+       = 'elbo' -> stop when the relative change in the ELBO is at most tolerance
+       = 'tau'  -> stop when the relative change in exptau is at most tolerance
+- monitor_every = N -> only compute the performances and ELBO every N iterations
+    (and at the last one), as these need several passes over the data. The 
+    iterations at which we did are stored in BNMF.all_monitored, and the ELBOs
+    in BNMF.all_elbo.
     
 Finally, we can return the goodness of fit of the data using the quality(metric) function:
 - metric = 'loglikelihood' -> return p(D|theta)
@@ -47,57 +93,87 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 (we want to maximise these values)
 """
 
-from kmeans.kmeans import KMeans
+from kmeans.kmeans import multistart_kmeans
 from distributions.gamma import gamma_expectation, gamma_expectation_log
-from distributions.truncated_normal import TN_expectation, TN_variance
-from distributions.truncated_normal_vector import TN_vector_expectation, TN_vector_variance
+from distributions.truncated_normal import TN_moments
+from distributions.truncated_normal_vector import TN_vector_moments
 from distributions.exponential import exponential_draw
+from model_state import save_model_state, load_model_state
 
-import numpy, itertools, math, scipy, time
+import numpy, itertools, math, os, scipy, time
+from scipy.sparse import csr_matrix
 from random import shuffle
 
 class bnmtf_vb_optimised:
-    def __init__(self,R,M,K,L,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,L,priors,sparse=False,cache_residual=False,block_S=False,dtype=float,seed=None):
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype in [numpy.float32,numpy.float64], "Unsupported dtype: %s. Should be float32 or float64." % self.dtype
+        self.sparse = sparse
+        self.cache_residual = cache_residual
+        self.block_S = block_S
+        self.R = numpy.asarray(R) if self.sparse else numpy.asarray(R,dtype=self.dtype)
+        if not self.sparse:
+            self.M = numpy.array(M,dtype=self.dtype)
+        self.rng = numpy.random.RandomState(seed) if seed is not None else numpy.random
+        self.seed = seed
         self.K = K
         self.L = L
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
             "but instead %s-dimensional." % len(self.R.shape)
-        assert self.R.shape == self.M.shape, "Input matrix R is not of the same size as " \
-            "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
+        assert self.R.shape == numpy.shape(M), "Input matrix R is not of the same size as " \
+            "the indicator matrix M: %s and %s respectively." % (self.R.shape,numpy.shape(M))
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        if self.sparse or self.cache_residual:
+            self.initialise_omega(M)
+        self.size_Omega = float(len(self.R_omega)) if self.sparse else float(self.M.sum())
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaF, self.lambdaS, self.lambdaG = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF']), numpy.array(priors['lambdaS']), numpy.array(priors['lambdaG'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF'],dtype=self.dtype), numpy.array(priors['lambdaS'],dtype=self.dtype), numpy.array(priors['lambdaG'],dtype=self.dtype)
         
         # If lambdaF, lambdaS, or lambdaG are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaF.shape == ():
-            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K))
+            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K),dtype=self.dtype)
         if self.lambdaS.shape == ():
-            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L))
+            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L),dtype=self.dtype)
         if self.lambdaG.shape == ():
-            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L))
+            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L),dtype=self.dtype)
         
         assert self.lambdaF.shape == (self.I,self.K), "Prior matrix lambdaF has the wrong shape: %s instead of (%s, %s)." % (self.lambdaF.shape,self.I,self.K)
         assert self.lambdaS.shape == (self.K,self.L), "Prior matrix lambdaS has the wrong shape: %s instead of (%s, %s)." % (self.lambdaS.shape,self.K,self.L)
         assert self.lambdaG.shape == (self.J,self.L), "Prior matrix lambdaG has the wrong shape: %s instead of (%s, %s)." % (self.lambdaG.shape,self.J,self.L)
+        
+        self.M_varG, self.M_varF = None, None     # M_omega.dot(varG) during a sweep over F, and M_omega.T.dot(varF) over G
                    
             
     # Raise an exception if an entire row or column is empty
     def check_empty_rows_columns(self):
-        sums_columns = self.M.sum(axis=0)
-        sums_rows = self.M.sum(axis=1)
+        if self.sparse:
+            sums_columns = numpy.bincount(self.omega_columns,minlength=self.J)
+            sums_rows = numpy.bincount(self.omega_rows,minlength=self.I)
+        else:
+            sums_columns = self.M.sum(axis=0)
+            sums_rows = self.M.sum(axis=1)
                     
         # Assert none of the rows or columns are entirely unknown values
         for i,c in enumerate(sums_rows):
             assert c != 0, "Fully unobserved row in R, row %s." % i
         for j,c in enumerate(sums_columns):
             assert c != 0, "Fully unobserved column in R, column %s." % j
+            
+            
+    # Store the observed entries as coordinate lists (i,j,Rij), ordered by row, 
+    # and the mask as a sparse matrix. If not sparse, we use M*R and M instead.
+    def initialise_omega(self,M):
+        if self.sparse:
+            (self.omega_rows,self.omega_columns) = numpy.nonzero(M)
+            self.R_omega = numpy.asarray(self.R[self.omega_rows,self.omega_columns],dtype=self.dtype)
+            self.M_omega = csr_matrix((numpy.ones(len(self.omega_rows),dtype=self.dtype),(self.omega_rows,self.omega_columns)),shape=(self.I,self.J))
+        else:
+            self.R_omega = self.M * self.R
+            self.M_omega = self.M
 
 
     # Initialise and run the sampler
@@ -107,41 +183,42 @@ class bnmtf_vb_optimised:
 
 
     # Initialise U, V, and tau. 
-    def initialise(self,init_S='random',init_FG='random',tauFSG={}):
-        self.tauF = tauFSG['tauF'] if 'tauF' in tauFSG else numpy.ones((self.I,self.K))
-        self.tauS = tauFSG['tauS'] if 'tauS' in tauFSG else numpy.ones((self.K,self.L))
-        self.tauG = tauFSG['tauG'] if 'tauG' in tauFSG else numpy.ones((self.J,self.L))
+    def initialise(self,init_S='random',init_FG='random',tauFSG={},kmeans_seeds=None,kmeans_P=1):
+        self.tauF = tauFSG['tauF'] if 'tauF' in tauFSG else numpy.ones((self.I,self.K),dtype=self.dtype)
+        self.tauS = tauFSG['tauS'] if 'tauS' in tauFSG else numpy.ones((self.K,self.L),dtype=self.dtype)
+        self.tauG = tauFSG['tauG'] if 'tauG' in tauFSG else numpy.ones((self.J,self.L),dtype=self.dtype)
         
         assert init_S in ['exp','random'], "Unrecognised init option for S: %s." % init_S
         self.muS = 1./self.lambdaS
         if init_S == 'random':
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):  
-                self.muS[k,l] = exponential_draw(self.lambdaS[k,l])
+            self.muS[:] = exponential_draw(self.lambdaS,rng=self.rng)
         
-        assert init_FG in ['exp','random','kmeans'], "Unrecognised init option for F,G: %s." % init_FG
+        assert init_FG in ['exp','random','kmeans','kmeans++'], "Unrecognised init option for F,G: %s." % init_FG
         self.muF, self.muG = 1./self.lambdaF, 1./self.lambdaG
         if init_FG == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.muF[i,k] = exponential_draw(self.lambdaF[i,k])
-            for j,l in itertools.product(xrange(0,self.J),xrange(0,self.L)):
-                self.muG[j,l] = exponential_draw(self.lambdaG[j,l])
-        elif init_FG == 'kmeans':
+            self.muF[:] = exponential_draw(self.lambdaF,rng=self.rng)
+            self.muG[:] = exponential_draw(self.lambdaG,rng=self.rng)
+        elif init_FG in ['kmeans','kmeans++']:
+            seeds = kmeans_seeds if kmeans_seeds is not None else [self.seed]
+            if self.sparse:
+                M = numpy.zeros((self.I,self.J),dtype=bool)
+                M[self.omega_rows,self.omega_columns] = True
+            else:
+                M = self.M
             print "Initialising F using KMeans."
-            kmeans_F = KMeans(self.R,self.M,self.K)
-            kmeans_F.initialise()
-            kmeans_F.cluster()
-            self.muF = kmeans_F.clustering_results #+ 0.2            
+            kmeans_F = multistart_kmeans(self.R,M,self.K,seeds,init='random' if init_FG == 'kmeans' else 'kmeans++',P=kmeans_P)
+            self.muF = kmeans_F.clustering_results.astype(self.dtype) #+ 0.2            
             
             print "Initialising G using KMeans."
-            kmeans_G = KMeans(self.R.T,self.M.T,self.L)   
-            kmeans_G.initialise()
-            kmeans_G.cluster()
-            self.muG = kmeans_G.clustering_results #+ 0.2
+            kmeans_G = multistart_kmeans(self.R.T,M.T,self.L,seeds,init='random' if init_FG == 'kmeans' else 'kmeans++',P=kmeans_P)
+            self.muG = kmeans_G.clustering_results.astype(self.dtype) #+ 0.2
         
         # Initialise the expectations and variances
-        self.expF, self.varF = numpy.zeros((self.I,self.K)), numpy.zeros((self.I,self.K))
-        self.expS, self.varS = numpy.zeros((self.K,self.L)), numpy.zeros((self.K,self.L))
-        self.expG, self.varG = numpy.zeros((self.J,self.L)), numpy.zeros((self.J,self.L))
+        self.expF, self.varF = numpy.zeros((self.I,self.K),dtype=self.dtype), numpy.zeros((self.I,self.K),dtype=self.dtype)
+        self.expS, self.varS = numpy.zeros((self.K,self.L),dtype=self.dtype), numpy.zeros((self.K,self.L),dtype=self.dtype)
+        self.expG, self.varG = numpy.zeros((self.J,self.L),dtype=self.dtype), numpy.zeros((self.J,self.L),dtype=self.dtype)
+        if self.cache_residual:
+            self.exp_residual = numpy.copy(self.R_omega)
         
         for k in range(0,self.K):
             self.update_exp_F(k)
@@ -156,53 +233,148 @@ class bnmtf_vb_optimised:
         self.update_exp_tau()
 
 
-    # Run the Gibbs sampler
-    def run(self,iterations):
-        self.all_exp_tau = []  # to check for convergence 
-        self.all_times = [] # to plot performance against time    
+    # Warm start from a trained model with a different number of row or column 
+    # clusters. After initialise(), we copy over its variational parameters for 
+    # the first min(K,model.K) row and min(L,model.L) column clusters, keeping 
+    # the fresh initialisation for the others.
+    def warm_start(self,model):
+        assert (model.I,model.J) == (self.I,self.J), "Cannot warm start from a model of size (%s, %s) instead of (%s, %s)." % (model.I,model.J,self.I,self.J)
+        K, L = min(self.K,model.K), min(self.L,model.L)
+        self.muF[:,:K], self.tauF[:,:K] = model.muF[:,:K], model.tauF[:,:K]
+        self.muS[:K,:L], self.tauS[:K,:L] = model.muS[:K,:L], model.tauS[:K,:L]
+        self.muG[:,:L], self.tauG[:,:L] = model.muG[:,:L], model.tauG[:,:L]
+        for k in range(0,K):
+            self.update_exp_F(k)
+        for k,l in itertools.product(xrange(0,K),xrange(0,L)):
+            self.update_exp_S(k,l)
+        for l in range(0,L):
+            self.update_exp_G(l)
+        if self.cache_residual:
+            self.update_residual()
+        self.update_tau()
+        self.update_exp_tau()
         
+
+    # Save the state of the model - the variational parameters, the iteration, and
+    # the random states - to a compressed .npz file, or load it back in.
+    def save_state(self,filename):
+        save_model_state(self,filename,['muF','tauF','muS','tauS','muG','tauG','expF','varF','expS','varS','expG','varG',
+                                           'alpha_s','beta_s','exptau','explogtau','exp_residual'])
+        
+    def load_state(self,filename):
+        load_model_state(self,filename)
+        
+
+    # Run the Gibbs sampler. If checkpoint is given, we save the state to it every
+    # <checkpoint_every> iterations, and resume from it if it already exists.
+    def run(self,iterations,stop=None,tolerance=1e-6,monitor_every=1,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert stop in [None,'elbo','tau'], "Unknown stopping criterion: %s. Should be None, 'elbo', or 'tau'." % stop
+        assert monitor_every >= 1, "monitor_every should be at least 1, not %s." % monitor_every
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
         metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
-        
-        time_start = time.time()
-        for it in range(0,iterations): 
-            indices_kl = list(itertools.product(xrange(0,self.K),xrange(0,self.L)))
-            shuffle(indices_kl)
-            for k,l in indices_kl:
-            #for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
-                self.update_S(k,l)
-                self.update_exp_S(k,l)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+            if self.converged:
+                return
+        else:
+            self.all_exp_tau = []  # to check for convergence 
+            self.all_times = [] # to plot performance against time    
+            
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in metrics:
+                self.all_performances[metric] = []
+            self.all_elbo = []
+            self.all_monitored = [] # the iterations at which we computed the performances and ELBO
+            self.converged = False
+            self.iteration = 0
+        
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration,iterations): 
+                if self.cache_residual:
+                    self.update_residual()
+                
+                indices_kl = list(itertools.product(xrange(0,self.K),xrange(0,self.L)))
+                self.shuffle(indices_kl)
+                if self.block_S:
+                    self.update_S_block(indices_kl)
+                else:
+                    for k,l in indices_kl:
+                    #for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+                        self.update_S(k,l)
+                        self.update_exp_S(k,l)
                 
-            indices_k = list(range(0,self.K))
-            shuffle(indices_k)
-            for k in indices_k:
-            #for k in range(0,self.K):
-                self.update_F(k)
-                self.update_exp_F(k)
+                # varG does not change while we update F, nor varF while we update G, 
+                # so we compute their products with the mask once per sweep
+                indices_k = list(range(0,self.K))
+                self.shuffle(indices_k)
+                if self.sparse or self.cache_residual:
+                    self.M_varG = self.M_omega.dot(self.varG)
+                for k in indices_k:
+                #for k in range(0,self.K):
+                    self.update_F(k)
+                    self.update_exp_F(k)
+                self.M_varG = None
                
-            indices_l = list(range(0,self.L))
-            shuffle(indices_l)
-            for l in indices_l:
-            #for l in range(0,self.L):
-                self.update_G(l)
-                self.update_exp_G(l)
+                indices_l = list(range(0,self.L))
+                self.shuffle(indices_l)
+                if self.sparse or self.cache_residual:
+                    self.M_varF = self.M_omega.T.dot(self.varF)
+                for l in indices_l:
+                #for l in range(0,self.L):
+                    self.update_G(l)
+                    self.update_exp_G(l)
+                self.M_varF = None
                 
-            self.update_tau()
-            self.update_exp_tau()
-            self.all_exp_tau.append(self.exptau)
+                self.update_tau()
+                self.update_exp_tau()
+                self.all_exp_tau.append(self.exptau)
             
-            perf, elbo = self.predict(self.M), self.elbo()
+                # Check whether the expectation of tau has converged
+                if stop == 'tau' and it > 0:
+                    self.converged = abs(self.all_exp_tau[-1] - self.all_exp_tau[-2]) <= tolerance * abs(self.all_exp_tau[-2])
             
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
+                # Compute the performances and ELBO every <monitor_every> iterations, at the 
+                # last iteration, or if we have converged, and check whether the ELBO has converged
+                if (it+1) % monitor_every == 0 or it+1 == iterations or self.converged:
+                    perf, elbo = self.predict_training(), self.elbo()
+                    for metric in metrics:
+                        self.all_performances[metric].append(perf[metric])
+                    self.all_elbo.append(elbo)
+                    self.all_monitored.append(it+1)
+                
+                    print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
                 
-            print "Iteration %s. ELBO: %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,elbo,perf['MSE'],perf['R^2'],perf['Rp'])
-                        
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                    if stop == 'elbo' and len(self.all_elbo) > 1:
+                        self.converged = abs(self.all_elbo[-1] - self.all_elbo[-2]) <= tolerance * abs(self.all_elbo[-2])
+                    
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)   
+            
+                self.iteration = it+1
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
             
+                if self.converged:
+                    print "Converged after %s iterations." % (it+1)
+                    break
+        finally:
+            self.M_varG, self.M_varF = None, None
+            if profiler is not None:
+                profiler.detach(self)
+            
+        
+    # Shuffle the order of the updates, using our own random state if we were given a seed
+    def shuffle(self,indices):
+        if self.seed is None:
+            shuffle(indices)
+        else:
+            self.rng.shuffle(indices)
+        
         
     # Compute the ELBO
     def elbo(self):
@@ -237,12 +409,16 @@ class bnmtf_vb_optimised:
         self.beta_s = self.beta + 0.5*self.exp_square_diff()
         
     def exp_square_diff(self): # Compute: sum_Omega E_q(F,S,G) [ ( Rij - Fi S Gj )^2 ]
+        if self.sparse or self.cache_residual:
+            return self.exp_square_diff_omega()
         return (self.M*( self.R - self.triple_dot(self.expF,self.expS,self.expG.T) )**2).sum() + \
                (self.M*( self.triple_dot(self.varF+self.expF**2, self.varS+self.expS**2, (self.varG+self.expG**2).T ) - self.triple_dot(self.expF**2,self.expS**2,(self.expG**2).T) )).sum() + \
                (self.M*( numpy.dot(self.varF, ( numpy.dot(self.expS,self.expG.T)**2 - numpy.dot(self.expS**2,self.expG.T**2) ) ) )).sum() + \
                (self.M*( numpy.dot( numpy.dot(self.expF,self.expS)**2 - numpy.dot(self.expF**2,self.expS**2), self.varG.T ) )).sum()
     
     def update_F(self,k):  
+        if self.sparse or self.cache_residual:
+            return self.update_F_omega(k)
         varSkG = numpy.dot( self.varS[k]+self.expS[k]**2 , (self.varG+self.expG**2).T ) - numpy.dot( self.expS[k]**2 , (self.expG**2).T ) # Vector of size J
         self.tauF[:,k] = self.exptau * numpy.dot( varSkG + ( numpy.dot(self.expS[k],self.expG.T) )**2 , self.M.T ) 
         
@@ -255,6 +431,8 @@ class bnmtf_vb_optimised:
         ) 
         
     def update_S(self,k,l):       
+        if self.sparse or self.cache_residual:
+            return self.update_S_omega(k,l)
         self.tauS[k,l] = self.exptau*(self.M*( numpy.outer( self.varF[:,k]+self.expF[:,k]**2 , self.varG[:,l]+self.expG[:,l]**2 ) )).sum()
         
         diff_term = (self.M * ( (self.R-self.triple_dot(self.expF,self.expS,self.expG.T)+self.expS[k,l]*numpy.outer(self.expF[:,k],self.expG[:,l]) ) * numpy.outer(self.expF[:,k],self.expG[:,l]) )).sum()
@@ -268,6 +446,8 @@ class bnmtf_vb_optimised:
         ) 
         
     def update_G(self,l):  
+        if self.sparse or self.cache_residual:
+            return self.update_G_omega(l)
         varFSl = numpy.dot( self.varF+self.expF**2 , self.varS[:,l]+self.expS[:,l]**2 ) - numpy.dot( self.expF**2 , self.expS[:,l]**2 ) # Vector of size I
         self.tauG[:,l] = self.exptau * numpy.dot( ( varFSl + ( numpy.dot(self.expF,self.expS[:,l]) )**2 ).T, self.M) #sum over i, so columns        
         
@@ -279,18 +459,154 @@ class bnmtf_vb_optimised:
             - self.exptau * cov_term
         )
 
+        
+    # Versions of the updates that only use the values in Omega, through products
+    # with the mask M (a sparse matrix if self.sparse) and the residual values.
+    # These are used if self.sparse, or if we keep a cache of the residual.
+    def omega_dot(self,A,B): # Values of dot(A,B.T) in Omega
+        if self.sparse:
+            return (A[self.omega_rows]*B[self.omega_columns]).sum(axis=1)
+        return self.M * numpy.dot(A,B.T)
+        
+    def omega_outer(self,a,b): # Values of outer(a,b) in Omega
+        if self.sparse:
+            return a[self.omega_rows]*b[self.omega_columns]
+        return self.M * numpy.outer(a,b)
+        
+    def omega_values_dot(self,E,x): # Compute dot(E,x), where E are values in Omega
+        if self.sparse:
+            return numpy.bincount(self.omega_rows,weights=E*x[self.omega_columns],minlength=self.I)
+        return numpy.dot(E,x)
+        
+    def omega_values_T_dot(self,E,y): # Compute dot(E.T,y), where E are values in Omega
+        if self.sparse:
+            return numpy.bincount(self.omega_columns,weights=E*y[self.omega_rows],minlength=self.J)
+        return numpy.dot(E.T,y)
+        
+    def omega_matrix(self,E): # Return the values E in Omega as a matrix (sparse if self.sparse)
+        if self.sparse:
+            return csr_matrix((E,(self.omega_rows,self.omega_columns)),shape=(self.I,self.J))
+        return E
+        
+    def omega_residual(self): # Values of R - expF*expS*expG.T in Omega
+        if self.cache_residual:
+            return self.exp_residual
+        return self.R_omega - self.omega_dot(numpy.dot(self.expF,self.expS),self.expG)
+        
+    def exp_square_diff_omega(self):
+        FS, SG = numpy.dot(self.expF,self.expS), numpy.dot(self.expS,self.expG.T)
+        return ( self.omega_residual()**2 ).sum() + \
+               ( numpy.dot(self.varF+self.expF**2, self.varS+self.expS**2) * self.M_omega.dot(self.varG+self.expG**2) ).sum() - \
+               ( numpy.dot(self.expF**2,self.expS**2) * self.M_omega.dot(self.expG**2) ).sum() + \
+               ( self.varF * self.M_omega.dot( ( SG**2 - numpy.dot(self.expS**2,self.expG.T**2) ).T ) ).sum() + \
+               ( ( FS**2 - numpy.dot(self.expF**2,self.expS**2) ) * self.M_omega.dot(self.varG) ).sum()
+               
+    # Outside of a sweep in run(), we compute M_omega.dot(varG) or M_omega.T.dot(varF) here
+    def update_F_omega(self,k):
+        FS, SkG = numpy.dot(self.expF,self.expS), numpy.dot(self.expS[k],self.expG.T)
+        M_varG = self.M_varG if self.M_varG is not None else self.M_omega.dot(self.varG)
+        varSkG = numpy.dot( self.varS[k]+self.expS[k]**2 , (self.varG+self.expG**2).T ) - numpy.dot( self.expS[k]**2 , (self.expG**2).T ) # Vector of size J
+        self.tauF[:,k] = self.exptau * self.M_omega.dot( varSkG + SkG**2 )
+        
+        diff_term = self.omega_values_dot(self.omega_residual(),SkG) + self.expF[:,k] * self.M_omega.dot(SkG**2)
+        cov_term = ( self.expS[k]*FS * M_varG ).sum(axis=1) - self.expF[:,k] * numpy.dot( M_varG, self.expS[k]**2 )
+        self.muF[:,k] = 1./self.tauF[:,k] * (
+            - self.lambdaF[:,k]
+            + self.exptau * diff_term
+            - self.exptau * cov_term
+        ) 
+        
+    def update_S_omega(self,k,l):
+        Fk, Gl = self.expF[:,k], self.expG[:,l]
+        self.tauS[k,l] = self.exptau * numpy.dot( self.varF[:,k]+Fk**2, self.M_omega.dot(self.varG[:,l]+Gl**2) )
+        
+        diff_term = numpy.dot( Fk, self.omega_values_dot(self.omega_residual(),Gl) ) + self.expS[k,l] * numpy.dot( Fk**2, self.M_omega.dot(Gl**2) )
+        cov_term_G = numpy.dot( Fk * ( numpy.dot(self.expF,self.expS[:,l]) - Fk*self.expS[k,l] ), self.M_omega.dot(self.varG[:,l]) )
+        cov_term_F = numpy.dot( self.varF[:,k], self.M_omega.dot( Gl * ( numpy.dot(self.expS[k],self.expG.T) - self.expS[k,l]*Gl ) ) )
+        self.muS[k,l] = 1./self.tauS[k,l] * (
+            - self.lambdaS[k,l] 
+            + self.exptau * diff_term
+            - self.exptau * cov_term_G
+            - self.exptau * cov_term_F
+        ) 
+        
+    def update_G_omega(self,l):
+        FSl = numpy.dot(self.expF,self.expS[:,l])
+        M_varF = self.M_varF if self.M_varF is not None else self.M_omega.T.dot(self.varF)
+        varFSl = numpy.dot( self.varF+self.expF**2 , self.varS[:,l]+self.expS[:,l]**2 ) - numpy.dot( self.expF**2 , self.expS[:,l]**2 ) # Vector of size I
+        self.tauG[:,l] = self.exptau * self.M_omega.T.dot( varFSl + FSl**2 )
+        
+        diff_term = self.omega_values_T_dot(self.omega_residual(),FSl) + self.expG[:,l] * self.M_omega.T.dot(FSl**2)
+        cov_term = ( M_varF * self.expS[:,l]*numpy.dot(self.expG,self.expS.T) ).sum(axis=1) - self.expG[:,l] * numpy.dot( M_varF, self.expS[:,l]**2 )
+        self.muG[:,l] = 1./self.tauG[:,l] * (
+            - self.lambdaG[:,l] 
+            + self.exptau * diff_term
+            - self.exptau * cov_term
+        )
+        
+    # Update all entries of S (and their expectations and variances), in the order
+    # given by indices_kl. F and G stay the same, so we first compute:
+    # - tauS[k,l] = exptau * sum_ij M_ij (varF_ik+F_ik^2) (varG_jl+G_jl^2)
+    # - B[k,l] = sum_ij M_ij R_ij F_ik G_jl
+    # - C[k,l,k',l'] = sum_ij M_ij F_ik F_ik' G_jl G_jl'
+    # - D[k,k',l] = sum_ij M_ij F_ik F_ik' varG_jl
+    # - E[k,l,l'] = sum_ij M_ij varF_ik G_jl G_jl'
+    # and then each update of muS[k,l] only needs the current values of S.
+    def update_S_block(self,indices_kl):
+        omega = self.sparse or self.cache_residual
+        M = self.M_omega if omega else self.M
+        MR = self.omega_matrix(self.R_omega) if omega else self.M * self.R
+        (I,J,K,L) = (self.I,self.J,self.K,self.L)
+        
+        FF = (self.expF[:,:,None]*self.expF[:,None,:]).reshape(I,K*K)
+        GG = (self.expG[:,:,None]*self.expG[:,None,:]).reshape(J,L*L)
+        tauS = self.exptau * numpy.dot( (self.varF+self.expF**2).T, M.dot(self.varG+self.expG**2) )
+        B = numpy.dot( self.expF.T, MR.dot(self.expG) )
+        C = numpy.dot( FF.T, M.dot(GG) ).reshape(K,K,L,L).transpose(0,2,1,3)
+        D = numpy.dot( FF.T, M.dot(self.varG) ).reshape(K,K,L)
+        E = numpy.dot( M.T.dot(self.varF).T, GG ).reshape(K,L,L)
+        
+        for k,l in indices_kl:
+            S, Skl = self.expS, self.expS[k,l]
+            self.tauS[k,l] = tauS[k,l]
+            diff_term = B[k,l] - (C[k,l]*S).sum() + Skl*C[k,l,k,l]
+            cov_term_G = numpy.dot(D[k,:,l],S[:,l]) - Skl*D[k,k,l]
+            cov_term_F = numpy.dot(E[k,l],S[k]) - Skl*E[k,l,l]
+            self.muS[k,l] = 1./self.tauS[k,l] * (
+                - self.lambdaS[k,l] 
+                + self.exptau * diff_term
+                - self.exptau * cov_term_G
+                - self.exptau * cov_term_F
+            ) 
+            (self.expS[k,l],self.varS[k,l]) = TN_moments(self.muS[k,l],self.tauS[k,l])
+        
+        if self.cache_residual:
+            self.update_residual()
+            
+    # Recompute the cached residual from scratch, so that the incremental updates do not drift
+    def update_residual(self):
+        self.exp_residual = self.R_omega - self.omega_dot(numpy.dot(self.expF,self.expS),self.expG)
+        
+
     # Update the expectations and variances
+    # If we cache the residual, we also subtract the change in expF*expS*expG.T
     def update_exp_F(self,k):
-        self.expF[:,k] = TN_vector_expectation(self.muF[:,k],self.tauF[:,k])
-        self.varF[:,k] = TN_vector_variance(self.muF[:,k],self.tauF[:,k])
+        old_expF_k = numpy.copy(self.expF[:,k])
+        TN_vector_moments(self.muF[:,k],self.tauF[:,k],out_exp=self.expF[:,k],out_var=self.varF[:,k])
+        if self.cache_residual:
+            self.exp_residual -= self.omega_outer(self.expF[:,k]-old_expF_k,numpy.dot(self.expS[k],self.expG.T))
         
     def update_exp_S(self,k,l):
-        self.expS[k,l] = TN_expectation(self.muS[k,l],self.tauS[k,l])
-        self.varS[k,l] = TN_variance(self.muS[k,l],self.tauS[k,l])
+        old_expS_kl = self.expS[k,l]
+        (self.expS[k,l],self.varS[k,l]) = TN_moments(self.muS[k,l],self.tauS[k,l])
+        if self.cache_residual:
+            self.exp_residual -= (self.expS[k,l]-old_expS_kl) * self.omega_outer(self.expF[:,k],self.expG[:,l])
         
     def update_exp_G(self,l):
-        self.expG[:,l] = TN_vector_expectation(self.muG[:,l],self.tauG[:,l])
-        self.varG[:,l] = TN_vector_variance(self.muG[:,l],self.tauG[:,l])
+        old_expG_l = numpy.copy(self.expG[:,l])
+        TN_vector_moments(self.muG[:,l],self.tauG[:,l],out_exp=self.expG[:,l],out_var=self.varG[:,l])
+        if self.cache_residual:
+            self.exp_residual -= self.omega_outer(numpy.dot(self.expF,self.expS[:,l]),self.expG[:,l]-old_expG_l)
         
     def update_exp_tau(self):
         self.exptau = gamma_expectation(self.alpha_s,self.beta_s)
@@ -299,12 +615,30 @@ class bnmtf_vb_optimised:
 
     # Compute the expectation of U and V, and use it to predict missing values
     def predict(self,M_pred):
+        if self.sparse:
+            (rows,columns) = numpy.nonzero(M_pred)
+            return self.predict_omega(rows,columns,numpy.asarray(self.R[rows,columns],dtype=self.dtype))
         R_pred = self.triple_dot(self.expF,self.expS,self.expG.T)
         MSE = self.compute_MSE(M_pred,self.R,R_pred)
         R2 = self.compute_R2(M_pred,self.R,R_pred)    
         Rp = self.compute_Rp(M_pred,self.R,R_pred)        
         return {'MSE':MSE,'R^2':R2,'Rp':Rp}
         
+    # The performances on the training data. If sparse, we read the observed values from R_omega
+    def predict_training(self):
+        if self.sparse:
+            return self.predict_omega(self.omega_rows,self.omega_columns,self.R_omega)
+        return self.predict(self.M)
+        
+    # Only compute the predictions for the entries (rows,columns), with true values R_true, and evaluate them as vectors
+    def predict_omega(self,rows,columns,R_true):
+        R_pred = (numpy.dot(self.expF,self.expS)[rows]*self.expG[columns]).sum(axis=1)
+        M = numpy.ones(len(rows))
+        MSE = self.compute_MSE(M,R_true,R_pred)
+        R2 = self.compute_R2(M,R_true,R_pred)    
+        Rp = self.compute_Rp(M,R_true,R_pred)        
+        return {'MSE':MSE,'R^2':R2,'Rp':Rp}
+        
         
     # Functions for computing MSE, R^2 (coefficient of determination), Rp (Pearson correlation)
     def compute_MSE(self,M,R,R_pred):
@@ -338,6 +672,8 @@ class bnmtf_vb_optimised:
             # -2*loglikelihood + 2*no. free parameters
             return - 2 * log_likelihood + 2 * (self.I*self.K+self.K*self.L+self.J*self.L)
         elif metric == 'MSE':
+            if self.sparse:
+                return self.predict_training()['MSE']
             R_pred = self.triple_dot(self.expF,self.expS,self.expG.T)
             return self.compute_MSE(self.M,self.R,R_pred)
         elif metric == 'ELBO':
@@ -345,5 +681,8 @@ class bnmtf_vb_optimised:
         
     def log_likelihood(self):
         # Return the likelihood of the data given the trained model's parameters
+        if self.sparse:
+            return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
+                 - self.exptau / 2. * ( ( self.R_omega - self.omega_dot(numpy.dot(self.expF,self.expS),self.expG) )**2 ).sum()
         return self.size_Omega / 2. * ( self.explogtau - math.log(2*math.pi) ) \
              - self.exptau / 2. * (self.M*( self.R - self.triple_dot(self.expF,self.expS,self.expG.T) )**2).sum()
\ No newline at end of file
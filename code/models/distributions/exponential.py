@@ -1,12 +1,13 @@
 """
 Class representing an exponential distribution, allowing us to sample from it.
 """
-from numpy.random import exponential
+import numpy
 
-# Exponential draws
-def exponential_draw(lambdax):
+# Exponential draws. lambdax can also be an array, giving an array of draws,
+# and rng a numpy RandomState (default the global one).
+def exponential_draw(lambdax,size=None,rng=numpy.random):
     scale = 1.0 / lambdax
-    return exponential(scale=scale,size=None)
+    return rng.exponential(scale=scale,size=size)
         
 '''
 # Do 1000 draws and plot them
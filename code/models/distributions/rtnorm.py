@@ -11,7 +11,8 @@ Created on Mon Aug 12 13:48:22 2013
 """
 from scipy.special import erf
 from numpy.random import uniform as rand, normal as randn, randint as randi
-from numpy import sqrt, pi, exp, log, floor, array
+from numpy import sqrt, pi, exp, log, floor, array, asarray, empty, zeros, ones, arange, \
+    flatnonzero, concatenate, minimum, where, full, nan
 
 def rtnorm(a, b, mu=0., sigma=1., size=1, probabilities=False):
     r"""
@@ -218,6 +219,137 @@ def rtstdnorm(a, b):
     return r
 
 
+def rtnorm_vector(a, mu, sigma):
+    r"""
+    Vectorised version of rtnorm(a, inf, mu, sigma), drawing one value for each
+    (mu, sigma) pair from a normal distribution truncated to [a, inf).
+    """
+    mu = asarray(mu, dtype=float)
+    sigma = asarray(sigma, dtype=float)
+    return rtstdnorm_vector((a-mu) / sigma) * sigma + mu
+
+
+def rtstdnorm_vector(a):
+    r"""
+    Vectorised version of rtstdnorm(a, inf) for an array of lower bounds a.
+    We split the entries over the three regimes of rtstdnorm (left tail, right 
+    tail, and Chopin's algorithm), and use a vectorised rejection sampler for 
+    each: in every round we make one proposal for each entry that has not been 
+    accepted yet.
+    
+    Note that the tables use 0-based indices: x has 4002 values, giving 4001
+    rectangles (k = 0..4000), and k = 4001 is the right tail beyond xmax. 
+    rtstdnorm uses N = 4000 for the tail (the Matlab value), so it never draws 
+    from the rightmost rectangle [x[4000], x[4001]]; here we do. Also, once the
+    right tail is chosen we draw from it until a value is accepted, rather than 
+    choosing a new region after a rejection, which under-weights the tail.
+    """
+    # Left and right limits
+    xmin = -2.00443204036
+    xmax = 3.48672170399
+    
+    # Design variables for Chopin's algorithm
+    kmin = 5                        
+    INVH = 1631.73284006            
+    I0 = 3271                       
+    N = 4001                        # Index of the right tail
+    
+    a = asarray(a, dtype=float)
+    r = full(a.shape, nan)          # NaN values of a are not drawn
+    flat_a, flat_r = a.ravel(), r.ravel()
+    
+    left = flatnonzero(flat_a < xmin)
+    right = flatnonzero(flat_a > xmax)
+    middle = flatnonzero((flat_a >= xmin) & (flat_a <= xmax))
+    
+    # If |kb-ka| is small (b = inf so kb = N), rtstdnorm uses the exponential proposal
+    ka = ncell[(I0 + floor(flat_a[middle]*INVH)).astype(int)]
+    exponential = concatenate((right, middle[N-ka < kmin]))
+    chopin, ka = middle[N-ka >= kmin], ka[N-ka >= kmin]
+    
+    flat_r[left] = rtstdnorm_vector_left(flat_a[left])
+    flat_r[exponential] = rtstdnorm_vector_right(flat_a[exponential])
+    flat_r[chopin] = rtstdnorm_vector_chopin(flat_a[chopin], ka)
+    return r
+    
+    
+def rtstdnorm_vector_left(a):
+    # Rejection algorithm with a Gaussian proposal
+    r = empty(a.shape)
+    pending = arange(len(a))
+    while len(pending) > 0:
+        sim = randn(size=len(pending))
+        accept = sim >= a[pending]
+        r[pending[accept]] = sim[accept]
+        pending = pending[~accept]
+    return r
+    
+    
+def rtstdnorm_vector_right(a):
+    # Rejection algorithm with an exponential proposal (b = inf, so expab = -1)
+    r = empty(a.shape)
+    pending = arange(len(a))
+    while len(pending) > 0:
+        ap = a[pending]
+        z = log(1 - rand(low=1E-15, size=len(pending)))
+        e = -log(rand(low=1E-15, size=len(pending)))
+        accept = 2*ap**2*e > z**2
+        r[pending[accept]] = (ap - z/ap)[accept]
+        pending = pending[~accept]
+    return r
+    
+    
+def rtstdnorm_vector_chopin(a, ka):
+    # Chopin's algorithm with b = inf, so kb = N
+    ALPHA = 1.837877066409345       
+    N = 4001                        # Index of the right tail
+    yl0 = 0.053513975472            # y_l of the leftmost rectangle
+    ylN = 0.000914116389555         # y_l of the rightmost rectangle
+    
+    r = empty(a.shape)
+    pending = arange(len(a))
+    while len(pending) > 0:
+        n = len(pending)
+        ap, kap = a[pending], ka[pending]
+        k = minimum(kap + floor(rand(size=n)*(N+1-kap)).astype(int), N)
+        u1, u2 = rand(size=n), rand(size=n)
+        accept, sim = zeros(n, dtype=bool), empty(n)
+        
+        # Right tail - draw until accepted, so the tail has the same weight as each rectangle
+        tail = k == N
+        accept[tail] = True
+        sim[tail] = rtstdnorm_vector_right(x[-1] * ones(tail.sum()))
+        
+        # Compute y_l from y_k for the other regions (the mode is at x[1954] = 0)
+        kc = minimum(k, N-1)
+        ylk = where(kc <= 1953, yu[kc-1], yu[minimum(kc+1, N-1)])
+        ylk = where(kc == 0, yl0, where(kc == N-1, ylN, ylk))
+        
+        # Two leftmost regions
+        edge = ~tail & (k <= kap+2)
+        ke = kc[edge]
+        sim_edge = x[ke] + (x[ke+1]-x[ke]) * u1[edge]
+        simy = yu[ke] * u2[edge]
+        ylk_edge = ylk[edge]
+        accept[edge] = (sim_edge >= ap[edge]) & ((simy < ylk_edge) | (sim_edge**2 + 2*log(simy) + ALPHA < 0))
+        sim[edge] = sim_edge
+        
+        # All the other boxes
+        box = ~tail & ~edge
+        kb = kc[box]
+        simy = yu[kb] * u1[box]
+        d = x[kb+1] - x[kb]
+        ylk_box = ylk[box]
+        quick = simy < ylk_box
+        sim_box = where(quick, x[kb] + u1[box]*d*yu[kb]/ylk_box, x[kb] + d*u2[box])
+        accept[box] = quick | (sim_box**2 + 2*log(simy) + ALPHA < 0)
+        sim[box] = sim_box
+        
+        r[pending[accept]] = sim[accept]
+        pending = pending[~accept]
+    return r
+
+
         # Tables
 x = array([
     -2.00443204036, -1.99990455547, -1.99541747213, -1.99096998962, \
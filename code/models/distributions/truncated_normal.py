@@ -32,6 +32,7 @@ from scipy.stats import truncnorm, norm
 from scipy.special import erfc
 import rtnorm
 
+SQRT_2PI = numpy.sqrt(2*numpy.pi)
 
 # TN draws     
 def TN_draw(mu,tau):
@@ -43,6 +44,19 @@ def TN_draw(mu,tau):
     #d = truncnorm(a, b, loc=mu, scale=sigma).rvs(1)[0]
     return d if (d >= 0. and d != numpy.inf and d != -numpy.inf and not numpy.isnan(d)) else 0.
               
+# TN expectation and variance, computing lambdax once for both
+def TN_moments(mu,tau):
+    sigma = numpy.float64(1.0) / math.sqrt(tau)
+    if mu < -30 * sigma:
+        exp = 1./(abs(mu)*tau)
+        var = exp**2
+    else:
+        x = - mu / sigma
+        lambdax = TN_lambdax(x)
+        exp = mu + sigma * lambdax
+        var = sigma**2 * ( 1 - lambdax*(lambdax-x) )
+    return (TN_clean(exp), TN_clean(var))
+    
 # TN expectation        
 def TN_expectation(mu,tau):
     sigma = numpy.float64(1.0) / math.sqrt(tau)
@@ -50,9 +64,9 @@ def TN_expectation(mu,tau):
         exp = 1./(abs(mu)*tau)
     else:
         x = - mu / sigma
-        lambdax = norm.pdf(x)/(0.5*erfc(x/math.sqrt(2)))
+        lambdax = TN_lambdax(x)
         exp = mu + sigma * lambdax
-    return exp if (exp >= 0.0 and exp != numpy.inf and exp != -numpy.inf and not numpy.isnan(exp)) else 0.
+    return TN_clean(exp)
        
 # TN variance
 def TN_variance(mu,tau):
@@ -61,10 +75,19 @@ def TN_variance(mu,tau):
         var = (1./(abs(mu)*tau))**2
     else:
         x = - mu / sigma
-        lambdax = norm.pdf(x)/(0.5*erfc(x/math.sqrt(2)))
+        lambdax = TN_lambdax(x)
         deltax = lambdax*(lambdax-x)
         var = sigma**2 * ( 1 - deltax )
-    return var if (var >= 0.0 and var != numpy.inf and var != -numpy.inf and not numpy.isnan(var)) else 0.       
+    return TN_clean(var)
+    
+# Compute lambdax = pdf(x) / (1 - cdf(x)), with the pdf computed in the same way
+# as scipy.stats.norm.pdf, but without its overhead for single values
+def TN_lambdax(x):
+    return math.exp(-x**2/2.0) / SQRT_2PI / (0.5*erfc(x/math.sqrt(2)))
+    
+# Return 0 for negative, infinite, and NaN values
+def TN_clean(v):
+    return v if (v >= 0.0 and v != numpy.inf and v != -numpy.inf and not numpy.isnan(v)) else 0.
        
 # TN mode
 def TN_mode(mu):
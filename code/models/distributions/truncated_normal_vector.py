@@ -10,6 +10,7 @@ truncnorm: a, b = (myclip_a - my_mean) / my_std, (myclip_b - my_mean) / my_std
            
 We get efficient draws using the library rtnorm by C. Lassner, from:
     http://miv.u-strasbg.fr/mazet/rtnorm/
+using a vectorised version of its algorithm, to draw all values at once.
 We compute the expectation and variance ourselves - note that we use the
 complementary error function for 1-cdf(x) = 0.5*erfc(x/sqrt(2)), as for large
 x (>8), cdf(x)=1., so we get 0. instead of something like n*e^-n.
@@ -32,45 +33,70 @@ from scipy.stats import truncnorm, norm
 from scipy.special import erfc
 import rtnorm
 
+SQRT_2PI = numpy.sqrt(2*numpy.pi)
 
-# TN draws
+# TN draws - we draw all values at once, and return 0 if tau = 0 or the draw is invalid
 def TN_vector_draw(mus,taus):
-    sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
-    draws = []
-    for (mu,sigma,tau) in zip(mus,sigmas,taus):
-        if tau == 0.:
-            draws.append(0)
-        else:
-            d = rtnorm.rtnorm(a=0., b=numpy.inf, mu=mu, sigma=sigma)[0]
-            d = d if (d >= 0. and d != numpy.inf and d != -numpy.inf and not numpy.isnan(d)) else 0.
-            draws.append(d)   
-    '''
-    draws = parallel_draw(self.mu,self.sigma,self.tau)
-    '''     
+    mus, taus = numpy.array(mus,dtype=float), numpy.array(taus,dtype=float)
+    draws = numpy.zeros(mus.shape)
+    nonzero = taus > 0.
+    sigmas = numpy.float64(1.0) / numpy.sqrt(taus[nonzero])
+    draws[nonzero] = rtnorm.rtnorm_vector(a=0., mu=mus[nonzero], sigma=sigmas)
+    draws[~(draws >= 0.) | numpy.isinf(draws)] = 0.
     return draws           
        
+# TN expectation and variance, computing lambdax = pdf(x) / (1 - cdf(x)) once for
+# both. We write the values into the arrays out_exp and out_var, if given.
+def TN_vector_moments(mus,taus,out_exp=None,out_var=None):
+    mus, taus = numpy.asarray(mus,dtype=float), numpy.asarray(taus,dtype=float)
+    sigmas, x, lambdax, exponential = TN_vector_lambdax(mus,taus)
+    return (TN_vector_expectation_lambdax(mus,taus,sigmas,lambdax,exponential,out_exp),
+            TN_vector_variance_lambdax(mus,taus,sigmas,x,lambdax,exponential,out_var))
+
 # TN expectation    
-def TN_vector_expectation(mus,taus):
+def TN_vector_expectation(mus,taus,out=None):
+    mus, taus = numpy.asarray(mus,dtype=float), numpy.asarray(taus,dtype=float)
+    sigmas, x, lambdax, exponential = TN_vector_lambdax(mus,taus)
+    return TN_vector_expectation_lambdax(mus,taus,sigmas,lambdax,exponential,out)
+    
+# TN variance
+def TN_vector_variance(mus,taus,out=None):
+    mus, taus = numpy.asarray(mus,dtype=float), numpy.asarray(taus,dtype=float)
+    sigmas, x, lambdax, exponential = TN_vector_lambdax(mus,taus)
+    return TN_vector_variance_lambdax(mus,taus,sigmas,x,lambdax,exponential,out)
+    
+# Compute sigma, x = -mu/sigma, lambdax, and a mask of the values where mu < -30*sigma.
+# We compute the pdf in the same way as scipy.stats.norm.pdf, without its overhead.
+def TN_vector_lambdax(mus,taus):
     sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
-    x = - numpy.float64(mus) / sigmas
-    lambdax = norm.pdf(x)/(0.5*erfc(x/math.sqrt(2)))
-    exp = mus + sigmas * lambdax
+    x = - mus / sigmas
+    lambdax = numpy.exp(-x**2/2.0) / SQRT_2PI
+    lambdax /= 0.5*erfc(x/math.sqrt(2))
+    exponential = mus < -30 * sigmas
+    return (sigmas, x, lambdax, exponential)
+    
+def TN_vector_expectation_lambdax(mus,taus,sigmas,lambdax,exponential,out=None):
+    exp = numpy.multiply(sigmas, lambdax, out=out)
+    exp += mus
     
     # Exp expectation - overwrite value if mu < -30*sigma
-    exp = [1./(numpy.abs(mu)*tau) if mu < -30 * sigma else v for v,mu,tau,sigma in zip(exp,mus,taus,sigmas)]
-    return [v if (v >= 0.0 and v != numpy.inf and v != -numpy.inf and not numpy.isnan(v)) else 0. for v in exp]
+    exp[exponential] = 1./(numpy.abs(mus[exponential])*taus[exponential])
+    return TN_vector_clean(exp)
     
-# TN variance
-def TN_vector_variance(mus,taus):
-    sigmas = numpy.float64(1.0) / numpy.sqrt(taus)
-    x = - numpy.float64(mus) / sigmas
-    lambdax = norm.pdf(x)/(0.5*erfc(x/math.sqrt(2)))
-    deltax = lambdax*(lambdax-x)
-    var = sigmas**2 * ( 1 - deltax )
+def TN_vector_variance_lambdax(mus,taus,sigmas,x,lambdax,exponential,out=None):
+    var = numpy.subtract(lambdax, x, out=out)
+    var *= lambdax
+    numpy.subtract(1, var, out=var)
+    var *= sigmas**2
     
     # Exp variance - overwrite value if mu < -30*sigma
-    var = [(1./(numpy.abs(mu)*tau))**2 if mu < -30 * sigma else v for v,mu,tau,sigma in zip(var,mus,taus,sigmas)]
-    return [v if (v >= 0.0 and v != numpy.inf and v != -numpy.inf and not numpy.isnan(v)) else 0. for v in var]      
+    var[exponential] = (1./(numpy.abs(mus[exponential])*taus[exponential]))**2
+    return TN_vector_clean(var)
+    
+# Set negative, infinite, and NaN values to 0, in place
+def TN_vector_clean(values):
+    values[~(values >= 0.) | numpy.isinf(values)] = 0.
+    return values
        
 # TN mode
 def TN_vector_mode(mus):
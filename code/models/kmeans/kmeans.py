@@ -1,206 +1,259 @@
+from multiprocessing import Pool
 import numpy, random, time
 
 max_iterations = 200 # safeguard - if it takes more than this many iterations, stop
 
+
+# Run the clustering for one seed, so that we can run several seeds in parallel.
+# Returns the KMeans object after clustering.
+def run_kmeans(params):
+    (X,M,K,resolve_empty,seed,init) = \
+        (params['X'],params['M'],params['K'],params['resolve_empty'],params['seed'],params['init'])
+    kmeans = KMeans(X,M,K,resolve_empty)
+    kmeans.initialise(seed=seed,init=init)
+    kmeans.cluster()
+    return kmeans
+
+
+# Run the clustering once for each of the seeds, using P parallel processes, and
+# return the KMeans object with the lowest distortion (the first one if tied).
+def multistart_kmeans(X,M,K,seeds,init='kmeans++',resolve_empty='singleton',P=1):
+    assert len(seeds) > 0, "Need at least one seed."
+    all_parameters = [
+        {
+            'X' : X,
+            'M' : M,
+            'K' : K,
+            'resolve_empty' : resolve_empty,
+            'seed' : seed,
+            'init' : init
+        }
+        for seed in seeds
+    ]
+    if P > 1:
+        pool = Pool(P)
+        try:
+            all_kmeans = pool.map(run_kmeans,all_parameters)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+    else:
+        all_kmeans = [run_kmeans(params) for params in all_parameters]
+    distortions = [kmeans.distortion() for kmeans in all_kmeans]
+    return all_kmeans[distortions.index(min(distortions))]
+
+
 # Cluster the rows of the dataset X, with missing values indicated by M.
+# We do the assignment and update steps for all points and clusters at once,
+# using matrix operations with the masks.
 class KMeans:
     def __init__(self,X,M,K,resolve_empty='singleton'):
-        self.X = numpy.copy(X)
-        self.M = numpy.copy(M)
+        X = numpy.asarray(X)
+        observed = numpy.asarray(M,dtype=bool)
         self.K = K
         self.resolve_empty = resolve_empty
-        
-        assert len(self.X.shape) == 2, "Input matrix X is not a two-dimensional array, but instead %s-dimensional." % len(self.X.shape)
-        assert self.X.shape == self.M.shape, "Input matrix X is not of the same size as the indicator matrix M: %s and %s respectively." % (self.X.shape,self.M.shape)
+
+        assert len(X.shape) == 2, "Input matrix X is not a two-dimensional array, but instead %s-dimensional." % len(X.shape)
+        assert X.shape == observed.shape, "Input matrix X is not of the same size as the indicator matrix M: %s and %s respectively." % (X.shape,observed.shape)
         assert self.K > 0, "K should be greater than 0."
-        
-        (self.no_points,self.no_coordinates) = self.X.shape
-        self.no_unique_points = len(set([tuple(l) for l in self.X.tolist()]))    
-        
+
+        (self.no_points,self.no_coordinates) = X.shape
+        self.no_unique_points = len(set([tuple(l) for l in X.tolist()]))
+
         if self.no_points < self.K: print "Want %s clusters but only have %s datapoints!" % (self.K,self.no_points)
         if self.no_unique_points < self.K: print "Want %s clusters but only have %s unique datapoints!" % (self.K,self.no_unique_points)
-        
-        # Compute lists of which indices are known (from M) for each row/column
-        self.omega_rows = [[j for j in range(0,self.no_coordinates) if self.M[i,j]] for i in range(0,self.no_points)]        
-        self.omega_columns = [[i for i in range(0,self.no_points) if self.M[i,j]] for j in range(0,self.no_coordinates)]
-                    
+
         # Assert none of the rows are entirely unknown values
-        for i,omega_row in enumerate(self.omega_rows):
-            assert len(omega_row) != 0, "Fully unobserved row in X, row %s." % i
-            
-        # Columns can be entirely unknown - they just don't influence the clustering - but we need to remove them
-        columns_to_remove = [j for j,omega_column in enumerate(self.omega_columns) if len(omega_column) == 0]
-        if len(columns_to_remove) > 0:
-            print "WARNING: removed columns %s for K-means clustering as they have no observed datapoints." % columns_to_remove
-            self.X = numpy.delete(self.X,columns_to_remove,axis=1)
-            self.M = numpy.delete(self.M,columns_to_remove,axis=1)
-            self.no_coordinates -= len(columns_to_remove)
-            self.omega_rows = [[j for j in range(0,self.no_coordinates) if self.M[i,j]] for i in range(0,self.no_points)]        
-            self.omega_columns = [[i for i in range(0,self.no_points) if self.M[i,j]] for j in range(0,self.no_coordinates)]
-            
+        for i,c in enumerate(observed.sum(axis=1)):
+            assert c != 0, "Fully unobserved row in X, row %s." % i
+
+        # Columns can be entirely unknown - they just don't influence the clustering - but we need to remove them.
+        # We index the columns we keep, rather than copying and deleting, so without empty columns nothing is copied.
+        columns_observed = observed.sum(axis=0) > 0
+        if not columns_observed.all():
+            print "WARNING: removed columns %s for K-means clustering as they have no observed datapoints." % numpy.flatnonzero(~columns_observed).tolist()
+            X = X[:,columns_observed]
+            observed = observed[:,columns_observed]
+            self.no_coordinates = int(columns_observed.sum())
+
+        # Masked versions of the data, used for computing the distances and centroids.
+        # The mask is float for the matrix products in the assignment and update steps.
+        self.M = observed.astype(float)
+        self.X = numpy.where(observed,X,0.)
+        self.X_squared = self.X**2
+
         # Initialise the distances from data points to the assigned cluster centroids to zeros
         self.distances = numpy.zeros(self.no_points)
-    
-    
-    """ Initialise the cluster centroids randomly """
-    def initialise(self,seed=None):
-        if seed is not None:
-            random.seed(seed)
-        
+
+
+    """ Initialise the cluster centroids, either randomly (init='random') or
+        using k-means++ seeding (init='kmeans++'). If a seed is given we draw from
+        our own random.Random with that seed, leaving the global one untouched. """
+    def initialise(self,seed=None,init='random'):
+        assert init in ['random','kmeans++'], "Unrecognised init option for KMeans: %s." % init
+        self.random = random.Random(seed) if seed is not None else random
+
         # Compute the mins and maxes of the columns - i.e. the min and max of each dimension
-        self.mins = [min([self.X[i,j] for i in self.omega_columns[j]]) for j in range(0,self.no_coordinates)]
-        self.maxs = [max([self.X[i,j] for i in self.omega_columns[j]]) for j in range(0,self.no_coordinates)]
-        
-        # Randomly initialise the cluster centroids
-        self.centroids = [self.random_cluster_centroid() for k in xrange(0,self.K)]
-        self.cluster_assignments = numpy.array([-1 for d in xrange(0,self.no_points)])
-        self.mask_centroids = numpy.ones((self.K,self.no_coordinates))
+        self.mins = numpy.where(self.M,self.X,numpy.inf).min(axis=0)
+        self.maxs = numpy.where(self.M,self.X,-numpy.inf).max(axis=0)
+
+        self.cluster_assignments = -numpy.ones(self.no_points,dtype=int)
+        if init == 'random':
+            # Randomly initialise the cluster centroids
+            self.centroids = numpy.array([self.random_cluster_centroid() for k in xrange(0,self.K)],dtype=float)
+            self.mask_centroids = numpy.ones((self.K,self.no_coordinates))
+        else:
+            self.kmeans_plus_plus()
+
+
+    # Pick the first centroid as a random data point, and each next one as a data
+    # point with probability proportional to its MSE to the closest centroid so far.
+    # A centroid copies the mask of its data point. Points that have no known values
+    # in common with any of the centroids so far count as being the furthest away.
+    def kmeans_plus_plus(self):
+        self.centroids = numpy.zeros((self.K,self.no_coordinates))
+        self.mask_centroids = numpy.zeros((self.K,self.no_coordinates))
+        for k in xrange(0,self.K):
+            if k == 0:
+                index = self.random.randrange(0,self.no_points)
+            else:
+                # Centroids we have not picked yet have an empty mask, so an infinite MSE
+                distances = self.compute_MSEs().min(axis=1)
+                finite = numpy.isfinite(distances)
+                distances[~finite] = distances[finite].max() if finite.any() else 1.
+                index = self.random_index(distances)
+            self.centroids[k] = self.X[index]
+            self.mask_centroids[k] = self.M[index]
+
+    # Return a random index with probability proportional to the weights, or uniformly if they are all 0
+    def random_index(self,weights):
+        total = weights.sum()
+        if total <= 0:
+            return self.random.randrange(0,len(weights))
+        index = numpy.searchsorted(numpy.cumsum(weights),self.random.random()*total,side='right')
+        return min(index,len(weights)-1)
 
 
     # Randomly place a new cluster centroids, picking uniformly between the min and max of each coordinate
     def random_cluster_centroid(self):
-        centroid = []
-        for coordinate in xrange(0,self.no_coordinates):
-            value = random.uniform(self.mins[coordinate],self.maxs[coordinate])
-            centroid.append(value)     
-        return centroid    
-    
-            
+        return [self.random.uniform(self.mins[coordinate],self.maxs[coordinate]) for coordinate in xrange(0,self.no_coordinates)]
+
+
     """ Perform the clustering, until there is no change """
     def cluster(self):
         iteration = 1
         change = True
         while change:
-            print "Iteration: %s." % iteration
             iteration += 1
             change = self.assignment()
             self.update()
-            
+
             if iteration >= max_iterations:
                 print "WARNING: did not converge, stopped after %s iterations." % max_iterations
                 break
-            
+
         # At the end, we create a binary matrix indicating which points were assigned to which cluster
         self.create_matrix()
 
 
     """ Assign each data point to the closest cluster, and return whether any reassignments were made """
     def assignment(self):
-        self.data_point_assignments = [[] for k in xrange(0,self.K)]
-        
-        change = False
-        for d,(data_point,mask) in enumerate(zip(self.X,self.M)):
-            old_c = self.cluster_assignments[d]
-            new_c = self.closest_cluster(data_point,d,mask)
-            
-            self.cluster_assignments[d] = new_c
-            self.data_point_assignments[new_c].append(d)
-            
-            change = (change or old_c != new_c)
+        MSEs = self.compute_MSEs()
+
+        # If two clusters are equally far, we take the cluster with the lowest index.
+        # If a point has no known values in common with any cluster, we assign it to the last one.
+        new_assignments = MSEs.argmin(axis=1)
+        undefined = numpy.isinf(MSEs).all(axis=1)
+        new_assignments[undefined] = self.K - 1
+
+        self.distances = MSEs[numpy.arange(self.no_points),new_assignments]
+        self.distances[undefined] = numpy.nan
+
+        change = (new_assignments != self.cluster_assignments).any()
+        self.cluster_assignments = new_assignments
         return change
-    
-    
-    # Compute the MSE to each of the clusters, and return the index of the closest cluster.
-    # If two clusters are equally far, we return the cluster with the lowest index.
-    def closest_cluster(self,data_point,index_data_point,mask_d):
-        closest_index = None
-        closest_MSE = None
-        for c,(centroid,mask_c) in enumerate(zip(self.centroids,self.mask_centroids)):
-            MSE = self.compute_MSE(data_point,centroid,mask_d,mask_c)
-            if (closest_MSE is None) or (MSE is not None and MSE < closest_MSE): #either no closest centroid yet, or MSE is defined and less
-                closest_MSE = MSE
-                closest_index = c
-        self.distances[index_data_point] = closest_MSE
-        return closest_index
-    
-    
-    # Compute the Euclidean distance between the data point and the cluster centroid.
-    # If they have no known values in common, we return None (=infinite distance).
-    def compute_MSE(self,x1,x2,mask1,mask2):
-        mask1_mask2 = numpy.multiply(mask1,mask2)
-        len_overlap = mask1_mask2.sum()
-        return None if len_overlap == 0 else numpy.multiply(mask1_mask2,numpy.power(numpy.subtract(x1,x2),2)).sum() / float(len_overlap)
-            
-        
-    """ Update the centroids to the mean of the points assigned to it. 
+
+
+    # Compute the MSE between each data point and each cluster centroid, using
+    # only the coordinates known for both, as a (no_points x K) matrix. If they
+    # have no known values in common, the MSE is infinite.
+    def compute_MSEs(self):
+        masked_centroids = self.mask_centroids * self.centroids
+        len_overlap = numpy.dot(self.M,self.mask_centroids.T)
+        squared_errors = numpy.dot(self.X_squared,self.mask_centroids.T) \
+                       - 2 * numpy.dot(self.X,masked_centroids.T) \
+                       + numpy.dot(self.M,(masked_centroids**2).T)
+        MSEs = numpy.full((self.no_points,self.K),numpy.inf)
+        overlap = len_overlap > 0
+        MSEs[overlap] = numpy.maximum(squared_errors[overlap],0.) / len_overlap[overlap]
+        return MSEs
+
+
+    """ Update the centroids to the mean of the points assigned to it.
         If for a coordinate there are no known values, we set this cluster's mask to 0 there.
-        If a cluster has no points assigned to it at all, we randomly re-initialise it. """
+        If a cluster has no points assigned to it at all, we either assign the point
+        furthest away to it (singleton), or randomly re-initialise it. """
     def update(self):
-        for c in xrange(0,self.K): 
-            self.update_cluster(c)
-    
-    # Update for one specific cluster
-    def update_cluster(self,c):
-        known_coordinate_values = self.find_known_coordinate_values(c)
-        
-        if known_coordinate_values is None:
-            # Reassign a datapoint to this cluster, as long as there are enough 
-            # unique datapoints. Either furthest away (singleton) or random.
-            if self.no_unique_points >= self.K:
-                if self.resolve_empty == 'singleton':
-                    # Find the point currently furthest away from its centroid                    
-                    index_furthest_away = self.find_point_furthest_away()
-                    old_cluster = self.cluster_assignments[index_furthest_away]
-                    
-                    # Add point to new cluster
-                    self.centroids[c] = self.X[index_furthest_away]
-                    self.mask_centroids[c] = self.M[index_furthest_away]
-                    self.distances[index_furthest_away] = 0.0
-                    self.cluster_assignments[index_furthest_away] = c
-                    self.data_point_assignments[c] = [index_furthest_away]
-                    
-                    # Remove from old cluster and update
-                    self.data_point_assignments[old_cluster].remove(index_furthest_away)
-                    #print c,old_cluster
-                    self.update_cluster(old_cluster)
-                else:
-                    # Randomly re-initialise this point
-                    self.centroids[c] = self.random_cluster_centroid()
-                    self.mask_centroids[c] = numpy.ones(self.no_coordinates)
+        self.update_clusters(range(0,self.K))
+        for c in xrange(0,self.K):
+            if (self.cluster_assignments == c).sum() == 0:
+                self.resolve_empty_cluster(c)
+
+    # Update the given clusters to the average of their known coordinate values,
+    # or to 0 if no values are observed. We leave empty clusters unchanged.
+    def update_clusters(self,clusters):
+        clusters = numpy.array(clusters,dtype=int)
+        assignments = (self.cluster_assignments[:,None] == clusters[None,:]).astype(float)
+        counts = numpy.dot(assignments.T,self.M)
+        sums = numpy.dot(assignments.T,self.X)
+
+        non_empty = assignments.sum(axis=0) > 0
+        known = counts > 0
+        self.centroids[clusters[non_empty]] = numpy.where(known,sums/numpy.maximum(counts,1.),0.)[non_empty]
+        self.mask_centroids[clusters[non_empty]] = known[non_empty]
+
+    # Reassign a datapoint to an empty cluster c, as long as there are enough
+    # unique datapoints. Either furthest away (singleton) or random.
+    def resolve_empty_cluster(self,c):
+        if self.no_unique_points < self.K:
+            return
+        if self.resolve_empty == 'singleton':
+            # Find the point currently furthest away from its centroid
+            index_furthest_away = self.find_point_furthest_away()
+            old_cluster = self.cluster_assignments[index_furthest_away]
+
+            # Add point to new cluster
+            self.centroids[c] = self.X[index_furthest_away]
+            self.mask_centroids[c] = self.M[index_furthest_away]
+            self.distances[index_furthest_away] = 0.0
+            self.cluster_assignments[index_furthest_away] = c
+
+            # Remove from old cluster and update
+            self.update_clusters([old_cluster])
+            if (self.cluster_assignments == old_cluster).sum() == 0:
+                self.resolve_empty_cluster(old_cluster)
         else:
-            # For each coordinate set the centroid to the average, or to 0 if no values are observed
-            for coordinate,coordinate_values in enumerate(known_coordinate_values):
-                if len(coordinate_values) == 0:
-                    new_coordinate = 0              
-                    new_mask = 0
-                else:
-                    new_coordinate = sum(coordinate_values) / float(len(coordinate_values))
-                    new_mask = 1
-                
-                self.centroids[c][coordinate] = new_coordinate
-                self.mask_centroids[c][coordinate] = new_mask
-    
-    
-    # For a given centroid c, construct a list of lists, each list consisting of
-    # all known coordinate values of data points assigned to the centroid.
-    # If no points are assigned to a cluster, return None.
-    def find_known_coordinate_values(self,c):
-        assigned_data_indexes = self.data_point_assignments[c]
-        data_points = numpy.array([self.X[d] for d in assigned_data_indexes])
-        masks = numpy.array([self.M[d] for d in assigned_data_indexes])
-        
-        if len(assigned_data_indexes) == 0:
-            lists_known_coordinate_values = None
-        else: 
-            lists_known_coordinate_values = [
-                [v for d,v in enumerate(data_points.T[coordinate]) if masks[d][coordinate]]
-                for coordinate in xrange(0,self.no_coordinates)
-            ]
-            
-        return lists_known_coordinate_values
-        
-    
+            # Randomly re-initialise this point
+            self.centroids[c] = self.random_cluster_centroid()
+            self.mask_centroids[c] = numpy.ones(self.no_coordinates)
+
+
+    # Return the distortion of the clustering: the sum of the MSEs of the points to their
+    # centroids (ignoring points without known values in common with their centroid)
+    def distortion(self):
+        return self.distances[numpy.isfinite(self.distances)].sum()
+
+
     # Find data point furthest away from its current cluster centroid
     def find_point_furthest_away(self):
         data_point_index = self.distances.argmax()
         return data_point_index
-        
-    
+
+
     # Create a binary matrix indicating the clustering (so size [no_points x K])
     def create_matrix(self):
         self.clustering_results = numpy.zeros((self.no_points,self.K))
-        for d in range(0,self.no_points):
-            c = self.cluster_assignments[d]
-            self.clustering_results[d][c] = 1
-            
-        print [sum(column) for column in self.clustering_results.T]
\ No newline at end of file
+        self.clustering_results[numpy.arange(self.no_points),self.cluster_assignments] = 1
+
+        print list(self.clustering_results.sum(axis=0))
@@ -0,0 +1,126 @@
+"""
+Functions for saving the state of a model to a compressed .npz file, and for
+loading it back in, so that we can checkpoint a long run and resume it exactly
+where it stopped.
+
+The state of a model consists of:
+- the variables given by the model, such as its factors, variational parameters,
+    and tau;
+- the iteration counter, model.iteration (the number of iterations done);
+- the histories of the run: all_times, all_performances, all_tau, all_exp_tau,
+    all_elbo, all_monitored, and converged (whichever the model has);
+- the random states: the global numpy one (used for drawing the samples), the
+    model's own RandomState if it was given a seed, and the global Python one
+    (used for shuffling the update order);
+- the sample store of a Gibbs sampler, model.samples. If it keeps its samples
+    in memory-mapped files, those stay in their files and are reopened.
+
+Loading a state sets these attributes on the model, and overwrites the global
+random states.
+
+Usage (in a model class):
+    def save_state(self,filename):
+        save_model_state(self,filename,['U','V','tau'])
+    def load_state(self,filename):
+        load_model_state(self,filename)
+"""
+
+from sample_store import load_sample_store
+
+import numpy, os, random
+
+histories = ['all_times','all_tau','all_exp_tau','all_elbo','all_monitored']
+
+
+# Save the variables names of the model, and the rest of its state, to filename.
+# We write to a temporary file first, so that a run killed while writing a
+# checkpoint still leaves the previous one intact.
+def save_model_state(model,filename,names):
+    state = {'iteration' : numpy.array(getattr(model,'iteration',0))}
+    for name in names:
+        if getattr(model,name,None) is not None:
+            state['variable.%s' % name] = numpy.asarray(getattr(model,name))
+    for name in histories:
+        if hasattr(model,name):
+            state['history.%s' % name] = numpy.array(getattr(model,name))
+    if hasattr(model,'converged'):
+        state['converged'] = numpy.array(model.converged)
+    for metric,values in getattr(model,'all_performances',{}).items():
+        state['performances.%s' % metric] = numpy.array(values)
+    if getattr(model,'samples',None) is not None:
+        for name,value in model.samples.state().items():
+            state['samples.%s' % name] = value
+
+    state.update(numpy_random_state(numpy.random,'random.numpy'))
+    if model.seed is not None:
+        state.update(numpy_random_state(model.rng,'random.model'))
+    state.update(python_random_state())
+
+    filename_tmp = filename + '.tmp'
+    with open(filename_tmp,'wb') as fout:
+        numpy.savez_compressed(fout,**state)
+    os.rename(filename_tmp,filename)
+
+
+# Load the state in filename back into the model
+def load_model_state(model,filename):
+    with numpy.load(filename) as data:
+        state = dict(data.items())
+    model.iteration = int(state['iteration'])
+    if 'converged' in state:
+        model.converged = bool(state['converged'])
+
+    performances = {}
+    samples = {}
+    for key,value in state.items():
+        (kind,_,name) = key.partition('.')
+        if kind == 'variable':
+            setattr(model,name,value[()] if value.shape == () else value)
+        elif kind == 'history':
+            # all_tau of the ICM models is an array rather than a list
+            setattr(model,name,value if name == 'all_tau' else list(value))
+        elif kind == 'performances':
+            performances[name] = list(value)
+        elif kind == 'samples':
+            samples[name] = value
+    if performances:
+        model.all_performances = performances
+    if samples:
+        model.samples = load_sample_store(samples)
+
+    set_numpy_random_state(numpy.random,state,'random.numpy')
+    if model.seed is not None:
+        set_numpy_random_state(model.rng,state,'random.model')
+    set_python_random_state(state)
+
+
+# Convert the state of a numpy RandomState (or the numpy.random module) to arrays, and back
+def numpy_random_state(rng,prefix):
+    (_,keys,position,has_gauss,cached_gaussian) = rng.get_state()
+    return {
+        '%s.keys' % prefix : keys,
+        '%s.position' % prefix : numpy.array([position,has_gauss]),
+        '%s.gaussian' % prefix : numpy.array(cached_gaussian),
+    }
+
+def set_numpy_random_state(rng,state,prefix):
+    (position,has_gauss) = state['%s.position' % prefix]
+    rng.set_state(('MT19937',state['%s.keys' % prefix],int(position),int(has_gauss),float(state['%s.gaussian' % prefix])))
+
+
+# Convert the state of the global Python random to arrays, and back. The cached
+# Gaussian is None if there is none, which we store as an empty array.
+def python_random_state():
+    (version,internal,gauss_next) = random.getstate()
+    return {
+        'random.python.version' : numpy.array(version),
+        'random.python.internal' : numpy.array(internal,dtype=numpy.int64),
+        'random.python.gauss' : numpy.array([gauss_next] if gauss_next is not None else [],dtype=float),
+    }
+
+def set_python_random_state(state):
+    gauss = state['random.python.gauss']
+    random.setstate((
+        int(state['random.python.version']),
+        tuple(int(v) for v in state['random.python.internal']),
+        float(gauss[0]) if len(gauss) > 0 else None))
@@ -2,11 +2,16 @@
 Iterated Conditional Modes for MAP non-negative matrix tri-factorisation.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
 - K, the number of latent factors
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaU' = [[lambdaUik]], 'lambdaV' = [[lambdaVjk]] },
     a dictionary defining the priors over tau, U, V.
+- dtype, the floating point type used for R, M, U, and V: float (default) or
+    numpy.float32.
+- seed, if given we draw the random initialisation from our own numpy
+    RandomState with this seed (default None).
     
 Initialisation can be done by running the initialise() function, with argument init:
 - init='random' -> draw initial values randomly from priors Exp, Gamma
@@ -20,6 +25,16 @@ Usage of class:
 Or:
     NMF = nmf_icm(R,M,K,priors)
     NMF.train(init,iterations)
+To warm start from a trained model NMF_prev with a different K, we run
+NMF.warm_start(NMF_prev) after initialise(init).
+To save a checkpoint every N iterations, we run
+    NMF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with NMF.save_state(filename) and 
+NMF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    NMF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
 
 We can test the performance of our model on a test dataset, specifying our test set with a mask M. 
     performance = NMF.predict(M_pred)
@@ -40,13 +55,18 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 from distributions.exponential import exponential_draw
 from distributions.gamma import gamma_mode
 from distributions.truncated_normal_vector import TN_vector_mode
+from model_state import save_model_state, load_model_state
 
-import numpy, itertools, math, time
+import numpy, itertools, math, os, time
 
 class nmf_icm:
-    def __init__(self,R,M,K,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,priors,dtype=float,seed=None):
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype in [numpy.float32,numpy.float64], "Unsupported dtype: %s. Should be float32 or float64." % self.dtype
+        self.R = numpy.asarray(R,dtype=self.dtype)
+        self.M = numpy.array(M,dtype=self.dtype)
+        self.rng = numpy.random.RandomState(seed) if seed is not None else numpy.random
+        self.seed = seed
         self.K = K
         
         assert len(self.R.shape) == 2, "Input matrix R is not a two-dimensional array, " \
@@ -55,17 +75,17 @@ class nmf_icm:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        self.size_Omega = float(self.M.sum())
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaU, self.lambdaV = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU']), numpy.array(priors['lambdaV'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaU'],dtype=self.dtype), numpy.array(priors['lambdaV'],dtype=self.dtype)
         
         # If lambdaU or lambdaV are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaU.shape == ():
-            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K))
+            self.lambdaU = self.lambdaU * numpy.ones((self.I,self.K),dtype=self.dtype)
         if self.lambdaV.shape == ():
-            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K))
+            self.lambdaV = self.lambdaV * numpy.ones((self.J,self.K),dtype=self.dtype)
         
         assert self.lambdaU.shape == (self.I,self.K), "Prior matrix lambdaU has the wrong shape: %s instead of (%s, %s)." % (self.lambdaU.shape,self.I,self.K)
         assert self.lambdaV.shape == (self.J,self.K), "Prior matrix lambdaV has the wrong shape: %s instead of (%s, %s)." % (self.lambdaV.shape,self.J,self.K)
@@ -92,59 +112,93 @@ class nmf_icm:
     # Initialise U, V, and tau. If init='random', draw values from an Exp and Gamma distribution. If init='exp', set it to the expectation values.
     def initialise(self,init='random'):
         assert init in ['random','exp'], "Unknown initialisation option: %s. Should be 'random' or 'exp'." % init
-        self.U = numpy.zeros((self.I,self.K))
-        self.V = numpy.zeros((self.J,self.K))
+        self.U = numpy.zeros((self.I,self.K),dtype=self.dtype)
+        self.V = numpy.zeros((self.J,self.K),dtype=self.dtype)
         
         if init == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):
-                self.U[i,k] = exponential_draw(self.lambdaU[i][k])
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = exponential_draw(self.lambdaV[j][k])
+            self.U[:] = exponential_draw(self.lambdaU,rng=self.rng)
+            self.V[:] = exponential_draw(self.lambdaV,rng=self.rng)
             
         elif init == 'exp':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):
-                self.U[i,k] = 1.0/self.lambdaU[i][k]
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = 1.0/self.lambdaV[j][k]
+            self.U[:] = 1.0/self.lambdaU
+            self.V[:] = 1.0/self.lambdaV
         
         self.tau = gamma_mode(self.alpha_s(), self.beta_s())
        
 
-    # Run the Gibbs sampler
-    def run(self,iterations,minimum_TN=0.):   
-        self.all_tau = numpy.zeros(iterations) # to plot convergence
-        self.all_times = [] # to plot performance against time
+    # Warm start from a trained model with a different number of factors. After
+    # initialise(), we copy over its U and V for the first min(K,model.K) factors,
+    # keeping the fresh initialisation for the others.
+    def warm_start(self,model):
+        assert (model.I,model.J) == (self.I,self.J), "Cannot warm start from a model of size (%s, %s) instead of (%s, %s)." % (model.I,model.J,self.I,self.J)
+        K = min(self.K,model.K)
+        self.U[:,:K], self.V[:,:K] = model.U[:,:K], model.V[:,:K]
+        self.tau = gamma_mode(self.alpha_s(), self.beta_s())
+        
+
+    # Save the state of the model - U, V, tau, the iteration, and the random 
+    # states - to a compressed .npz file, or load it back in.
+    def save_state(self,filename):
+        save_model_state(self,filename,['U','V','tau'])
         
+    def load_state(self,filename):
+        load_model_state(self,filename)
+        
+
+    # Run the Gibbs sampler. If checkpoint is given, we save the state to it every
+    # <checkpoint_every> iterations, and resume from it if it already exists.
+    def run(self,iterations,minimum_TN=0.,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
         metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
-        
-        time_start = time.time()
-        for it in range(0,iterations):      
-            for k in range(0,self.K):   
-                tauUk = self.tauU(k)
-                muUk = self.muU(tauUk,k)
-                self.U[:,k] = TN_vector_mode(muUk) 
-                self.U[:,k] = numpy.maximum(self.U[:,k],minimum_TN*numpy.ones(self.I))
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+            self.all_tau = numpy.append(self.all_tau[:self.iteration],numpy.zeros(max(iterations-self.iteration,0)))
+        else:
+            self.all_tau = numpy.zeros(iterations) # to plot convergence
+            self.all_times = [] # to plot performance against time
+            
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in metrics:
+                self.all_performances[metric] = []
+            self.iteration = 0
+        
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration,iterations):      
+                for k in range(0,self.K):   
+                    tauUk = self.tauU(k)
+                    muUk = self.muU(tauUk,k)
+                    self.U[:,k] = TN_vector_mode(muUk) 
+                    self.U[:,k] = numpy.maximum(self.U[:,k],minimum_TN*numpy.ones(self.I))
                 
-            for k in range(0,self.K):
-                tauVk = self.tauV(k)
-                muVk = self.muV(tauVk,k)
-                self.V[:,k] = TN_vector_mode(muVk) 
-                self.V[:,k] = numpy.maximum(self.V[:,k],minimum_TN*numpy.ones(self.J))
+                for k in range(0,self.K):
+                    tauVk = self.tauV(k)
+                    muVk = self.muV(tauVk,k)
+                    self.V[:,k] = TN_vector_mode(muVk) 
+                    self.V[:,k] = numpy.maximum(self.V[:,k],minimum_TN*numpy.ones(self.J))
                 
-            self.tau = gamma_mode(self.alpha_s(),self.beta_s())
-            self.all_tau[it] = self.tau
+                self.tau = gamma_mode(self.alpha_s(),self.beta_s())
+                self.all_tau[it] = self.tau
             
-            perf = self.predict(self.M)
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
+                perf = self.predict(self.M)
+                for metric in metrics:
+                    self.all_performances[metric].append(perf[metric])
                 
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+                print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+            
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)            
             
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                self.iteration = it+1
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
+        finally:
+            if profiler is not None:
+                profiler.detach(self)
             
         return
         
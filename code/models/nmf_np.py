@@ -15,24 +15,42 @@ And realising that elements in each column in U and V are independent:
 - V.k <- V.k * sum(M * [U.k * (R / (U dot V.T))], axis=0) / sum(M dot U.k, axis=0)
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
 - K, the number of latent factors
+- dtype, the floating point type used for R, M, U, and V: float (default) or
+    numpy.float32.
+- seed, if given we draw the random initialisation from our own numpy
+    RandomState with this seed (default None).
     
 Initialisation can be done by running the initialise(init,tauUV) function. We initialise as follows:
 - init_UV = 'ones'          -> U[i,k] = V[j,k] = 1
           = 'random'        -> U[i,k] ~ U(0,1), V[j,k] ~ U(0,1), 
           = 'exponential'   -> U[i,k] ~ Exp(expo_prior), V[j,k] ~ Exp(expo_prior) 
   where expo_prior is an additional parameter (default 1)
+To save a checkpoint every N iterations, we run
+    NMF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with NMF.save_state(filename) and 
+NMF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    NMF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
 """
 
 from distributions.exponential import exponential_draw
-import numpy, math, itertools, time
+from model_state import save_model_state, load_model_state
+import numpy, math, itertools, os, time
 
 class NMF:
-    def __init__(self,R,M,K):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,dtype=float,seed=None):
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype in [numpy.float32,numpy.float64], "Unsupported dtype: %s. Should be float32 or float64." % self.dtype
+        self.R = numpy.asarray(R,dtype=self.dtype)
+        self.M = numpy.array(M,dtype=self.dtype)
+        self.rng = numpy.random.RandomState(seed) if seed is not None else numpy.random
+        self.seed = seed
         self.K = K                     
         
         self.metrics = ['MSE','R^2','Rp']
@@ -47,7 +65,7 @@ class NMF:
         self.check_empty_rows_columns() 
         
         # For computing the I-div it is better if unknown values are 1's, not 0's
-        self.R_excl_unknown = numpy.empty((self.I,self.J))
+        self.R_excl_unknown = numpy.empty((self.I,self.J),dtype=self.dtype)
         for i,j in itertools.product(range(0,self.I),range(0,self.J)):
             self.R_excl_unknown[i,j] = self.R[i,j] if self.M[i,j] else 1.
                  
@@ -68,40 +86,63 @@ class NMF:
     def initialise(self,init_UV='random',expo_prior=1.):
         assert init_UV in ['ones','random','exponential'], "Unrecognised init option for U,V: %s." % init_UV
         if init_UV == 'ones':
-            self.U = numpy.ones((self.I,self.K))
-            self.V = numpy.ones((self.J,self.K))
+            self.U = numpy.ones((self.I,self.K),dtype=self.dtype)
+            self.V = numpy.ones((self.J,self.K),dtype=self.dtype)
         elif init_UV == 'random':
-            self.U = numpy.random.rand(self.I,self.K)
-            self.V = numpy.random.rand(self.J,self.K)
+            self.U = self.rng.rand(self.I,self.K).astype(self.dtype)
+            self.V = self.rng.rand(self.J,self.K).astype(self.dtype)
         elif init_UV == 'exponential':
-            self.U = numpy.empty((self.I,self.K))
-            self.V = numpy.empty((self.J,self.K))
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.U[i,k] = exponential_draw(expo_prior)
-            for j,k in itertools.product(xrange(0,self.J),xrange(0,self.K)):
-                self.V[j,k] = exponential_draw(expo_prior)
+            self.U = exponential_draw(expo_prior,size=(self.I,self.K),rng=self.rng).astype(self.dtype)
+            self.V = exponential_draw(expo_prior,size=(self.J,self.K),rng=self.rng).astype(self.dtype)
     
     
-    """ Update U and V for a number of iterations, printing the MSE and divergence each iteration. """
-    def run(self,iterations):
-        assert hasattr(self,'U') and hasattr(self,'V'), "U and V have not been initialised - please run NMF.initialise() first."        
+    """ Save the state - U, V, the iteration, and the random states - to a compressed .npz file, or load it back in. """
+    def save_state(self,filename):
+        save_model_state(self,filename,['U','V'])
         
-        self.all_times = [] # to plot performance against time
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in self.metrics:
-            self.all_performances[metric] = []
+    def load_state(self,filename):
+        load_model_state(self,filename)
+    
+    
+    """ Update U and V for a number of iterations, printing the MSE and divergence each iteration. 
+        If checkpoint is given, we save the state to it every <checkpoint_every> iterations,
+        and resume from it if it already exists. """
+    def run(self,iterations,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+        else:
+            assert hasattr(self,'U') and hasattr(self,'V'), "U and V have not been initialised - please run NMF.initialise() first."        
+            
+            self.all_times = [] # to plot performance against time
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in self.metrics:
+                self.all_performances[metric] = []
+            self.iteration = 0
+            
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration+1,iterations+1):
+                for k in range(0,self.K):
+                    self.update_U(k)
+                for k in range(0,self.K):
+                    self.update_V(k)
             
-        time_start = time.time()
-        for it in range(1,iterations+1):
-            for k in range(0,self.K):
-                self.update_U(k)
-            for k in range(0,self.K):
-                self.update_V(k)
+                self.give_update(it)
             
-            self.give_update(it)
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)   
             
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)   
+                self.iteration = it
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
+        finally:
+            if profiler is not None:
+                profiler.detach(self)
         
         
     """ Method for doing both initialise() and run() """
@@ -2,17 +2,25 @@
 Iterated Conditional Modes for MAP non-negative matrix tri-factorisation.
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
 - K, the number of row clusters
 - L, the number of column clusters
 - priors = { 'alpha' = alpha_R, 'beta' = beta_R, 'lambdaF' = [[lambdaFik]], 'lambdaS' = [[lambdaSkl]], 'lambdaG' = [[lambdaGjl]] },
     a dictionary defining the priors over tau, F, S, G.
+- dtype, the floating point type used for R, M, F, S, and G: float (default) or
+    numpy.float32.
+- seed, if given we draw the random initialisation from our own numpy
+    RandomState with this seed, and also use it for KMeans (default None).
     
 Initialisation can be done by running the initialise() function, with argument init:
 - init='random' -> draw initial values randomly from priors Exp, Gamma
 - init='exp'    -> use the expectation of the priors Exp, Gamma
 Alternatively, you can define your own initial values for F, S, G, and tau.
+With init_FG = 'kmeans' or 'kmeans++', we can give initialise() a list of
+kmeans_seeds, in which case we cluster once per seed (in kmeans_P parallel
+processes) and use the clustering with the lowest distortion.
 
 Usage of class:
     BNMF = bnmf_gibbs(R,M,K,L,priors)
@@ -21,6 +29,16 @@ Usage of class:
 Or:
     BNMF = bnmf_gibbs(R,M,K,L,priors)
     BNMF.train(init,iterations)
+To warm start from a trained model BNMF_prev with a different K or L, we run
+BNMF.warm_start(BNMF_prev) after initialise(init).
+To save a checkpoint every N iterations, we run
+    BNMF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with BNMF.save_state(filename) and 
+BNMF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    BNMF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
     
 We can test the performance of our model on a test dataset, specifying our test set with a mask M. 
     performance = BNMF.predict(M_pred)
@@ -38,18 +56,23 @@ Finally, we can return the goodness of fit of the data using the quality(metric)
 (we want to maximise these values)
 """
 
-from kmeans.kmeans import KMeans
+from kmeans.kmeans import multistart_kmeans
 from distributions.exponential import exponential_draw
 from distributions.gamma import gamma_mode
 from distributions.truncated_normal import TN_mode
 from distributions.truncated_normal_vector import TN_vector_mode
+from model_state import save_model_state, load_model_state
 
-import numpy, itertools, math, time
+import numpy, itertools, math, os, time
 
 class nmtf_icm:
-    def __init__(self,R,M,K,L,priors):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,L,priors,dtype=float,seed=None):
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype in [numpy.float32,numpy.float64], "Unsupported dtype: %s. Should be float32 or float64." % self.dtype
+        self.R = numpy.asarray(R,dtype=self.dtype)
+        self.M = numpy.array(M,dtype=self.dtype)
+        self.rng = numpy.random.RandomState(seed) if seed is not None else numpy.random
+        self.seed = seed
         self.K = K
         self.L = L
         
@@ -59,19 +82,19 @@ class nmtf_icm:
             "the indicator matrix M: %s and %s respectively." % (self.R.shape,self.M.shape)
             
         (self.I,self.J) = self.R.shape
-        self.size_Omega = self.M.sum()
+        self.size_Omega = float(self.M.sum())
         self.check_empty_rows_columns()      
         
         self.alpha, self.beta, self.lambdaF, self.lambdaS, self.lambdaG = \
-            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF']), numpy.array(priors['lambdaS']), numpy.array(priors['lambdaG'])
+            float(priors['alpha']), float(priors['beta']), numpy.array(priors['lambdaF'],dtype=self.dtype), numpy.array(priors['lambdaS'],dtype=self.dtype), numpy.array(priors['lambdaG'],dtype=self.dtype)
         
         # If lambdaF, lambdaS, or lambdaG are an integer rather than a numpy array, we make it into one using that value
         if self.lambdaF.shape == ():
-            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K))
+            self.lambdaF = self.lambdaF * numpy.ones((self.I,self.K),dtype=self.dtype)
         if self.lambdaS.shape == ():
-            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L))
+            self.lambdaS = self.lambdaS * numpy.ones((self.K,self.L),dtype=self.dtype)
         if self.lambdaG.shape == ():
-            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L))
+            self.lambdaG = self.lambdaG * numpy.ones((self.J,self.L),dtype=self.dtype)
         
         assert self.lambdaF.shape == (self.I,self.K), "Prior matrix lambdaF has the wrong shape: %s instead of (%s, %s)." % (self.lambdaF.shape,self.I,self.K)
         assert self.lambdaS.shape == (self.K,self.L), "Prior matrix lambdaS has the wrong shape: %s instead of (%s, %s)." % (self.lambdaS.shape,self.K,self.L)
@@ -97,78 +120,111 @@ class nmtf_icm:
 
 
     # Initialise U, V, and tau. If init='random', draw values from an Exp and Gamma distribution. If init='exp', set it to the expectation values.
-    def initialise(self,init_S='random',init_FG='random'):
+    def initialise(self,init_S='random',init_FG='random',kmeans_seeds=None,kmeans_P=1):
         assert init_S in ['random','exp'], "Unknown initialisation option for S: %s. Should be 'random' or 'exp'." % init_S
-        assert init_FG in ['random','exp','kmeans'], "Unknown initialisation option for S: %s. Should be 'random', 'exp', or 'kmeans." % init_FG
+        assert init_FG in ['random','exp','kmeans','kmeans++'], "Unknown initialisation option for F,G: %s. Should be 'random', 'exp', 'kmeans', or 'kmeans++'." % init_FG
         
         self.S = 1./self.lambdaS
         if init_S == 'random':
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):  
-                self.S[k,l] = exponential_draw(self.lambdaS[k,l])
+            self.S[:] = exponential_draw(self.lambdaS,rng=self.rng)
                 
         self.F, self.G = 1./self.lambdaF, 1./self.lambdaG
         if init_FG == 'random':
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.F[i,k] = exponential_draw(self.lambdaF[i,k])
-            for j,l in itertools.product(xrange(0,self.J),xrange(0,self.L)):
-                self.G[j,l] = exponential_draw(self.lambdaG[j,l])
-        elif init_FG == 'kmeans':
+            self.F[:] = exponential_draw(self.lambdaF,rng=self.rng)
+            self.G[:] = exponential_draw(self.lambdaG,rng=self.rng)
+        elif init_FG in ['kmeans','kmeans++']:
+            seeds = kmeans_seeds if kmeans_seeds is not None else [self.seed]
             print "Initialising F using KMeans."
-            kmeans_F = KMeans(self.R,self.M,self.K)
-            kmeans_F.initialise()
-            kmeans_F.cluster()
-            self.F = kmeans_F.clustering_results + 0.2            
+            kmeans_F = multistart_kmeans(self.R,self.M,self.K,seeds,init='random' if init_FG == 'kmeans' else 'kmeans++',P=kmeans_P)
+            self.F = (kmeans_F.clustering_results + 0.2).astype(self.dtype)            
             
             print "Initialising G using KMeans."
-            kmeans_G = KMeans(self.R.T,self.M.T,self.L)   
-            kmeans_G.initialise()
-            kmeans_G.cluster()
-            self.G = kmeans_G.clustering_results + 0.2
+            kmeans_G = multistart_kmeans(self.R.T,self.M.T,self.L,seeds,init='random' if init_FG == 'kmeans' else 'kmeans++',P=kmeans_P)
+            self.G = (kmeans_G.clustering_results + 0.2).astype(self.dtype)
 
         self.tau = gamma_mode(self.alpha_s(), self.beta_s())
 
 
-    # Run the Gibbs sampler
-    def run(self,iterations,minimum_TN=0.):  
-        self.all_tau = numpy.zeros(iterations)
-        self.all_times = [] # to plot performance against time
+    # Warm start from a trained model with a different number of row or column 
+    # clusters. After initialise(), we copy over its F, S, and G for the first 
+    # min(K,model.K) row and min(L,model.L) column clusters, keeping the fresh
+    # initialisation for the others.
+    def warm_start(self,model):
+        assert (model.I,model.J) == (self.I,self.J), "Cannot warm start from a model of size (%s, %s) instead of (%s, %s)." % (model.I,model.J,self.I,self.J)
+        K, L = min(self.K,model.K), min(self.L,model.L)
+        self.F[:,:K], self.S[:K,:L], self.G[:,:L] = model.F[:,:K], model.S[:K,:L], model.G[:,:L]
+        self.tau = gamma_mode(self.alpha_s(), self.beta_s())
+        
+
+    # Save the state of the model - F, S, G, tau, the iteration, and the random 
+    # states - to a compressed .npz file, or load it back in.
+    def save_state(self,filename):
+        save_model_state(self,filename,['F','S','G','tau'])
         
+    def load_state(self,filename):
+        load_model_state(self,filename)
+        
+
+    # Run the Gibbs sampler. If checkpoint is given, we save the state to it every
+    # <checkpoint_every> iterations, and resume from it if it already exists.
+    def run(self,iterations,minimum_TN=0.,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
         metrics = ['MSE','R^2','Rp']
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in metrics:
-            self.all_performances[metric] = []
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+            self.all_tau = numpy.append(self.all_tau[:self.iteration],numpy.zeros(max(iterations-self.iteration,0)))
+        else:
+            self.all_tau = numpy.zeros(iterations)
+            self.all_times = [] # to plot performance against time
+            
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in metrics:
+                self.all_performances[metric] = []
+            self.iteration = 0
         
-        time_start = time.time()
-        for it in range(0,iterations):            
-            for k in range(0,self.K):
-                tauFk = self.tauF(k)
-                muFk = self.muF(tauFk,k)
-                self.F[:,k] = TN_vector_mode(muFk)
-                self.F[:,k] = numpy.maximum(self.F[:,k],minimum_TN*numpy.ones(self.I))
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration,iterations):            
+                for k in range(0,self.K):
+                    tauFk = self.tauF(k)
+                    muFk = self.muF(tauFk,k)
+                    self.F[:,k] = TN_vector_mode(muFk)
+                    self.F[:,k] = numpy.maximum(self.F[:,k],minimum_TN*numpy.ones(self.I))
                 
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
-                tauSkl = self.tauS(k,l)
-                muSkl = self.muS(tauSkl,k,l)
-                self.S[k,l] = TN_mode(muSkl)
-                self.S[k,l] = max(self.S[k,l],minimum_TN)
+                for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+                    tauSkl = self.tauS(k,l)
+                    muSkl = self.muS(tauSkl,k,l)
+                    self.S[k,l] = TN_mode(muSkl)
+                    self.S[k,l] = max(self.S[k,l],minimum_TN)
                 
-            for l in range(0,self.L):
-                tauGl = self.tauG(l)
-                muGl = self.muG(tauGl,l)
-                self.G[:,l] = TN_vector_mode(muGl)
-                self.G[:,l] = numpy.maximum(self.G[:,l],minimum_TN*numpy.ones(self.J))
+                for l in range(0,self.L):
+                    tauGl = self.tauG(l)
+                    muGl = self.muG(tauGl,l)
+                    self.G[:,l] = TN_vector_mode(muGl)
+                    self.G[:,l] = numpy.maximum(self.G[:,l],minimum_TN*numpy.ones(self.J))
                 
-            self.tau = gamma_mode(self.alpha_s(),self.beta_s())
-            self.all_tau[it] = self.tau
+                self.tau = gamma_mode(self.alpha_s(),self.beta_s())
+                self.all_tau[it] = self.tau
             
-            perf = self.predict(self.M)
-            for metric in metrics:
-                self.all_performances[metric].append(perf[metric])
+                perf = self.predict(self.M)
+                for metric in metrics:
+                    self.all_performances[metric].append(perf[metric])
                 
-            print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
+                print "Iteration %s. MSE: %s. R^2: %s. Rp: %s." % (it+1,perf['MSE'],perf['R^2'],perf['Rp'])
         
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)            
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)            
+            
+                self.iteration = it+1
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
+        finally:
+            if profiler is not None:
+                profiler.detach(self)
             
         return 
         
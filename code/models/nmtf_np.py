@@ -15,10 +15,15 @@ And realising that elements in each column in U and V are independent:
 - V.k <- V.k * sum(M * [U.k * (R / (U dot V.T))], axis=0) / sum(M dot U.k, axis=0)
 
 We expect the following arguments:
-- R, the matrix
-- M, the mask matrix indicating observed values (1) and unobserved ones (0)
+- R, the matrix. A memory-mapped array of the given dtype is used without copying it.
+- M, the mask matrix indicating observed values (1) and unobserved ones (0),
+    or a PackedMask (see cross_validation/packed_mask.py)
 - K, the number of row latent factors
 - L, the number of column latent factors
+- dtype, the floating point type used for R, M, F, S, and G: float (default) or
+    numpy.float32.
+- seed, if given we draw the random initialisation from our own numpy
+    RandomState with this seed, and also use it for KMeans (default None).
     
 Initialisation can be done by running the initialise(init,tauUV) function. We initialise as follows:
 - init_S = 'ones'          -> S[i,k] = 1
@@ -28,18 +33,35 @@ Initialisation can be done by running the initialise(init,tauUV) function. We in
           = 'random'        -> F[i,k] ~ U(0,1), G[j,l] ~ G(0,1), 
           = 'exponential'   -> F[i,k] ~ Exp(expo_prior), G[j,l] ~ Exp(expo_prior) 
           = 'kmeans'        -> F = KMeans(R,rows)+0.2, G = KMeans(R,columns)+0.2
+          = 'kmeans++'      -> the same, but seeding KMeans with k-means++
   where expo_prior is an additional parameter (default 1)
+With init_FG = 'kmeans' or 'kmeans++', we can give initialise() a list of
+kmeans_seeds, in which case we cluster once per seed (in kmeans_P parallel
+processes) and use the clustering with the lowest distortion.
+To save a checkpoint every N iterations, we run
+    NMTF.run(iterations,checkpoint=filename,checkpoint_every=N)
+If the checkpoint exists, running this again continues where it stopped. We can
+also save and load the state ourselves with NMTF.save_state(filename) and 
+NMTF.load_state(filename) (see model_state.py).
+To see how long each part of the iterations takes, we run
+    NMTF.run(iterations,profiler=profiler)
+with profiler = Profiler() (see profiler.py).
 """
 
-from kmeans.kmeans import KMeans
+from kmeans.kmeans import multistart_kmeans
 from distributions.exponential import exponential_draw
+from model_state import save_model_state, load_model_state
 
-import numpy,itertools,math,time
+import numpy,itertools,math,os,time
 
 class NMTF:
-    def __init__(self,R,M,K,L):
-        self.R = numpy.array(R,dtype=float)
-        self.M = numpy.array(M,dtype=float)
+    def __init__(self,R,M,K,L,dtype=float,seed=None):
+        self.dtype = numpy.dtype(dtype)
+        assert self.dtype in [numpy.float32,numpy.float64], "Unsupported dtype: %s. Should be float32 or float64." % self.dtype
+        self.R = numpy.asarray(R,dtype=self.dtype)
+        self.M = numpy.array(M,dtype=self.dtype)
+        self.rng = numpy.random.RandomState(seed) if seed is not None else numpy.random
+        self.seed = seed
         self.K = K            
         self.L = L    
         
@@ -55,7 +77,7 @@ class NMTF:
         self.check_empty_rows_columns() 
         
         # For computing the I-div it is better if unknown values are 1's, not 0's
-        self.R_excl_unknown = numpy.empty((self.I,self.J))
+        self.R_excl_unknown = numpy.empty((self.I,self.J),dtype=self.dtype)
         for i,j in itertools.product(range(0,self.I),range(0,self.J)):
             self.R_excl_unknown[i,j] = self.R[i,j] if self.M[i,j] else 1.
                  
@@ -73,72 +95,90 @@ class NMTF:
                  
 
     """ Initialise F, S and G """    
-    def initialise(self,init_S='random',init_FG='random',expo_prior=1.):
+    def initialise(self,init_S='random',init_FG='random',expo_prior=1.,kmeans_seeds=None,kmeans_P=1):
         assert init_S in ['ones','random','exponential'], "Unrecognised init option for S: %s." % init_S
-        assert init_FG in ['ones','random','exponential','kmeans'], "Unrecognised init option for F,G: %s." % init_FG
+        assert init_FG in ['ones','random','exponential','kmeans','kmeans++'], "Unrecognised init option for F,G: %s." % init_FG
         
         if init_S == 'ones':
-            self.S = numpy.ones((self.K,self.L))
+            self.S = numpy.ones((self.K,self.L),dtype=self.dtype)
         elif init_S == 'random':
-            self.S = numpy.random.rand(self.K,self.L)
+            self.S = self.rng.rand(self.K,self.L).astype(self.dtype)
         elif init_S == 'exponential':
-            self.S = numpy.empty((self.K,self.L))
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):        
-                self.S[k,l] = exponential_draw(expo_prior)
+            self.S = exponential_draw(expo_prior,size=(self.K,self.L),rng=self.rng).astype(self.dtype)
         
         if init_FG == 'ones':
-            self.F = numpy.ones((self.I,self.K))
-            self.G = numpy.ones((self.J,self.L))
+            self.F = numpy.ones((self.I,self.K),dtype=self.dtype)
+            self.G = numpy.ones((self.J,self.L),dtype=self.dtype)
         elif init_FG == 'random':
-            self.F = numpy.random.rand(self.I,self.K)
-            self.G = numpy.random.rand(self.J,self.L)
+            self.F = self.rng.rand(self.I,self.K).astype(self.dtype)
+            self.G = self.rng.rand(self.J,self.L).astype(self.dtype)
         elif init_FG == 'exponential':
-            self.F = numpy.empty((self.I,self.K))
-            self.G = numpy.empty((self.J,self.L))
-            for i,k in itertools.product(xrange(0,self.I),xrange(0,self.K)):        
-                self.F[i,k] = exponential_draw(expo_prior)
-            for j,l in itertools.product(xrange(0,self.J),xrange(0,self.L)):
-                self.G[j,l] = exponential_draw(expo_prior)
-        elif init_FG == 'kmeans':
+            self.F = exponential_draw(expo_prior,size=(self.I,self.K),rng=self.rng).astype(self.dtype)
+            self.G = exponential_draw(expo_prior,size=(self.J,self.L),rng=self.rng).astype(self.dtype)
+        elif init_FG in ['kmeans','kmeans++']:
+            seeds = kmeans_seeds if kmeans_seeds is not None else [self.seed]
             print "Initialising F using KMeans."
-            kmeans_F = KMeans(self.R,self.M,self.K)
-            kmeans_F.initialise()
-            kmeans_F.cluster()
-            self.F = kmeans_F.clustering_results + 0.2            
+            kmeans_F = multistart_kmeans(self.R,self.M,self.K,seeds,init='random' if init_FG == 'kmeans' else 'kmeans++',P=kmeans_P)
+            self.F = (kmeans_F.clustering_results + 0.2).astype(self.dtype)            
             
             print "Initialising G using KMeans."
-            kmeans_G = KMeans(self.R.T,self.M.T,self.L)   
-            kmeans_G.initialise()
-            kmeans_G.cluster()
-            self.G = kmeans_G.clustering_results + 0.2
+            kmeans_G = multistart_kmeans(self.R.T,self.M.T,self.L,seeds,init='random' if init_FG == 'kmeans' else 'kmeans++',P=kmeans_P)
+            self.G = (kmeans_G.clustering_results + 0.2).astype(self.dtype)
         
         
-    """ Update F, S, G for a number of iterations, printing the performances each iteration. """
-    def run(self,iterations):
-        assert hasattr(self,'F') and hasattr(self,'S') and hasattr(self,'G'), \
-            "F, S and G have not been initialised - please run NMTF.initialise() first."        
+    """ Save the state - F, S, G, the iteration, and the random states - to a compressed .npz file, or load it back in. """
+    def save_state(self,filename):
+        save_model_state(self,filename,['F','S','G'])
         
-        self.all_times = [] # to plot performance against time
-        self.all_performances = {} # for plotting convergence of metrics
-        for metric in self.metrics:
-            self.all_performances[metric] = []
+    def load_state(self,filename):
+        load_model_state(self,filename)
+        
+        
+    """ Update F, S, G for a number of iterations, printing the performances each iteration. 
+        If checkpoint is given, we save the state to it every <checkpoint_every> iterations,
+        and resume from it if it already exists. """
+    def run(self,iterations,checkpoint=None,checkpoint_every=10,profiler=None):
+        assert checkpoint_every >= 1, "checkpoint_every should be at least 1, not %s." % checkpoint_every
+        if checkpoint is not None and os.path.exists(checkpoint):
+            self.load_state(checkpoint)
+        else:
+            assert hasattr(self,'F') and hasattr(self,'S') and hasattr(self,'G'), \
+                "F, S and G have not been initialised - please run NMTF.initialise() first."        
             
-        time_start = time.time()
-        for it in range(1,iterations+1):
-            # Doing S first gives more interpretable results (F,G ~= [0,1] rather than [0,20])
-            for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
-                self.update_S(k,l)
+            self.all_times = [] # to plot performance against time
+            self.all_performances = {} # for plotting convergence of metrics
+            for metric in self.metrics:
+                self.all_performances[metric] = []
+            self.iteration = 0
+            
+        if profiler is not None:
+            profiler.attach(self)
+        try:
+            time_start = time.time() - (self.all_times[-1] if self.all_times else 0.)
+            for it in range(self.iteration+1,iterations+1):
+                # Doing S first gives more interpretable results (F,G ~= [0,1] rather than [0,20])
+                for k,l in itertools.product(xrange(0,self.K),xrange(0,self.L)):
+                    self.update_S(k,l)
                     
-            for k in range(0,self.K):
-                self.update_F(k)
+                for k in range(0,self.K):
+                    self.update_F(k)
                 
-            for l in range(0,self.L):
-                self.update_G(l)
+                for l in range(0,self.L):
+                    self.update_G(l)
                
-            self.give_update(it)
+                self.give_update(it)
+            
+                time_iteration = time.time()
+                self.all_times.append(time_iteration-time_start)  
             
-            time_iteration = time.time()
-            self.all_times.append(time_iteration-time_start)  
+                self.iteration = it
+                if checkpoint is not None and self.iteration % checkpoint_every == 0:
+                    self.save_state(checkpoint)
+                if profiler is not None:
+                    profiler.end_iteration(self.iteration)
+        finally:
+            if profiler is not None:
+                profiler.detach(self)
         
         
     """ Method for doing both initialise() and run() """
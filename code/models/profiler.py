@@ -0,0 +1,157 @@
+"""
+Profiler for the run() of the models, recording how long each part of an
+iteration takes and how often it is called.
+
+Give a Profiler to run(), as run(...,profiler=profiler). Before the first
+iteration it replaces the methods of the model (such as update_U, tauF,
+exp_square_diff, predict, and elbo) by timed versions, and likewise for the
+distribution functions the model's module uses (such as TN_vector_draw and
+gamma_draw). The run() puts the originals back when it finishes, also if it
+raises an exception. The distribution functions are shared by all models using
+that module, so we only record their calls made from within a timed method of
+the profiled model; other models calling them in the meantime are not counted.
+Without a profiler nothing is replaced, so the run is exactly as fast as before.
+
+The times are inclusive: the time of predict includes that of compute_MSE, and
+the time of update_U the time of the TN_vector_moments it calls.
+
+Arguments:
+- names, the methods of the model to time. By default all of its methods
+    except the ones in not_timed (run, train, initialise, ...).
+- kernels, whether to time the distribution functions as well (default True).
+- trace, whether to also record each call as an event for write_chrome_trace()
+    (default False). Otherwise we only keep the totals per iteration, so that 
+    the memory use does not grow with the number of calls.
+
+Per iteration we store a dictionary
+    {'iteration': .., 'time': .., 'phases': {name: {'calls': .., 'time': ..}}}
+in profiler.iterations, where 'time' is the duration of the iteration, and the
+time of the phases is the total over their calls, all in seconds. These can be
+written to a file with:
+- write_json_lines(filename), giving one JSON dictionary per iteration.
+- write_chrome_trace(filename), giving each call as an event in the Chrome
+    trace format, which can be opened in chrome://tracing or Perfetto. This
+    needs a Profiler(trace=True).
+
+Usage:
+    profiler = Profiler()
+    BNMF.run(iterations,profiler=profiler)
+    profiler.write_json_lines('times.jsonl')
+"""
+
+import inspect, json, os, sys, time
+
+not_timed = ['run','train','initialise','initialise_omega','warm_start','load_state',
+             'check_empty_rows_columns','quality','restart','best','all_restarts','shuffle']
+
+
+class Profiler:
+    def __init__(self,names=None,kernels=True,trace=False):
+        self.names = names
+        self.kernels = kernels
+        self.trace = trace
+
+        self.iterations = []        # The dictionaries of the finished iterations
+        self.events = []            # Tuples (name, category, start, duration, index of the iteration) of all calls, if trace
+        self.time_start = time.time()
+        self.start_iteration()
+        self.attached = None
+        self.depth = 0              # The number of timed methods of the model currently running
+
+    # Reset the counts for the next iteration
+    def start_iteration(self):
+        self.phases = {}
+        self.time_iteration = time.time()
+
+
+    # Replace the methods of the model, and the distribution functions in its
+    # module, by timed versions
+    def attach(self,model):
+        if self.attached is not None:
+            self.detach(self.attached[0])
+        names = self.names if self.names is not None else \
+            [name for name,_ in inspect.getmembers(model.__class__,inspect.ismethod)
+             if not name.startswith('_') and name not in not_timed]
+        for name in names:
+            setattr(model,name,self.timed_method(name,getattr(model,name)))
+
+        module = sys.modules[model.__class__.__module__]
+        originals = {}
+        if self.kernels:
+            for name,function in vars(module).items():
+                if inspect.isfunction(function) and 'distributions' in function.__module__.split('.'):
+                    originals[name] = function
+                    setattr(module,name,self.timed_kernel(name,function))
+        self.attached = (model,names,module,originals)
+        self.depth = 0
+        self.start_iteration()
+
+    # Put the original methods and functions back
+    def detach(self,model):
+        if self.attached is None:
+            return
+        (_,names,module,originals) = self.attached
+        for name in names:
+            if name in vars(model):
+                delattr(model,name)
+        for name,function in originals.items():
+            setattr(module,name,function)
+        self.attached = None
+
+    def timed_method(self,name,function):
+        def timed_function(*args,**kwargs):
+            start = time.time()
+            self.depth += 1
+            try:
+                return function(*args,**kwargs)
+            finally:
+                self.depth -= 1
+                self.add(name,'phase',start,time.time()-start)
+        return timed_function
+
+    # Kernels called outside the methods of the profiled model go straight through
+    def timed_kernel(self,name,function):
+        def timed_function(*args,**kwargs):
+            if self.depth == 0:
+                return function(*args,**kwargs)
+            start = time.time()
+            try:
+                return function(*args,**kwargs)
+            finally:
+                self.add(name,'kernel',start,time.time()-start)
+        return timed_function
+
+    def add(self,name,category,start,duration):
+        (calls,total) = self.phases.get(name,(0,0.))
+        self.phases[name] = (calls+1,total+duration)
+        if self.trace:
+            self.events.append((name,category,start,duration,len(self.iterations)))
+
+    # Store the counts of the iteration that just finished, and start the next one
+    def end_iteration(self,iteration):
+        time_end = time.time()
+        if self.trace:
+            self.events.append(('iteration %s' % iteration,'iteration',self.time_iteration,time_end-self.time_iteration,len(self.iterations)))
+        self.iterations.append({
+            'iteration' : iteration,
+            'time' : time_end - self.time_iteration,
+            'phases' : { name:{'calls':calls,'time':total} for name,(calls,total) in self.phases.items() },
+        })
+        self.start_iteration()
+
+
+    def write_json_lines(self,filename):
+        with open(filename,'w') as fout:
+            for record in self.iterations:
+                fout.write(json.dumps(record,sort_keys=True) + '\n')
+
+    # Each call is a complete event ('X'), with its start and duration in microseconds
+    def write_chrome_trace(self,filename):
+        assert self.trace, "No events were recorded for the Chrome trace: use Profiler(trace=True)."
+        events = [{
+            'name' : name, 'cat' : category, 'ph' : 'X', 'pid' : os.getpid(), 'tid' : 0,
+            'ts' : (start - self.time_start) * 1e6, 'dur' : duration * 1e6,
+            'args' : { 'iteration' : self.iterations[index]['iteration'] if index < len(self.iterations) else None },
+        } for (name,category,start,duration,index) in self.events]
+        with open(filename,'w') as fout:
+            json.dump({ 'traceEvents' : events, 'displayTimeUnit' : 'ms' },fout)
@@ -0,0 +1,161 @@
+"""
+Class for storing the samples of a Gibbs sampler while it runs, only keeping
+the samples we need for approximating the expectations.
+
+We expect the following arguments:
+- shapes, a list of (name, shape) pairs, one for each variable we store - for
+    example [('U',(I,K)),('V',(J,K)),('tau',())].
+- iterations, the number of iterations of the sampler.
+- burn_in, thinning: we only keep the samples of iterations burn_in,
+    burn_in+thinning, burn_in+2*thinning, ... (default 0 and 1, keeping all).
+- running_sums, if True we do not store the samples at all, but only the running
+    sums and sums of squares of the retained samples (default False).
+- folder, if given we store the retained samples in memory-mapped files
+    <folder>/<name>.npy rather than in memory (default None).
+- dtype, the floating point type of the stored samples (default float). The
+    running sums are always accumulated in double precision.
+- mode, the mode for opening the memory-mapped files: 'w+' creates new ones
+    (default), 'r+' reopens the existing ones, for resuming a run.
+
+Usage:
+    samples = SampleStore(shapes,iterations,burn_in,thinning)
+    samples.add(it,{'U':U,'V':V,'tau':tau})     (for it = 0, .., iterations-1)
+    samples.flush()
+Then:
+    samples.get('U')                            -> array of retained samples of U
+    samples.mean('U',burn_in,thinning)          -> average of the samples
+    samples.variance('U',burn_in,thinning)      -> variance of the samples
+mean and variance accept any burn_in and thinning selecting only retained
+samples, or exactly the burn_in and thinning of the store if running_sums=True.
+
+To checkpoint the store, samples.state() gives a dictionary of arrays, from
+which load_sample_store(state) recreates it.
+"""
+
+import numpy, os
+
+class SampleStore:
+    def __init__(self,shapes,iterations,burn_in=0,thinning=1,running_sums=False,folder=None,dtype=float,mode='w+'):
+        assert burn_in >= 0 and thinning >= 1, "Invalid burn-in or thinning: %s, %s." % (burn_in,thinning)
+        assert not (running_sums and folder), "Cannot store running sums in memory-mapped files."
+        assert mode in ['w+','r+'], "Unknown mode for the memory-mapped files: %s. Should be 'w+' or 'r+'." % mode
+
+        self.shapes = dict(shapes)
+        self.iterations = iterations
+        self.burn_in = burn_in
+        self.thinning = thinning
+        self.running_sums = running_sums
+        self.folder = folder
+        self.dtype = dtype
+        self.no_retained = len(range(burn_in,iterations,thinning))
+
+        self.samples, self.sums, self.sums_squares = {}, {}, {}
+        self.count = 0
+        for name,shape in shapes:
+            if self.running_sums:
+                self.sums[name], self.sums_squares[name] = numpy.zeros(shape), numpy.zeros(shape)
+            elif self.folder:
+                self.samples[name] = numpy.lib.format.open_memmap(
+                    os.path.join(self.folder,'%s.npy' % name), mode=mode, dtype=dtype, shape=(self.no_retained,)+tuple(shape))
+            else:
+                self.samples[name] = numpy.zeros((self.no_retained,)+tuple(shape),dtype=dtype)
+
+
+    # Return the position of iteration it in the retained samples, or None if we do not keep it
+    def position(self,it):
+        if it < self.burn_in or (it - self.burn_in) % self.thinning != 0 or it >= self.iterations:
+            return None
+        return (it - self.burn_in) // self.thinning
+
+    # Store the values (a dictionary from name to value) of iteration it
+    def add(self,it,values):
+        position = self.position(it)
+        if position is None:
+            return
+        for name,value in values.iteritems():
+            if self.running_sums:
+                self.sums[name] += value
+                self.sums_squares[name] += numpy.square(value)
+            else:
+                self.samples[name][position] = value
+        self.count += 1
+
+    # Write the memory-mapped files to disk
+    def flush(self):
+        if self.folder:
+            for samples in self.samples.values():
+                samples.flush()
+
+    # Return the state of the store as a dictionary of arrays. Memory-mapped samples
+    # are flushed to their files, rather than included.
+    def state(self):
+        self.flush()
+        state = {
+            'config' : numpy.array([self.iterations,self.burn_in,self.thinning,self.running_sums,self.count]),
+            'folder' : numpy.array(self.folder if self.folder else ''),
+            'dtype' : numpy.array(numpy.dtype(self.dtype).str),
+        }
+        for name,shape in self.shapes.items():
+            state['shape.%s' % name] = numpy.array(shape,dtype=int)
+            if self.running_sums:
+                state['sums.%s' % name], state['sums_squares.%s' % name] = self.sums[name], self.sums_squares[name]
+            elif not self.folder:
+                state['samples.%s' % name] = self.samples[name]
+        return state
+
+    # Return the retained samples for the variable name (None if running_sums=True)
+    def get(self,name):
+        return self.samples[name] if not self.running_sums else None
+
+
+    # Return the positions of the retained samples selected by burn_in and thinning
+    def positions(self,burn_in,thinning):
+        positions = [self.position(it) for it in range(burn_in,self.iterations,thinning)]
+        assert None not in positions, "Burn-in %s and thinning %s select samples that were not stored " \
+            "(stored burn-in %s and thinning %s)." % (burn_in,thinning,self.burn_in,self.thinning)
+        return positions
+
+    # Return the average and variance of the samples selected by burn_in and thinning.
+    # We add the samples one at a time, so that we do not load all of them at once.
+    def mean(self,name,burn_in,thinning):
+        if self.running_sums:
+            self.check_running_sums(burn_in,thinning)
+            return self.sums[name] / float(self.count)
+        positions = self.positions(burn_in,thinning)
+        if self.shapes[name] == ():
+            return sum([self.samples[name][p] for p in positions]) / float(len(positions))
+        total = numpy.zeros(self.shapes[name])
+        for p in positions:
+            total += self.samples[name][p]
+        return total / float(len(positions))
+
+    def variance(self,name,burn_in,thinning):
+        mean = self.mean(name,burn_in,thinning)
+        if self.running_sums:
+            return numpy.maximum(self.sums_squares[name] / float(self.count) - mean**2, 0.)
+        positions = self.positions(burn_in,thinning)
+        total = numpy.zeros(self.shapes[name])
+        for p in positions:
+            total += (self.samples[name][p] - mean)**2
+        return total / float(len(positions))
+
+    def check_running_sums(self,burn_in,thinning):
+        assert (burn_in,thinning) == (self.burn_in,self.thinning), "Only stored the running sums for burn-in %s " \
+            "and thinning %s, not %s and %s." % (self.burn_in,self.thinning,burn_in,thinning)
+        assert self.count > 0, "No samples were stored."
+
+
+# Recreate a SampleStore from its state(), reopening its memory-mapped files if it had any
+def load_sample_store(state):
+    (iterations,burn_in,thinning,running_sums,count) = [int(v) for v in state['config']]
+    folder = str(state['folder'])
+    shapes = [(key.partition('.')[2],tuple(shape)) for key,shape in state.items() if key.startswith('shape.')]
+    store = SampleStore(shapes,iterations,burn_in,thinning,bool(running_sums),folder if folder else None,
+                        numpy.dtype(str(state['dtype'])),mode='r+')
+    for name,_ in shapes:
+        if store.running_sums:
+            store.sums[name][...], store.sums_squares[name][...] = state['sums.%s' % name], state['sums_squares.%s' % name]
+        elif not store.folder:
+            store.samples[name][...] = state['samples.%s' % name]
+    store.count = count
+    return store
\ No newline at end of file
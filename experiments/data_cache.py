@@ -0,0 +1,58 @@
+"""
+Cache for the drug sensitivity datasets, so that we only parse each text file
+once. The parsed arrays are stored in a compressed .npz file next to the data
+file (<source>.cache.npz), together with the SHA-1 hash of the data file and
+the parse options. Later loads read the arrays straight from the cache, unless
+the data file has changed since, in which case we parse it again.
+
+The parse function takes the file location and returns a dictionary mapping
+names to arrays. Lists of names (such as the drug names) can be stored as
+numpy string arrays, and turned back into lists with .tolist().
+
+Usage:
+    values = load_cached(source,parse,options='',cache=True)
+If cache=False we always parse the file, and do not read or write the cache.
+"""
+
+import hashlib, numpy, os
+
+cache_extension = '.cache.npz'
+hash_block_size = 2**20
+
+
+# Return the hash of the file at location, combined with the parse options
+def file_hash(location,options=''):
+    sha1 = hashlib.sha1()
+    with open(location,'rb') as fin:
+        for block in iter(lambda: fin.read(hash_block_size),''):
+            sha1.update(block)
+    sha1.update(options)
+    return sha1.hexdigest()
+
+
+# Return the dictionary of arrays from parse(source), from the cache if it is
+# still valid and otherwise by parsing the file and storing the cache
+def load_cached(source,parse,options='',cache=True):
+    if not cache:
+        return parse(source)
+
+    location_cache = source + cache_extension
+    source_hash = file_hash(source,options)
+    if os.path.exists(location_cache):
+        with numpy.load(location_cache) as data:
+            if str(data['hash']) == source_hash:
+                return { name:value for name,value in data.items() if name != 'hash' }
+
+    values = parse(source)
+    store_cache(location_cache,values,source_hash)
+    return values
+
+
+# Store the arrays and hash, writing to a temporary file first so that an
+# interrupted write never leaves a broken cache behind
+def store_cache(location_cache,values,source_hash):
+    assert 'hash' not in values, "Cannot store an array named 'hash' in the cache."
+    location_tmp = location_cache + '.tmp'
+    with open(location_tmp,'wb') as fout:
+        numpy.savez_compressed(fout,hash=numpy.array(source_hash),**values)
+    os.rename(location_tmp,location_cache)
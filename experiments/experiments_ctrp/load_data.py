@@ -1,29 +1,32 @@
 """
 Helper function for reading in the CTRP dataset, splitting into data X and mask M.
+The parsed file is cached in a .npz file next to it (see data_cache.py), unless
+cache=False.
 Returns:
     X               Drug sensitivity values (original)
     M               Mask of known vs unknown values
 """
 
+from BNMTF.experiments.data_cache import load_cached
+
 import numpy
 
 project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 folder_ctrp = project_location+"BNMTF/data_drug_sensitivity/ctrp/"
 ctrp_file = folder_ctrp+"ec50.txt"
 
-def load_ctrp(delim='\t'):
+def load_ctrp(delim='\t',cache=True):
     filelocation = ctrp_file
-    data = numpy.genfromtxt(filelocation, delimiter=delim, missing_values=[numpy.nan])
-    I, J = data.shape
+    values = load_cached(filelocation,lambda location: parse_data(location,delim),options=delim,cache=cache)
+    return values['X'], values['M']
+
+def parse_data(location,delim='\t'):
+    data = numpy.genfromtxt(location, delimiter=delim, missing_values=[numpy.nan])
     
     # Construct the mask matrix, and replace any nan values by 0
-    new_data, mask = numpy.zeros((I,J)), numpy.zeros((I,J))
-    for i in range(0,I):
-        for j in range(0,J):
-            if not numpy.isnan(data[i,j]):
-                new_data[i,j] = data[i,j]
-                mask[i,j] = 1.
-    return new_data, mask
+    mask = (~numpy.isnan(data)).astype(float)
+    new_data = numpy.where(mask,data,0.)
+    return { 'X' : new_data, 'M' : mask }
 
 """
 X, M = load_ctrp()
@@ -3,6 +3,8 @@ Helper function for reading in the Sanger dataset, splitting into data X,
 mask M, drug names, cancer cell line names.
 We exclude two lines from the dataset because on those cell lines only two 
 drugs were tested.
+The parsed file is cached in a .npz file next to it (see data_cache.py), unless
+cache=False.
 Returns:
     X               Drug sensitivity values (original)
     X_min           Drug sensitivity values, minus (the lowest value in the dataset + 1)
@@ -15,6 +17,8 @@ Returns:
 Also have a helper for storing it back into a file.
 """
 
+from BNMTF.experiments.data_cache import load_cached
+
 import numpy
 
 project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
@@ -22,36 +26,36 @@ folder_gdsc = project_location+"BNMTF/data_drug_sensitivity/gdsc/"
 gdsc_file = folder_gdsc+"ic50_excl_empty_filtered_cell_lines_drugs.txt"
 gdsc_file_std = folder_gdsc+"ic50_excl_empty_filtered_cell_lines_drugs_standardised.txt"
 
-def load_gdsc(location=None,standardised=False,sep=","):
+def load_gdsc(location=None,standardised=False,sep=",",cache=True):
     """ Load in data. We get a masked array, and set masked values to 0. """
     if location:
         fin = location
     else:
         fin = gdsc_file if not standardised else gdsc_file_std
 
-    lines = [line.split("\n")[0].split("\r")[0].split(sep) for line in open(fin,'r').readlines()]
-    drug_names = lines[0][3:]
-    cell_lines = []
-    cancer_types = []
-    tissues = []
-    X = []
-    M = []
-    for line in lines[1:]:
-        cell_lines.append(line[0])
-        cancer_types.append(line[1])
-        tissues.append(line[2])
-        X.append([float(v) if v != '' else 0.0 for v in line[3:]])
-        M.append([1.0 if v != '' else 0.0 for v in line[3:]])
-    X = numpy.array(X,dtype=float)
-    M = numpy.array(M,dtype=float)
+    values = load_cached(fin,lambda location: parse_gdsc(location,sep),options=sep,cache=cache)
+    (X,M) = (values['X'],values['M'])
     
     minimum = X.min()-1
-    X_min = []
-    for row,row_M in zip(X,M):    
-        X_min.append([v-minimum if m else 0.0 for v,m in zip(row,row_M)])
-    X_min = numpy.array(X_min,dtype=float)
+    X_min = numpy.where(M,X-minimum,0.)
     
-    return (X,X_min,M,drug_names,cell_lines,cancer_types,tissues)
+    return (X,X_min,M,values['drug_names'].tolist(),values['cell_lines'].tolist(),
+            values['cancer_types'].tolist(),values['tissues'].tolist())
+
+
+def parse_gdsc(location,sep=","):
+    """ Parse the data file into the arrays X, M, and the names. """
+    lines = [line.split("\n")[0].split("\r")[0].split(sep) for line in open(location,'r').readlines()]
+    drug_names = lines[0][3:]
+    rows = numpy.array(lines[1:],dtype=str)
+    values = rows[:,3:]
+    M = (values != '').astype(float)
+    X = numpy.where(M,values,'0').astype(float)
+    return {
+        'X' : X, 'M' : M,
+        'drug_names' : numpy.array(drug_names,dtype=str), 'cell_lines' : rows[:,0],
+        'cancer_types' : rows[:,1], 'tissues' : rows[:,2],
+    }
     
 
 def negate_gdsc(X,M):
@@ -62,10 +66,7 @@ def negate_gdsc(X,M):
     X = -X
     minimum = X.min()-lowest_value
     
-    X_min = []
-    for row,row_M in zip(X,M):    
-        X_min.append([v-minimum if m else 0.0 for v,m in zip(row,row_M)])
-    X_min = numpy.array(X_min,dtype=float)
+    X_min = numpy.where(M,X-minimum,0.)
     
     return X_min
     
@@ -6,7 +6,7 @@ project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-from BNMTF.code.models.distributions.truncated_normal import TN_draw, TN_expectation, TN_variance, TN_mode
+from BNMTF.code.models.distributions.truncated_normal import TN_draw, TN_expectation, TN_variance, TN_moments, TN_mode
 from scipy.stats import norm
 import numpy
 
@@ -39,6 +39,10 @@ def test_variance():
     tau = 2000.
     assert TN_variance(mu,tau) == (1./2000.)**2
     
+def test_moments():
+    for mu,tau in [(1.0,3.0),(-1.,2000.),(-5.,0.5)]:
+        assert TN_moments(mu,tau) == (TN_expectation(mu,tau),TN_variance(mu,tau))
+    
 # Test a draw - simply verify it is > 0.
 # Also test whether we get inf for a very negative mean and high variance
 def test_draw():
@@ -6,7 +6,7 @@ project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-from BNMTF.code.models.distributions.truncated_normal_vector import TN_vector_draw, TN_vector_expectation, TN_vector_variance, TN_vector_mode
+from BNMTF.code.models.distributions.truncated_normal_vector import TN_vector_draw, TN_vector_expectation, TN_vector_variance, TN_vector_moments, TN_vector_mode
 from scipy.stats import norm
 import numpy
 
@@ -30,6 +30,21 @@ def test_variance():
     variance = sigma[0]**2 * ( 1 - ( lambdav * ( lambdav + mu[0] / sigma[0] ) ) )
     assert numpy.array_equal(TN_vector_variance(mu,tau), [variance, (1./2000.)**2])
 
+# Test computing both at once, also writing into an output buffer. 
+# Invalid values (tau = 0, or NaN) should give 0.
+def test_moments():
+    mu = numpy.array([1.0, -1, 0.5, numpy.nan])
+    tau = numpy.array([3.0, 2000, 0., 1.])
+    expectation, variance = TN_vector_moments(mu,tau)
+    assert numpy.array_equal(expectation, TN_vector_expectation(mu,tau))
+    assert numpy.array_equal(variance, TN_vector_variance(mu,tau))
+    assert expectation[2] == 0. and variance[2] == 0. and expectation[3] == 0. and variance[3] == 0.
+    
+    out = numpy.ones((4,2))
+    returned = TN_vector_moments(mu,tau,out_exp=out[:,0],out_var=out[:,1])
+    assert numpy.array_equal(out[:,0], expectation) and numpy.array_equal(out[:,1], variance)
+    assert returned[0].base is out and returned[1].base is out
+    
 # Test a draw - simply verify it is > 0.
 # Also test whether we get inf for a very negative mean and high variance
 def test_draw():
@@ -40,6 +55,17 @@ def test_draw():
         v1,v2 = TN_vector_draw(mu,tau)
         assert v1 >= 0.0 and v2 == 0.0
         
+# Test whether the draws have the right mean, for each of the regimes in rtnorm:
+# left tail (-mu/sigma < -2), Chopin's algorithm, and right tail (-mu/sigma > 3.49).
+def test_draw_regimes():
+    numpy.random.seed(0)
+    n = 100000
+    for mu,tau in [(3.,1.),(0.,4.),(-1.,1.),(-3.,1.),(-3.4,1.),(-5.,1.),(-1.,2000.)]:
+        draws = TN_vector_draw(mu*numpy.ones(n),tau*numpy.ones(n))
+        assert len(draws) == n and draws.min() >= 0.
+        expectation, variance = TN_vector_expectation([mu],[tau])[0], TN_vector_variance([mu],[tau])[0]
+        assert abs(draws.mean() - expectation) < 5 * numpy.sqrt(variance / n)
+    
 # Test the mode
 def test_mode():
     # Positive mean
@@ -0,0 +1,154 @@
+"""
+Test the masked K-means clustering in kmeans.py.
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+from BNMTF.code.models.kmeans.kmeans import KMeans, multistart_kmeans
+from BNMTF.code.cross_validation.packed_mask import PackedMask
+import numpy, pytest, random
+
+
+""" Test constructor """
+def test_init():
+    X = numpy.array([[1.,2.,0.],[3.,4.,0.]])
+    M = numpy.array([[1,1,0],[0,1,0]])
+    with pytest.raises(AssertionError) as error:
+        KMeans(X,numpy.ones((3,3)),2)
+    assert str(error.value) == "Input matrix X is not of the same size as the indicator matrix M: (2, 3) and (3, 3) respectively."
+    with pytest.raises(AssertionError) as error:
+        KMeans(X,numpy.array([[1,1,0],[0,0,0]]),2)
+    assert str(error.value) == "Fully unobserved row in X, row 1."
+
+    # Unobserved column 2 gets removed
+    kmeans = KMeans(X,M,2)
+    assert kmeans.no_coordinates == 2
+    assert numpy.array_equal(kmeans.X, [[1.,2.],[0.,4.]])
+    assert numpy.array_equal(kmeans.M, [[1.,1.],[0.,1.]])
+    assert numpy.array_equal(X, [[1.,2.,0.],[3.,4.,0.]])
+
+    # Boolean and packed masks give the same result
+    for M_other in [M != 0, PackedMask(M)]:
+        kmeans = KMeans(X,M_other,2)
+        assert numpy.array_equal(kmeans.X, [[1.,2.],[0.,4.]])
+        assert numpy.array_equal(kmeans.M, [[1.,1.],[0.,1.]])
+
+
+""" Test computing the distances to all centroids, using only the coordinates known for both """
+def test_compute_MSEs():
+    X = numpy.array([[1.,2.,3.],[4.,5.,6.]])
+    M = numpy.array([[1,1,0],[1,0,1]])
+    kmeans = KMeans(X,M,2)
+    kmeans.centroids = numpy.array([[1.,1.,1.],[2.,2.,2.]])
+    kmeans.mask_centroids = numpy.array([[1.,1.,1.],[0.,1.,0.]])
+
+    MSEs = kmeans.compute_MSEs()
+    assert numpy.allclose(MSEs[0], [(0.+1.)/2., 0.])
+    assert MSEs[1,0] == pytest.approx((9.+25.)/2.)
+    assert MSEs[1,1] == numpy.inf
+
+
+""" Test assigning points and updating the centroids """
+def test_assignment_update():
+    X = numpy.array([[0.,0.],[0.,1.],[10.,10.],[10.,11.],[6.,100.]])
+    M = numpy.array([[1,1],[1,1],[1,1],[1,1],[1,0]])
+    kmeans = KMeans(X,M,2)
+    kmeans.initialise()
+    kmeans.centroids = numpy.array([[0.,0.],[10.,10.]])
+
+    assert kmeans.assignment()
+    assert numpy.array_equal(kmeans.cluster_assignments, [0,0,1,1,1])
+    assert numpy.allclose(kmeans.distances, [0.,0.5,0.,0.5,16.])
+    kmeans.update()
+    assert numpy.allclose(kmeans.centroids, [[0.,0.5],[26./3.,10.5]])
+    assert numpy.array_equal(kmeans.mask_centroids, numpy.ones((2,2)))
+    assert not kmeans.assignment()
+
+
+""" Test giving an empty cluster the point furthest away from its centroid """
+def test_update_singleton():
+    X = numpy.array([[0.,0.],[0.,1.],[10.,10.],[10.,11.]])
+    M = numpy.ones((4,2))
+    kmeans = KMeans(X,M,3)
+    kmeans.initialise()
+    kmeans.centroids = numpy.array([[0.,0.],[100.,100.],[10.,10.]])
+
+    kmeans.assignment()
+    assert numpy.array_equal(kmeans.cluster_assignments, [0,0,2,2])
+    kmeans.update()
+    assert numpy.array_equal(kmeans.cluster_assignments, [0,1,2,2])
+    assert numpy.array_equal(kmeans.centroids, [[0.,0.],[0.,1.],[10.,10.5]])
+
+
+""" Test the full clustering """
+def test_cluster():
+    numpy.random.seed(0)
+    X = numpy.vstack([numpy.random.rand(10,4), 10+numpy.random.rand(10,4)])
+    M = numpy.ones((20,4))
+    M[0,0], M[15,3] = 0, 0
+    kmeans = KMeans(X,M,2)
+    kmeans.initialise(seed=1)
+    kmeans.cluster()
+
+    assert kmeans.clustering_results.shape == (20,2)
+    assert numpy.array_equal(kmeans.clustering_results.sum(axis=1), numpy.ones(20))
+    assert len(set(kmeans.cluster_assignments[:10])) == 1 and len(set(kmeans.cluster_assignments[10:])) == 1
+    assert kmeans.cluster_assignments[0] != kmeans.cluster_assignments[10]
+
+
+""" Test k-means++ seeding, which picks data points (with their masks) as the initial centroids """
+def test_initialise_kmeans_plus_plus():
+    X = numpy.array([[0.,0.],[0.,0.],[10.,10.],[10.,10.],[20.,-5.]])
+    M = numpy.array([[1,1],[1,1],[1,1],[1,1],[1,0]])
+    kmeans = KMeans(X,M,3)
+    with pytest.raises(AssertionError) as error:
+        kmeans.initialise(init='fail')
+    assert str(error.value) == "Unrecognised init option for KMeans: fail."
+
+    for seed in range(0,10):
+        kmeans.initialise(seed=seed,init='kmeans++')
+        centroids = [tuple(c) for c in kmeans.mask_centroids * kmeans.centroids]
+        assert len(set(centroids)) == 3
+        assert set(centroids) == set([(0.,0.),(10.,10.),(20.,0.)])
+
+
+""" Test that seeding the initialisation does not touch the global random state """
+def test_initialise_seed():
+    numpy.random.seed(0)
+    X = numpy.random.rand(10,3)
+    M = numpy.ones((10,3))
+    kmeans = KMeans(X,M,3)
+    for init in ['random','kmeans++']:
+        random.seed(5)
+        state = random.getstate()
+        kmeans.initialise(seed=1,init=init)
+        centroids = numpy.copy(kmeans.centroids)
+        assert random.getstate() == state
+        kmeans.initialise(seed=1,init=init)
+        assert numpy.array_equal(kmeans.centroids,centroids)
+
+
+""" Test running several seeds and keeping the clustering with the lowest distortion, sequentially and in parallel """
+def test_multistart_kmeans():
+    numpy.random.seed(0)
+    X = numpy.vstack([numpy.random.rand(10,4), 5+numpy.random.rand(10,4), 10+numpy.random.rand(10,4)])
+    M = (numpy.random.rand(30,4) < 0.8).astype(float)
+    M[:,0] = 1
+    seeds = range(0,6)
+
+    distortions = []
+    for seed in seeds:
+        kmeans = KMeans(X,M,3)
+        kmeans.initialise(seed=seed,init='random')
+        kmeans.cluster()
+        distortions.append(kmeans.distortion())
+
+    best = multistart_kmeans(X,M,3,seeds,init='random')
+    assert best.distortion() == min(distortions)
+    best_parallel = multistart_kmeans(X,M,3,seeds,init='random',P=2)
+    assert numpy.array_equal(best.clustering_results, best_parallel.clustering_results)
+
+    best = multistart_kmeans(X,M,3,seeds,init='kmeans++',P=2)
+    assert best.distortion() <= min(distortions)
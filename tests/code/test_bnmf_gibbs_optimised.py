@@ -6,7 +6,7 @@ project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, random
 from BNMTF.code.models.bnmf_gibbs_optimised import bnmf_gibbs_optimised
 
 
@@ -152,6 +152,27 @@ alpha, beta = 3, 1
 priors = { 'alpha':alpha, 'beta':beta, 'lambdaU':lambdaU, 'lambdaV':lambdaV }
 init = 'exp' #U=1/2,V=1/3
 
+""" Test the random initialisation with a seed """
+def test_initialise_seed():
+    I,J,K = 5,3,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    numpy.random.seed(0)
+    state = numpy.random.get_state()
+    BNMF1 = bnmf_gibbs_optimised(R,M,K,priors,seed=1)
+    BNMF1.initialise(init='random')
+    BNMF2 = bnmf_gibbs_optimised(R,M,K,priors,seed=1)
+    BNMF2.initialise(init='random')
+    BNMF3 = bnmf_gibbs_optimised(R,M,K,priors,seed=2)
+    BNMF3.initialise(init='random')
+    assert numpy.array_equal(numpy.random.get_state()[1], state[1])
+    for name in ['U','V']:
+        assert numpy.array_equal(getattr(BNMF1,name), getattr(BNMF2,name))
+        assert not numpy.array_equal(getattr(BNMF1,name), getattr(BNMF3,name))
+    
+    
 def test_alpha_s():
     BNMF = bnmf_gibbs_optimised(R,M,K,priors)
     BNMF.initialise(init)
@@ -236,6 +257,49 @@ def test_run():
     assert taus[1] != alpha/float(beta)
     
     
+""" Test giving the burn-in and thinning to run, storing only the retained samples or their sums """
+def test_run_burn_in_thinning():
+    I,J,K = 10,5,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    iterations, burn_in, thinning = 15, 5, 2
+    
+    expectations = []
+    for kwargs in [{},{'burn_in':burn_in,'thinning':thinning},{'burn_in':burn_in,'thinning':thinning,'running_sums':True}]:
+        BNMF = bnmf_gibbs_optimised(R,M,K,priors)
+        numpy.random.seed(0)
+        BNMF.initialise('random')
+        BNMF.run(iterations,**kwargs)
+        expectations.append(BNMF.approx_expectation(burn_in,thinning))
+        
+    assert BNMF.all_U is None
+    for expectation in expectations[1:]:
+        for exp_full,exp in zip(expectations[0],expectation):
+            assert numpy.allclose(exp_full,exp)
+    
+    
+""" Test running in single precision """
+def test_run_float32():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    iterations = 10
+    
+    BNMF = bnmf_gibbs_optimised(R,M,K,priors,dtype=numpy.float32)
+    BNMF.initialise()
+    (Us,Vs,taus) = BNMF.run(iterations,burn_in=2,thinning=2)
+    assert BNMF.R.dtype == numpy.float32 and BNMF.M.dtype == numpy.float32
+    assert BNMF.U.dtype == numpy.float32 and BNMF.V.dtype == numpy.float32
+    assert Us.dtype == numpy.float32 and Vs.dtype == numpy.float32
+    (exp_U,exp_V,exp_tau) = BNMF.approx_expectation(2,2)
+    assert numpy.all(numpy.isfinite(exp_U)) and numpy.all(numpy.isfinite(exp_V)) and exp_tau > 0
+    
+    
 """ Test approximating the expectations for U, V, tau """
 def test_approx_expectation():
     burn_in = 2
@@ -357,4 +421,67 @@ def test_log_likelihood():
     assert MSE == BNMF.quality('MSE',burnin,thinning)
     with pytest.raises(AssertionError) as error:
         BNMF.quality('FAIL',burnin,thinning)
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+
+    
+""" Test warm starting from a model with more or fewer factors """
+def test_warm_start():
+    I,J = 5,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    BNMF2 = bnmf_gibbs_optimised(R,M,2,priors,seed=0)
+    BNMF2.initialise(init='random')
+    BNMF2.run(iterations=2)
+    for K in [1,3]:
+        BNMF = bnmf_gibbs_optimised(R,M,K,priors,seed=1)
+        BNMF.initialise(init='random')
+        fresh = { name : numpy.copy(getattr(BNMF,name)) for name in ['U','V'] }
+        BNMF.warm_start(BNMF2)
+        for name in fresh:
+            assert numpy.array_equal(getattr(BNMF,name)[:,:min(K,2)], getattr(BNMF2,name)[:,:min(K,2)])
+            assert numpy.array_equal(getattr(BNMF,name)[:,2:], fresh[name][:,2:])
+        BNMF.run(iterations=2)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K = 5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        BNMF = bnmf_gibbs_optimised(R,M,K,priors,seed=2)
+        BNMF.initialise(init='random')
+        BNMF.run(iterations=10,checkpoint=checkpoint,checkpoint_every=3)
+        return BNMF
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    BNMF, BNMF_checkpoint = run(), run(checkpoint)
+    assert BNMF.all_performances == BNMF_checkpoint.all_performances
+    BNMF_state = bnmf_gibbs_optimised(R,M,K,priors,seed=2)
+    BNMF_state.load_state(checkpoint)
+    assert BNMF_state.iteration == 9
+    assert len(BNMF_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    BNMF_resumed = run(checkpoint)
+    assert BNMF_resumed.iteration == 10
+    assert len(BNMF_resumed.all_times) == 10
+    assert BNMF_resumed.all_performances == BNMF.all_performances
+    for name in ['U','V','tau']:
+        assert numpy.array_equal(getattr(BNMF_resumed,name), getattr(BNMF,name))
+    assert numpy.array_equal(BNMF_resumed.approx_expectation(2,1)[0], BNMF.approx_expectation(2,1)[0])
+    
+    # The checkpoint is for a run of 10 iterations
+    with pytest.raises(AssertionError) as error:
+        BNMF_resumed.run(iterations=12,checkpoint=checkpoint)
+    assert str(error.value) == "Checkpoint %s is for a run of 10 iterations, not 12." % checkpoint
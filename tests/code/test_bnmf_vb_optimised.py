@@ -8,6 +8,7 @@ sys.path.append(project_location)
 
 import numpy, math, pytest, itertools, random
 from BNMTF.code.models.bnmf_vb_optimised import bnmf_vb_optimised
+from BNMTF.code.cross_validation.packed_mask import PackedMask
 
 
 """ Test constructor """
@@ -156,6 +157,27 @@ def test_initialise():
         assert BNMF.tauV[j,k] == 3.
     
         
+""" Test the random initialisation with a seed """
+def test_initialise_seed():
+    I,J,K = 5,3,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    numpy.random.seed(0)
+    state = numpy.random.get_state()
+    BNMF1 = bnmf_vb_optimised(R,M,K,priors,seed=1)
+    BNMF1.initialise(init='random')
+    BNMF2 = bnmf_vb_optimised(R,M,K,priors,seed=1)
+    BNMF2.initialise(init='random')
+    BNMF3 = bnmf_vb_optimised(R,M,K,priors,seed=2)
+    BNMF3.initialise(init='random')
+    assert numpy.array_equal(numpy.random.get_state()[1], state[1])
+    for name in ['muU','muV']:
+        assert numpy.array_equal(getattr(BNMF1,name), getattr(BNMF2,name))
+        assert not numpy.array_equal(getattr(BNMF1,name), getattr(BNMF3,name))
+    
+    
 """ Test computing the ELBO. """
 def test_elbo():
     I,J,K = 5,3,2
@@ -345,6 +367,76 @@ def test_run():
     assert BNMF.explogtau != numpy.inf and not math.isnan(BNMF.explogtau)
     
 
+""" Test stopping early when the ELBO converges, and only monitoring every N iterations """
+def test_run_stop():
+    I,J,K = 6,4,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    iterations = 200
+    
+    BNMF = bnmf_vb_optimised(R,M,K,priors)
+    BNMF.initialise()
+    BNMF.run(iterations,stop='elbo',tolerance=1e-4,monitor_every=5)
+    assert BNMF.converged and len(BNMF.all_exp_tau) < iterations
+    assert BNMF.all_monitored == range(5,len(BNMF.all_exp_tau)+1,5)
+    assert abs(BNMF.all_elbo[-1] - BNMF.all_elbo[-2]) <= 1e-4 * abs(BNMF.all_elbo[-2])
+    
+    
+""" Test running in single precision """
+def test_run_float32():
+    I,J,K = 6,4,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0] = 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    BNMF = bnmf_vb_optimised(R,M,K,priors)
+    BNMF.initialise()
+    BNMF.run(10)
+    
+    BNMF_32 = bnmf_vb_optimised(R,M,K,priors,dtype=numpy.float32)
+    BNMF_32.initialise()
+    BNMF_32.run(10)
+    for name in ['R','M','lambdaU','muU','tauU','expU','varU','muV','tauV','expV','varV']:
+        assert getattr(BNMF_32,name).dtype == numpy.float32
+    assert numpy.allclose(BNMF.expU, BNMF_32.expU, rtol=1e-3)
+    assert numpy.allclose(BNMF.expV, BNMF_32.expV, rtol=1e-3)
+    assert numpy.isclose(BNMF.elbo(), BNMF_32.elbo(), rtol=1e-4)
+    
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb_optimised(R,M,K,priors,dtype=int)
+    assert str(error.value) == "Unsupported dtype: int64. Should be float32 or float64."
+    
+
+""" Test running with a memory-mapped R, which is not copied, and a packed mask """
+def test_run_packed_mask(tmpdir):
+    I,J,K = 6,4,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[3,2] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    filename = str(tmpdir.join('R.npy'))
+    numpy.save(filename,R)
+    R_memmap = numpy.load(filename,mmap_mode='r')
+    
+    BNMF = bnmf_vb_optimised(R,M,K,priors)
+    BNMF.initialise()
+    BNMF.run(10)
+    
+    BNMF_packed = bnmf_vb_optimised(R_memmap,PackedMask(M),K,priors)
+    assert numpy.may_share_memory(BNMF_packed.R,R_memmap)
+    assert numpy.array_equal(BNMF_packed.M,M)
+    BNMF_packed.initialise()
+    BNMF_packed.run(10)
+    assert numpy.array_equal(BNMF.expU, BNMF_packed.expU)
+    assert numpy.array_equal(BNMF.expV, BNMF_packed.expV)
+    assert BNMF.predict(1-M) == BNMF_packed.predict(PackedMask(M).complement())
+    
+    
 """ Test computing the performance of the predictions using the expectations """
 def test_predict():
     (I,J,K) = (5,3,2)
@@ -426,4 +518,62 @@ def test_log_likelihood():
     assert MSE == BNMF.quality('MSE')
     with pytest.raises(AssertionError) as error:
         BNMF.quality('FAIL')
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+
+    
+""" Test warm starting from a model with more or fewer factors """
+def test_warm_start():
+    I,J = 5,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    BNMF2 = bnmf_vb_optimised(R,M,2,priors,seed=0)
+    BNMF2.initialise(init='random')
+    BNMF2.run(iterations=2)
+    for K in [1,3]:
+        BNMF = bnmf_vb_optimised(R,M,K,priors,seed=1)
+        BNMF.initialise(init='random')
+        fresh = { name : numpy.copy(getattr(BNMF,name)) for name in ['muU','tauU','muV','tauV'] }
+        BNMF.warm_start(BNMF2)
+        for name in fresh:
+            assert numpy.array_equal(getattr(BNMF,name)[:,:min(K,2)], getattr(BNMF2,name)[:,:min(K,2)])
+            assert numpy.array_equal(getattr(BNMF,name)[:,2:], fresh[name][:,2:])
+        BNMF.run(iterations=2)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K = 5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        BNMF = bnmf_vb_optimised(R,M,K,priors,seed=2)
+        BNMF.initialise(init='random')
+        BNMF.run(iterations=10,checkpoint=checkpoint,checkpoint_every=3)
+        return BNMF
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    BNMF, BNMF_checkpoint = run(), run(checkpoint)
+    assert BNMF.all_performances == BNMF_checkpoint.all_performances
+    BNMF_state = bnmf_vb_optimised(R,M,K,priors,seed=2)
+    BNMF_state.load_state(checkpoint)
+    assert BNMF_state.iteration == 9
+    assert len(BNMF_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    BNMF_resumed = run(checkpoint)
+    assert BNMF_resumed.iteration == 10
+    assert len(BNMF_resumed.all_times) == 10
+    assert BNMF_resumed.all_performances == BNMF.all_performances
+    for name in ['muU','tauU','muV','tauV','exptau']:
+        assert numpy.array_equal(getattr(BNMF_resumed,name), getattr(BNMF,name))
+    assert BNMF_resumed.all_elbo == BNMF.all_elbo
@@ -0,0 +1,128 @@
+"""
+Tests for the BNMF Variational Bayes algorithm training multiple restarts at once.
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+import numpy, pytest, random
+from BNMTF.code.models.bnmf_vb_optimised import bnmf_vb_optimised
+from BNMTF.code.models.bnmf_vb_optimised_batch import bnmf_vb_optimised_batch
+
+
+""" Test constructor """
+def test_init():
+    I,J,K = 5,3,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb_optimised_batch(R,M,K,priors,0)
+    assert str(error.value) == "Need at least 1 restart."
+    
+    M[0,:] = 0
+    with pytest.raises(AssertionError) as error:
+        bnmf_vb_optimised_batch(R,M,K,priors,2)
+    assert str(error.value) == "Fully unobserved row in R, row 0."
+    
+    M = numpy.ones((I,J))
+    BNMF = bnmf_vb_optimised_batch(R,M,K,priors,4)
+    assert BNMF.restarts == 4
+    assert numpy.array_equal(BNMF.lambdaU, 2*numpy.ones((I,K)))
+    assert numpy.array_equal(BNMF.lambdaV, 3*numpy.ones((J,K)))
+    
+    BNMF = bnmf_vb_optimised_batch(R,M,K,priors,4,dtype=numpy.float32)
+    BNMF.initialise()
+    BNMF.run(2)
+    for name in ['R','M','muU','tauU','expU','varU','muV','tauV','expV','varV']:
+        assert getattr(BNMF,name).dtype == numpy.float32
+    assert BNMF.best().expU.dtype == numpy.float32
+    
+    
+""" Test that training the restarts at once gives the same results as training them one after another """
+def test_run():
+    I,J,K = 8,6,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[3,2], M[7,5] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    restarts, iterations = 3, 10
+    
+    numpy.random.seed(1)
+    batch = bnmf_vb_optimised_batch(R,M,K,priors,restarts)
+    batch.initialise(init='random')
+    batch.run(iterations)
+    
+    numpy.random.seed(1)
+    for r in range(0,restarts):
+        BNMF = bnmf_vb_optimised(R,M,K,priors)
+        BNMF.initialise(init='random')
+        BNMF.run(iterations)
+        
+        restart = batch.restart(r)
+        for name in ['muU','tauU','expU','varU','muV','tauV','expV','varV']:
+            assert numpy.allclose(getattr(BNMF,name), getattr(restart,name))
+        assert numpy.isclose(BNMF.exptau, restart.exptau)
+        assert numpy.isclose(BNMF.explogtau, restart.explogtau)
+        assert numpy.isclose(BNMF.elbo(), batch.elbo()[r])
+        assert numpy.isclose(BNMF.log_likelihood(), batch.log_likelihood()[r])
+        assert numpy.allclose(BNMF.all_exp_tau, restart.all_exp_tau)
+        for metric in ['MSE','R^2','Rp']:
+            assert numpy.allclose(BNMF.all_performances[metric], restart.all_performances[metric])
+    
+    
+""" Test returning the restart with the highest log likelihood """
+def test_best():
+    I,J,K = 8,6,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    BNMF = bnmf_vb_optimised_batch(R,M,K,priors,4)
+    BNMF.initialise(init='random')
+    BNMF.run(3)
+    
+    log_likelihoods = BNMF.log_likelihood()
+    best = BNMF.best()
+    assert isinstance(best, bnmf_vb_optimised)
+    assert best.quality('loglikelihood') == log_likelihoods.max()
+    assert [restart.quality('loglikelihood') for restart in BNMF.all_restarts()] == list(log_likelihoods)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K,restarts = 5,3,2,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        batch = bnmf_vb_optimised_batch(R,M,K,priors,restarts,seed=2)
+        batch.initialise(init='random')
+        batch.run(iterations=10,checkpoint=checkpoint,checkpoint_every=3)
+        return batch
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    batch, batch_checkpoint = run(), run(checkpoint)
+    assert numpy.array_equal(batch.all_performances['MSE'], batch_checkpoint.all_performances['MSE'])
+    batch_state = bnmf_vb_optimised_batch(R,M,K,priors,restarts,seed=2)
+    batch_state.load_state(checkpoint)
+    assert batch_state.iteration == 9
+    assert len(batch_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    batch_resumed = run(checkpoint)
+    assert batch_resumed.iteration == 10
+    assert len(batch_resumed.all_times) == 10
+    assert numpy.array_equal(batch_resumed.all_performances['MSE'], batch.all_performances['MSE'])
+    for name in ['muU','tauU','muV','tauV','exptau']:
+        assert numpy.array_equal(getattr(batch_resumed,name), getattr(batch,name))
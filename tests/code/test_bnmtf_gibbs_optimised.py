@@ -6,7 +6,7 @@ project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, random
 from BNMTF.code.models.bnmtf_gibbs_optimised import bnmtf_gibbs_optimised
 
 
@@ -199,6 +199,27 @@ init_S, init_FG = 'exp', 'exp'
 # F = 1/2, S = 1/3, G = 1/5
 # R - FSG.T = [[1]] - [[4/15]] = [[11/15]]
 
+""" Test the random initialisation with a seed """
+def test_initialise_seed():
+    I,J,K,L = 5,3,2,4
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    numpy.random.seed(0)
+    state = numpy.random.get_state()
+    BNMTF1 = bnmtf_gibbs_optimised(R,M,K,L,priors,seed=1)
+    BNMTF1.initialise(init_S='random',init_FG='random')
+    BNMTF2 = bnmtf_gibbs_optimised(R,M,K,L,priors,seed=1)
+    BNMTF2.initialise(init_S='random',init_FG='random')
+    BNMTF3 = bnmtf_gibbs_optimised(R,M,K,L,priors,seed=2)
+    BNMTF3.initialise(init_S='random',init_FG='random')
+    assert numpy.array_equal(numpy.random.get_state()[1], state[1])
+    for name in ['F','S','G']:
+        assert numpy.array_equal(getattr(BNMTF1,name), getattr(BNMTF2,name))
+        assert not numpy.array_equal(getattr(BNMTF1,name), getattr(BNMTF3,name))
+    
+    
 def test_alpha_s():
     BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors)
     BNMTF.initialise(init_S,init_FG)
@@ -312,6 +333,102 @@ def test_run():
     assert taus[1] != alpha/float(beta)
     
     
+""" Test that caching the residual gives the same draws for a fixed seed """
+def test_run_cache_residual():
+    I,J,K,L = 10,5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    iterations = 5 # rounding differences slowly grow over the iterations
+    
+    BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    numpy.random.seed(1)
+    BNMTF.initialise('random','random')
+    (Fs,Ss,Gs,taus) = BNMTF.run(iterations)
+    
+    BNMTF_cache = bnmtf_gibbs_optimised(R,M,K,L,priors,cache_residual=True)
+    numpy.random.seed(1)
+    BNMTF_cache.initialise('random','random')
+    (Fs_cache,Ss_cache,Gs_cache,taus_cache) = BNMTF_cache.run(iterations)
+    
+    assert numpy.allclose(Fs,Fs_cache)
+    assert numpy.allclose(Ss,Ss_cache)
+    assert numpy.allclose(Gs,Gs_cache)
+    assert numpy.allclose(taus,taus_cache)
+    assert numpy.allclose(BNMTF_cache.residual, M*(R-numpy.dot(BNMTF_cache.F,numpy.dot(BNMTF_cache.S,BNMTF_cache.G.T))))
+    
+    
+""" Test that drawing S in one block gives the same draws for a fixed seed """
+def test_run_block_S():
+    I,J,K,L = 10,5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    iterations = 5 
+    
+    BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    numpy.random.seed(1)
+    BNMTF.initialise('random','random')
+    draws = BNMTF.run(iterations)
+    
+    BNMTF_block = bnmtf_gibbs_optimised(R,M,K,L,priors,block_S=True)
+    numpy.random.seed(1)
+    BNMTF_block.initialise('random','random')
+    draws_block = BNMTF_block.run(iterations)
+    
+    for values,values_block in zip(draws,draws_block):
+        assert numpy.allclose(values,values_block)
+    
+    
+""" Test giving the burn-in and thinning to run, storing only the retained samples of F, S, G, tau or their sums """
+def test_run_burn_in_thinning():
+    I,J,K,L = 10,5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    iterations, burn_in, thinning = 15, 5, 2
+    
+    expectations = []
+    for kwargs in [{},{'burn_in':burn_in,'thinning':thinning},{'burn_in':burn_in,'thinning':thinning,'running_sums':True}]:
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors)
+        numpy.random.seed(0)
+        BNMTF.initialise('random','random')
+        BNMTF.run(iterations,**kwargs)
+        expectations.append(BNMTF.approx_expectation(burn_in,thinning))
+        
+    assert BNMTF.all_F is None and BNMTF.all_S is None and BNMTF.all_G is None
+    for expectation in expectations[1:]:
+        for exp_full,exp in zip(expectations[0],expectation):
+            assert numpy.allclose(exp_full,exp)
+    
+    
+""" Test running in single precision """
+def test_run_float32():
+    I,J,K,L = 10,5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    iterations = 10
+    
+    for cache_residual in [False,True]:
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors,cache_residual=cache_residual,dtype=numpy.float32)
+        BNMTF.initialise('random','random')
+        (Fs,Ss,Gs,taus) = BNMTF.run(iterations)
+        for name in ['R','M','F','S','G']:
+            assert getattr(BNMTF,name).dtype == numpy.float32
+        assert Fs.dtype == numpy.float32 and Ss.dtype == numpy.float32 and Gs.dtype == numpy.float32
+        (exp_F,exp_S,exp_G,exp_tau) = BNMTF.approx_expectation(2,2)
+        assert numpy.all(numpy.isfinite(exp_F)) and numpy.all(numpy.isfinite(exp_S)) and numpy.all(numpy.isfinite(exp_G))
+    
+    
 """ Test approximating the expectations for F, S, G, tau """
 def test_approx_expectation():
     burn_in = 2
@@ -445,4 +562,65 @@ def test_log_likelihood():
     assert MSE == BNMTF.quality('MSE',burnin,thinning)
     with pytest.raises(AssertionError) as error:
         BNMTF.quality('FAIL',burnin,thinning)
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+
+    
+""" Test warm starting from a model with more or fewer row and column clusters """
+def test_warm_start():
+    I,J = 5,4
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    BNMTF2 = bnmtf_gibbs_optimised(R,M,2,2,priors,seed=0)
+    BNMTF2.initialise(init_S='random',init_FG='random')
+    BNMTF2.run(iterations=2)
+    for (K,L) in [(1,3),(3,1),(3,3)]:
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors,seed=1)
+        BNMTF.initialise(init_S='random',init_FG='random')
+        fresh = { name : numpy.copy(getattr(BNMTF,name)) for name in ['F','S','G'] }
+        BNMTF.warm_start(BNMTF2)
+        for name in fresh:
+            (rows,columns) = {'F':(I,min(K,2)),'S':(min(K,2),min(L,2)),'G':(J,min(L,2))}[name[-1]]
+            new = getattr(BNMTF,name)
+            assert numpy.array_equal(new[:rows,:columns], getattr(BNMTF2,name)[:rows,:columns])
+            if name[-1] in ['F','G']:
+                assert numpy.array_equal(new[:,columns:], fresh[name][:,columns:])
+        BNMTF.run(iterations=2)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K,L = 5,3,2,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors,cache_residual=True,seed=2)
+        BNMTF.initialise('random','random')
+        BNMTF.run(iterations=10,checkpoint=checkpoint,checkpoint_every=3)
+        return BNMTF
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    BNMTF, BNMTF_checkpoint = run(), run(checkpoint)
+    assert BNMTF.all_performances == BNMTF_checkpoint.all_performances
+    BNMTF_state = bnmtf_gibbs_optimised(R,M,K,L,priors,cache_residual=True,seed=2)
+    BNMTF_state.load_state(checkpoint)
+    assert BNMTF_state.iteration == 9
+    assert len(BNMTF_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    BNMTF_resumed = run(checkpoint)
+    assert BNMTF_resumed.iteration == 10
+    assert len(BNMTF_resumed.all_times) == 10
+    assert BNMTF_resumed.all_performances == BNMTF.all_performances
+    for name in ['F','S','G','tau']:
+        assert numpy.array_equal(getattr(BNMTF_resumed,name), getattr(BNMTF,name))
+    assert numpy.array_equal(BNMTF_resumed.approx_expectation(2,1)[0], BNMTF.approx_expectation(2,1)[0])
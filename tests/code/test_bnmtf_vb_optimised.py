@@ -6,7 +6,7 @@ project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, random
 from BNMTF.code.models.bnmtf_vb_optimised import bnmtf_vb_optimised
 
 
@@ -206,6 +206,12 @@ def test_initialise():
         assert BNMTF.tauS[k,l] == 1.
         assert BNMTF.muS[k,l] == 1./lambdaS[k,l]
         
+    # Initialisation of F and G using Kmeans with k-means++ seeding
+    BNMTF = bnmtf_vb_optimised(R,M,K,L,priors,seed=0)
+    BNMTF.initialise('exp','kmeans++')
+    assert numpy.array_equal(BNMTF.muF.sum(axis=1), numpy.ones(I))
+    assert numpy.array_equal(BNMTF.muG.sum(axis=1), numpy.ones(J))
+    
     # Initialise tauF, tauS, tauG using predefined values
     tauFSG = {
         'tauF' : 2*numpy.ones((I,K)),
@@ -224,6 +230,27 @@ def test_initialise():
         assert BNMTF.tauG[j,l] == 4.
         
         
+""" Test the random initialisation with a seed """
+def test_initialise_seed():
+    I,J,K,L = 5,3,2,4
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    numpy.random.seed(0)
+    state = numpy.random.get_state()
+    BNMTF1 = bnmtf_vb_optimised(R,M,K,L,priors,seed=1)
+    BNMTF1.initialise(init_S='random',init_FG='random')
+    BNMTF2 = bnmtf_vb_optimised(R,M,K,L,priors,seed=1)
+    BNMTF2.initialise(init_S='random',init_FG='random')
+    BNMTF3 = bnmtf_vb_optimised(R,M,K,L,priors,seed=2)
+    BNMTF3.initialise(init_S='random',init_FG='random')
+    assert numpy.array_equal(numpy.random.get_state()[1], state[1])
+    for name in ['muF','muS','muG']:
+        assert numpy.array_equal(getattr(BNMTF1,name), getattr(BNMTF2,name))
+        assert not numpy.array_equal(getattr(BNMTF1,name), getattr(BNMTF3,name))
+    
+    
 """ Test computing the ELBO. """
 def test_elbo():
     I,J,K,L = 5,3,2,4
@@ -515,6 +542,166 @@ def test_run():
     assert BNMF.explogtau != numpy.inf and not math.isnan(BNMF.explogtau)
     
 
+""" Test that the sparse (Omega only) updates give the same values as the dense ones. """
+def test_sparse():
+    I,J,K,L = 6,4,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1], M[5,3] = 0, 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    BNMTF_dense = bnmtf_vb_optimised(R,M,K,L,priors)
+    BNMTF_sparse = bnmtf_vb_optimised(R,M,K,L,priors,sparse=True)
+    assert numpy.array_equal(BNMTF_sparse.R_omega, R[M == 1])
+    assert BNMTF_sparse.R is R and not hasattr(BNMTF_sparse,'M')
+    assert BNMTF_sparse.size_Omega == BNMTF_dense.size_Omega
+    
+    for BNMTF in [BNMTF_dense,BNMTF_sparse]:
+        numpy.random.seed(1)
+        BNMTF.initialise(init_S='random',init_FG='random')
+        BNMTF.varF = numpy.random.rand(I,K)
+        BNMTF.varS = numpy.random.rand(K,L)
+        BNMTF.varG = numpy.random.rand(J,L)
+        
+    assert abs(BNMTF_dense.exp_square_diff() - BNMTF_sparse.exp_square_diff()) < 0.000000001
+    for k in range(0,K):
+        BNMTF_dense.update_F(k), BNMTF_sparse.update_F(k)
+    for k,l in itertools.product(xrange(0,K),xrange(0,L)):
+        BNMTF_dense.update_S(k,l), BNMTF_sparse.update_S(k,l)
+    for l in range(0,L):
+        BNMTF_dense.update_G(l), BNMTF_sparse.update_G(l)
+    for name in ['tauF','muF','tauS','muS','tauG','muG']:
+        assert numpy.allclose(getattr(BNMTF_dense,name), getattr(BNMTF_sparse,name))
+    
+    M_test = numpy.zeros((I,J))
+    M_test[0,0], M_test[2,2], M_test[4,1] = 1, 1, 1
+    performances_dense, performances_sparse = BNMTF_dense.predict(M_test), BNMTF_sparse.predict(M_test)
+    for metric in ['MSE','R^2','Rp']:
+        assert abs(performances_dense[metric] - performances_sparse[metric]) < 0.000000001
+    for metric in ['loglikelihood','MSE','ELBO']:
+        assert abs(BNMTF_dense.quality(metric) - BNMTF_sparse.quality(metric)) < 0.000001
+        
+    # The KMeans initialisation and the checks for empty rows also work without M
+    for BNMTF in [BNMTF_dense,BNMTF_sparse]:
+        BNMTF.initialise(init_S='exp',init_FG='kmeans',kmeans_seeds=[2])
+    assert numpy.array_equal(BNMTF_dense.muF, BNMTF_sparse.muF) and numpy.array_equal(BNMTF_dense.muG, BNMTF_sparse.muG)
+    M[1] = 0
+    with pytest.raises(AssertionError) as error:
+        bnmtf_vb_optimised(R,M,K,L,priors,sparse=True)
+    assert str(error.value) == "Fully unobserved row in R, row 1."
+    
+    
+""" Test that caching the residual gives the same updates, and keeps the residual up to date """
+def test_cache_residual():
+    I,J,K,L = 6,4,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1], M[5,3] = 0, 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    BNMTFs = [
+        bnmtf_vb_optimised(R,M,K,L,priors),
+        bnmtf_vb_optimised(R,M,K,L,priors,cache_residual=True),
+        bnmtf_vb_optimised(R,M,K,L,priors,sparse=True,cache_residual=True)
+    ]
+    for BNMTF in BNMTFs:
+        numpy.random.seed(1)
+        random.seed(1)
+        BNMTF.initialise(init_S='random',init_FG='random')
+        BNMTF.run(iterations=5)
+        
+    for BNMTF in BNMTFs[1:]:
+        for name in ['expF','varF','expS','varS','expG','varG','exptau']:
+            assert numpy.allclose(getattr(BNMTFs[0],name), getattr(BNMTF,name))
+        assert abs(BNMTFs[0].quality('ELBO') - BNMTF.quality('ELBO')) < 0.000001
+        
+        exp_residual = numpy.copy(BNMTF.exp_residual)
+        BNMTF.update_residual()
+        assert numpy.allclose(exp_residual, BNMTF.exp_residual)
+    
+    
+""" Test that updating S in one block gives the same updates as one entry at a time """
+def test_block_S():
+    I,J,K,L = 6,4,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1], M[5,3] = 0, 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    BNMTFs = [
+        bnmtf_vb_optimised(R,M,K,L,priors),
+        bnmtf_vb_optimised(R,M,K,L,priors,block_S=True),
+        bnmtf_vb_optimised(R,M,K,L,priors,sparse=True,cache_residual=True,block_S=True)
+    ]
+    for BNMTF in BNMTFs:
+        numpy.random.seed(1)
+        random.seed(1)
+        BNMTF.initialise(init_S='random',init_FG='random')
+        BNMTF.run(iterations=5)
+        
+    for BNMTF in BNMTFs[1:]:
+        for name in ['muS','tauS','expS','varS','expF','expG','exptau']:
+            assert numpy.allclose(getattr(BNMTFs[0],name), getattr(BNMTF,name))
+    
+    
+""" Test stopping early when the ELBO or tau converge, and only monitoring every N iterations """
+def test_run_stop():
+    I,J,K,L = 6,4,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    iterations = 200
+    
+    BNMTF = bnmtf_vb_optimised(R,M,K,L,priors)
+    BNMTF.initialise(init_S='random',init_FG='random')
+    BNMTF.run(iterations,monitor_every=7)
+    assert BNMTF.all_monitored == range(7,iterations+1,7) + [iterations]
+    assert len(BNMTF.all_elbo) == len(BNMTF.all_monitored) and len(BNMTF.all_performances['MSE']) == len(BNMTF.all_monitored)
+    assert len(BNMTF.all_exp_tau) == iterations and len(BNMTF.all_times) == iterations
+    assert not BNMTF.converged
+    
+    for stop in ['elbo','tau']:
+        BNMTF.initialise(init_S='random',init_FG='random')
+        BNMTF.run(iterations,stop=stop,tolerance=1e-4)
+        assert BNMTF.converged and len(BNMTF.all_exp_tau) < iterations
+        assert BNMTF.all_monitored[-1] == len(BNMTF.all_exp_tau)
+    assert abs(BNMTF.all_exp_tau[-1] - BNMTF.all_exp_tau[-2]) <= 1e-4 * BNMTF.all_exp_tau[-2]
+    
+    with pytest.raises(AssertionError):
+        BNMTF.run(iterations,stop='mse')
+    
+    
+""" Test running in single precision, with dense and sparse matrices """
+def test_run_float32():
+    I,J,K,L = 6,4,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[3,2] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    BNMTF = bnmtf_vb_optimised(R,M,K,L,priors)
+    BNMTF.initialise(init_S='exp',init_FG='exp')
+    random.seed(1)
+    BNMTF.run(10)
+    
+    for sparse in [False,True]:
+        BNMTF_32 = bnmtf_vb_optimised(R,M,K,L,priors,sparse=sparse,dtype=numpy.float32)
+        BNMTF_32.initialise(init_S='exp',init_FG='exp')
+        random.seed(1)
+        BNMTF_32.run(10)
+        names = ['R_omega'] if sparse else ['R','M']
+        for name in names + ['muF','tauF','expF','varF','muS','tauS','expS','varS','muG','tauG','expG','varG']:
+            assert getattr(BNMTF_32,name).dtype == numpy.float32
+        for name in ['expF','expS','expG']:
+            assert numpy.allclose(getattr(BNMTF,name), getattr(BNMTF_32,name), rtol=1e-3)
+        assert numpy.isclose(BNMTF.elbo(), BNMTF_32.elbo(), rtol=1e-4)
+    
+    
 """ Test computing the performance of the predictions using the expectations """
 def test_predict():
     (I,J,K) = (5,3,2)
@@ -602,4 +789,65 @@ def test_log_likelihood():
     assert MSE == BNMTF.quality('MSE')
     with pytest.raises(AssertionError) as error:
         BNMTF.quality('FAIL')
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+
+    
+""" Test warm starting from a model with more or fewer row and column clusters """
+def test_warm_start():
+    I,J = 5,4
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    BNMTF2 = bnmtf_vb_optimised(R,M,2,2,priors,seed=0)
+    BNMTF2.initialise(init_S='random',init_FG='random')
+    BNMTF2.run(iterations=2)
+    for (K,L) in [(1,3),(3,1),(3,3)]:
+        BNMTF = bnmtf_vb_optimised(R,M,K,L,priors,seed=1)
+        BNMTF.initialise(init_S='random',init_FG='random')
+        fresh = { name : numpy.copy(getattr(BNMTF,name)) for name in ['muF','tauF','muS','tauS','muG','tauG'] }
+        BNMTF.warm_start(BNMTF2)
+        for name in fresh:
+            (rows,columns) = {'F':(I,min(K,2)),'S':(min(K,2),min(L,2)),'G':(J,min(L,2))}[name[-1]]
+            new = getattr(BNMTF,name)
+            assert numpy.array_equal(new[:rows,:columns], getattr(BNMTF2,name)[:rows,:columns])
+            if name[-1] in ['F','G']:
+                assert numpy.array_equal(new[:,columns:], fresh[name][:,columns:])
+        BNMTF.run(iterations=2)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K,L = 5,3,2,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        BNMTF = bnmtf_vb_optimised(R,M,K,L,priors)
+        BNMTF.initialise(init_S='random',init_FG='random')
+        BNMTF.run(iterations=10,checkpoint=checkpoint,checkpoint_every=3)
+        return BNMTF
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    BNMTF, BNMTF_checkpoint = run(), run(checkpoint)
+    assert BNMTF.all_performances == BNMTF_checkpoint.all_performances
+    BNMTF_state = bnmtf_vb_optimised(R,M,K,L,priors)
+    BNMTF_state.load_state(checkpoint)
+    assert BNMTF_state.iteration == 9
+    assert len(BNMTF_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    BNMTF_resumed = run(checkpoint)
+    assert BNMTF_resumed.iteration == 10
+    assert len(BNMTF_resumed.all_times) == 10
+    assert BNMTF_resumed.all_performances == BNMTF.all_performances
+    for name in ['muF','muS','muG','tauF','tauS','tauG','exptau']:
+        assert numpy.array_equal(getattr(BNMTF_resumed,name), getattr(BNMTF,name))
+    assert BNMTF_resumed.all_elbo == BNMTF.all_elbo
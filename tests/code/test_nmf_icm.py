@@ -6,7 +6,7 @@ project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, random
 from BNMTF.code.models.nmf_icm import nmf_icm
 
 
@@ -153,6 +153,27 @@ alpha, beta = 3, 1
 priors = { 'alpha':alpha, 'beta':beta, 'lambdaU':lambdaU, 'lambdaV':lambdaV }
 init = 'exp' #U=1/2,V=1/3
 
+""" Test the random initialisation with a seed """
+def test_initialise_seed():
+    I,J,K = 5,3,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    numpy.random.seed(0)
+    state = numpy.random.get_state()
+    NMF1 = nmf_icm(R,M,K,priors,seed=1)
+    NMF1.initialise(init='random')
+    NMF2 = nmf_icm(R,M,K,priors,seed=1)
+    NMF2.initialise(init='random')
+    NMF3 = nmf_icm(R,M,K,priors,seed=2)
+    NMF3.initialise(init='random')
+    assert numpy.array_equal(numpy.random.get_state()[1], state[1])
+    for name in ['U','V']:
+        assert numpy.array_equal(getattr(NMF1,name), getattr(NMF2,name))
+        assert not numpy.array_equal(getattr(NMF1,name), getattr(NMF3,name))
+    
+    
 def test_alpha_s():
     NMF = nmf_icm(R,M,K,priors)
     NMF.initialise(init)
@@ -227,6 +248,27 @@ def test_run():
     assert NMF.all_tau[1] != alpha/float(beta)
 
     
+""" Test running in single precision """
+def test_run_float32():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    NMF = nmf_icm(R,M,K,priors)
+    NMF.initialise('exp')
+    NMF.run(5)
+    
+    NMF_32 = nmf_icm(R,M,K,priors,dtype=numpy.float32)
+    NMF_32.initialise('exp')
+    NMF_32.run(5)
+    assert NMF_32.U.dtype == numpy.float32 and NMF_32.V.dtype == numpy.float32
+    assert numpy.allclose(NMF.U, NMF_32.U, rtol=1e-3, atol=1e-5)
+    assert numpy.allclose(NMF.V, NMF_32.V, rtol=1e-3, atol=1e-5)
+    
+    
 """ Test computing the performance of the predictions using the expectations """
 def test_predict():
     (I,J,K) = (5,3,2)
@@ -309,4 +351,61 @@ def test_log_likelihood():
     assert MSE == BNMF.quality('MSE')
     with pytest.raises(AssertionError) as error:
         BNMF.quality('FAIL')
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+
+    
+""" Test warm starting from a model with more or fewer factors """
+def test_warm_start():
+    I,J = 5,3
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    
+    NMF2 = nmf_icm(R,M,2,priors,seed=0)
+    NMF2.initialise(init='random')
+    NMF2.run(iterations=2)
+    for K in [1,3]:
+        NMF = nmf_icm(R,M,K,priors,seed=1)
+        NMF.initialise(init='random')
+        fresh = { name : numpy.copy(getattr(NMF,name)) for name in ['U','V'] }
+        NMF.warm_start(NMF2)
+        for name in fresh:
+            assert numpy.array_equal(getattr(NMF,name)[:,:min(K,2)], getattr(NMF2,name)[:,:min(K,2)])
+            assert numpy.array_equal(getattr(NMF,name)[:,2:], fresh[name][:,2:])
+        NMF.run(iterations=2)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K = 5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':0.1, 'lambdaV':0.1 }
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        NMF = nmf_icm(R,M,K,priors,seed=2)
+        NMF.initialise('random')
+        NMF.run(iterations=10,minimum_TN=0.1,checkpoint=checkpoint,checkpoint_every=3)
+        return NMF
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    NMF, NMF_checkpoint = run(), run(checkpoint)
+    assert NMF.all_performances == NMF_checkpoint.all_performances
+    NMF_state = nmf_icm(R,M,K,priors,seed=2)
+    NMF_state.load_state(checkpoint)
+    assert NMF_state.iteration == 9
+    assert len(NMF_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    NMF_resumed = run(checkpoint)
+    assert NMF_resumed.iteration == 10
+    assert len(NMF_resumed.all_times) == 10
+    assert NMF_resumed.all_performances == NMF.all_performances
+    for name in ['U','V','tau','all_tau']:
+        assert numpy.array_equal(getattr(NMF_resumed,name), getattr(NMF,name))
@@ -6,7 +6,7 @@ project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, random
 from BNMTF.code.models.nmf_np import NMF
 
 
@@ -85,6 +85,26 @@ def test_initialisation():
         assert nmf.V[j,k] > 0 and nmf.V[j,k] < 1
     
     
+""" Test the random initialisation with a seed """
+def test_initialise_seed():
+    I,J,K = 5,3,2
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    
+    numpy.random.seed(0)
+    state = numpy.random.get_state()
+    nmf1 = NMF(R,M,K,seed=1)
+    nmf1.initialise(init_UV='exponential')
+    nmf2 = NMF(R,M,K,seed=1)
+    nmf2.initialise(init_UV='exponential')
+    nmf3 = NMF(R,M,K,seed=2)
+    nmf3.initialise(init_UV='exponential')
+    assert numpy.array_equal(numpy.random.get_state()[1], state[1])
+    for name in ['U','V']:
+        assert numpy.array_equal(getattr(nmf1,name), getattr(nmf2,name))
+        assert not numpy.array_equal(getattr(nmf1,name), getattr(nmf3,name))
+    
+    
 """ Test updates for Uik, Vjk """
 def test_update():
     I,J = 2,4
@@ -192,6 +212,28 @@ def test_run():
     assert abs(U_00 - nmf.U[0][0]) < 0.000001
     
 
+""" Test running in single precision """
+def test_run_float32():
+    I,J,K = 10,5,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    nmf = NMF(R,M,K)
+    numpy.random.seed(1)
+    nmf.initialise('random')
+    nmf.run(10)
+    
+    nmf_32 = NMF(R,M,K,dtype=numpy.float32)
+    numpy.random.seed(1)
+    nmf_32.initialise('random')
+    nmf_32.run(10)
+    assert nmf_32.U.dtype == numpy.float32 and nmf_32.V.dtype == numpy.float32
+    assert numpy.allclose(nmf.U, nmf_32.U, rtol=1e-3)
+    assert numpy.allclose(nmf.V, nmf_32.V, rtol=1e-3)
+    
+    
 """ Test divergence calculation """
 def test_compute_I_div():
     R = [[1,2,0,4],[5,0,7,0]]
@@ -260,4 +302,38 @@ def test_compute_statistics():
     
     assert MSE_pred == nmf.compute_MSE(M_pred,R,R_pred)
     assert R2_pred == nmf.compute_R2(M_pred,R,R_pred)
-    assert Rp_pred == nmf.compute_Rp(M_pred,R,R_pred)
\ No newline at end of file
+    assert Rp_pred == nmf.compute_Rp(M_pred,R,R_pred)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K = 5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        nmf = NMF(R,M,K,seed=2)
+        nmf.initialise('random')
+        nmf.run(iterations=10,checkpoint=checkpoint,checkpoint_every=3)
+        return nmf
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    nmf, nmf_checkpoint = run(), run(checkpoint)
+    assert nmf.all_performances == nmf_checkpoint.all_performances
+    nmf_state = NMF(R,M,K,seed=2)
+    nmf_state.load_state(checkpoint)
+    assert nmf_state.iteration == 9
+    assert len(nmf_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    nmf_resumed = run(checkpoint)
+    assert nmf_resumed.iteration == 10
+    assert len(nmf_resumed.all_times) == 10
+    assert nmf_resumed.all_performances == nmf.all_performances
+    for name in ['U','V']:
+        assert numpy.array_equal(getattr(nmf_resumed,name), getattr(nmf,name))
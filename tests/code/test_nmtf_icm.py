@@ -6,8 +6,9 @@ project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
 import sys
 sys.path.append(project_location)
 
-import numpy, math, pytest, itertools
+import numpy, math, pytest, itertools, random
 from BNMTF.code.models.nmtf_icm import nmtf_icm
+from BNMTF.code.models.kmeans.kmeans import multistart_kmeans
 
 
 """ Test constructor """
@@ -199,6 +200,45 @@ init_S, init_FG = 'exp', 'exp'
 # F = 1/2, S = 1/3, G = 1/5
 # R - FSG.T = [[1]] - [[4/15]] = [[11/15]]
 
+""" Test the random initialisation with a seed """
+def test_initialise_seed():
+    I,J,K,L = 5,3,2,4
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    numpy.random.seed(0)
+    state = numpy.random.get_state()
+    NMTF1 = nmtf_icm(R,M,K,L,priors,seed=1)
+    NMTF1.initialise(init_S='random',init_FG='random')
+    NMTF2 = nmtf_icm(R,M,K,L,priors,seed=1)
+    NMTF2.initialise(init_S='random',init_FG='random')
+    NMTF3 = nmtf_icm(R,M,K,L,priors,seed=2)
+    NMTF3.initialise(init_S='random',init_FG='random')
+    assert numpy.array_equal(numpy.random.get_state()[1], state[1])
+    for name in ['F','S','G']:
+        assert numpy.array_equal(getattr(NMTF1,name), getattr(NMTF2,name))
+        assert not numpy.array_equal(getattr(NMTF1,name), getattr(NMTF3,name))
+    
+
+""" Test initialising F and G with the best KMeans clustering over several seeds """
+def test_initialise_kmeans_seeds():
+    I,J,K,L = 12,6,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[3,2] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    seeds = [0,1,2,3]
+    
+    NMTF = nmtf_icm(R,M,K,L,priors)
+    NMTF.initialise(init_S='exp',init_FG='kmeans++',kmeans_seeds=seeds,kmeans_P=2)
+    best_F = multistart_kmeans(R,M,K,seeds,init='kmeans++')
+    best_G = multistart_kmeans(R.T,M.T,L,seeds,init='kmeans++')
+    assert numpy.array_equal(NMTF.F,best_F.clustering_results + 0.2)
+    assert numpy.array_equal(NMTF.G,best_G.clustering_results + 0.2)
+    
+    
 def test_alpha_s():
     NMTF = nmtf_icm(R,M,K,L,priors)
     NMTF.initialise(init_S,init_FG)
@@ -298,6 +338,27 @@ def test_run():
     assert NMTF.all_tau[1] != alpha/float(beta)
     
     
+""" Test running in single precision """
+def test_run_float32():
+    I,J,K,L = 10,5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    NMTF = nmtf_icm(R,M,K,L,priors)
+    NMTF.initialise('exp','exp')
+    NMTF.run(5)
+    
+    NMTF_32 = nmtf_icm(R,M,K,L,priors,dtype=numpy.float32)
+    NMTF_32.initialise('exp','exp')
+    NMTF_32.run(5)
+    for name in ['F','S','G']:
+        assert getattr(NMTF_32,name).dtype == numpy.float32
+        assert numpy.allclose(getattr(NMTF,name), getattr(NMTF_32,name), rtol=1e-3, atol=1e-5)
+    
+    
 """ Test computing the performance of the predictions using the expectations """
 def test_predict():
     (I,J,K,L) = (5,3,2,4)
@@ -386,4 +447,64 @@ def test_log_likelihood():
     assert MSE == NMTF.quality('MSE')
     with pytest.raises(AssertionError) as error:
         NMTF.quality('FAIL')
-    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric for model quality: FAIL."
+
+    
+""" Test warm starting from a model with more or fewer row and column clusters """
+def test_warm_start():
+    I,J = 5,4
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    
+    NMTF2 = nmtf_icm(R,M,2,2,priors,seed=0)
+    NMTF2.initialise(init_S='random',init_FG='random')
+    NMTF2.run(iterations=2)
+    for (K,L) in [(1,3),(3,1),(3,3)]:
+        NMTF = nmtf_icm(R,M,K,L,priors,seed=1)
+        NMTF.initialise(init_S='random',init_FG='random')
+        fresh = { name : numpy.copy(getattr(NMTF,name)) for name in ['F','S','G'] }
+        NMTF.warm_start(NMTF2)
+        for name in fresh:
+            (rows,columns) = {'F':(I,min(K,2)),'S':(min(K,2),min(L,2)),'G':(J,min(L,2))}[name[-1]]
+            new = getattr(NMTF,name)
+            assert numpy.array_equal(new[:rows,:columns], getattr(NMTF2,name)[:rows,:columns])
+            if name[-1] in ['F','G']:
+                assert numpy.array_equal(new[:,columns:], fresh[name][:,columns:])
+        NMTF.run(iterations=2)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K,L = 5,3,2,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':0.1, 'lambdaS':0.1, 'lambdaG':0.1 }
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        NMTF = nmtf_icm(R,M,K,L,priors,seed=2)
+        NMTF.initialise('random','random')
+        NMTF.run(iterations=10,minimum_TN=0.1,checkpoint=checkpoint,checkpoint_every=3)
+        return NMTF
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    NMTF, NMTF_checkpoint = run(), run(checkpoint)
+    assert NMTF.all_performances == NMTF_checkpoint.all_performances
+    NMTF_state = nmtf_icm(R,M,K,L,priors,seed=2)
+    NMTF_state.load_state(checkpoint)
+    assert NMTF_state.iteration == 9
+    assert len(NMTF_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    NMTF_resumed = run(checkpoint)
+    assert NMTF_resumed.iteration == 10
+    assert len(NMTF_resumed.all_times) == 10
+    assert NMTF_resumed.all_performances == NMTF.all_performances
+    for name in ['F','S','G','tau','all_tau']:
+        assert numpy.array_equal(getattr(NMTF_resumed,name), getattr(NMTF,name))
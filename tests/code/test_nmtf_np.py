@@ -106,6 +106,26 @@ def test_initialisation():
         assert nmtf.S[k,l] > 0
     
     
+""" Test the random initialisation with a seed """
+def test_initialise_seed():
+    I,J,K,L = 5,3,2,4
+    R = numpy.ones((I,J))
+    M = numpy.ones((I,J))
+    
+    numpy.random.seed(0)
+    state = numpy.random.get_state()
+    nmtf1 = NMTF(R,M,K,L,seed=1)
+    nmtf1.initialise(init_S='exponential',init_FG='random')
+    nmtf2 = NMTF(R,M,K,L,seed=1)
+    nmtf2.initialise(init_S='exponential',init_FG='random')
+    nmtf3 = NMTF(R,M,K,L,seed=2)
+    nmtf3.initialise(init_S='exponential',init_FG='random')
+    assert numpy.array_equal(numpy.random.get_state()[1], state[1])
+    for name in ['F','S','G']:
+        assert numpy.array_equal(getattr(nmtf1,name), getattr(nmtf2,name))
+        assert not numpy.array_equal(getattr(nmtf1,name), getattr(nmtf3,name))
+    
+    
 """ Test updates for F, G, S, without dynamic behaviour. """
 def test_updates():
     R = numpy.array([[1,2],[3,4]],dtype='f')
@@ -217,6 +237,28 @@ def test_run():
     
     
 
+""" Test running in single precision """
+def test_run_float32():
+    I,J,K,L = 10,5,3,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,2], M[3,1] = 0, 0, 0
+    
+    nmtf = NMTF(R,M,K,L)
+    numpy.random.seed(1)
+    nmtf.initialise('random','random')
+    nmtf.run(10)
+    
+    nmtf_32 = NMTF(R,M,K,L,dtype=numpy.float32)
+    numpy.random.seed(1)
+    nmtf_32.initialise('random','random')
+    nmtf_32.run(10)
+    for name in ['F','S','G']:
+        assert getattr(nmtf_32,name).dtype == numpy.float32
+        assert numpy.allclose(getattr(nmtf,name), getattr(nmtf_32,name), rtol=1e-3)
+    
+    
 """ Test divergence calculation """
 def test_compute_I_div():
     R = numpy.array([[1,2],[3,4]],dtype=float)
@@ -292,4 +334,38 @@ def test_compute_statistics():
     
     assert MSE_pred == nmtf.compute_MSE(M_pred,R,R_pred)
     assert R2_pred == nmtf.compute_R2(M_pred,R,R_pred)
-    assert Rp_pred == nmtf.compute_Rp(M_pred,R,R_pred)
\ No newline at end of file
+    assert Rp_pred == nmtf.compute_Rp(M_pred,R,R_pred)
+
+
+""" Test checkpointing the run every few iterations, and resuming from the checkpoint """
+def test_checkpoint(tmpdir):
+    I,J,K,L = 5,3,2,2
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[2,1] = 0, 0
+    checkpoint = str(tmpdir.join('checkpoint.npz'))
+    
+    def run(checkpoint=None):
+        numpy.random.seed(1)
+        random.seed(1)
+        nmtf = NMTF(R,M,K,L,seed=2)
+        nmtf.initialise('random','random')
+        nmtf.run(iterations=10,checkpoint=checkpoint,checkpoint_every=3)
+        return nmtf
+    
+    # Checkpointing does not change the run, and leaves the state of iteration 9
+    nmtf, nmtf_checkpoint = run(), run(checkpoint)
+    assert nmtf.all_performances == nmtf_checkpoint.all_performances
+    nmtf_state = NMTF(R,M,K,L,seed=2)
+    nmtf_state.load_state(checkpoint)
+    assert nmtf_state.iteration == 9
+    assert len(nmtf_state.all_times) == 9
+    
+    # Running again resumes from iteration 9, giving the same final state
+    nmtf_resumed = run(checkpoint)
+    assert nmtf_resumed.iteration == 10
+    assert len(nmtf_resumed.all_times) == 10
+    assert nmtf_resumed.all_performances == nmtf.all_performances
+    for name in ['F','S','G']:
+        assert numpy.array_equal(getattr(nmtf_resumed,name), getattr(nmtf,name))
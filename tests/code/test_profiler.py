@@ -0,0 +1,110 @@
+"""
+Test the profiler of the model runs, in profiler.py
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+from BNMTF.code.models.profiler import Profiler
+from BNMTF.code.models.bnmf_vb_optimised import bnmf_vb_optimised
+from BNMTF.code.models.bnmtf_gibbs_optimised import bnmtf_gibbs_optimised
+import BNMTF.code.models.bnmf_vb_optimised as module_vb
+import numpy, json, pytest
+
+
+I,J,K,L = 5,4,2,3
+numpy.random.seed(0)
+R = numpy.random.rand(I,J)
+M = numpy.ones((I,J))
+M[0,0], M[2,1] = 0, 0
+
+
+""" Test that profiling records the calls of each iteration, without changing the run """
+def test_profile_run(tmpdir):
+    priors = { 'alpha':3, 'beta':1, 'lambdaU':2, 'lambdaV':3 }
+    def run(profiler=None):
+        BNMF = bnmf_vb_optimised(R,M,K,priors,seed=1)
+        BNMF.initialise(init='random')
+        BNMF.run(iterations=4,monitor_every=2,profiler=profiler)
+        return BNMF
+        
+    profiler = Profiler(trace=True)
+    BNMF, BNMF_profiled = run(), run(profiler)
+    assert numpy.array_equal(BNMF.expU, BNMF_profiled.expU)
+    assert BNMF.all_performances == BNMF_profiled.all_performances
+    
+    # The methods and kernels are restored after the run
+    assert 'update_U' not in vars(BNMF_profiled)
+    assert module_vb.TN_vector_moments.__name__ == 'TN_vector_moments'
+    
+    assert [record['iteration'] for record in profiler.iterations] == [1,2,3,4]
+    for record in profiler.iterations:
+        phases = record['phases']
+        assert phases['update_U']['calls'] == K and phases['update_V']['calls'] == K
+        assert phases['update_tau']['calls'] == 1
+        assert phases['TN_vector_moments']['calls'] == 2*K
+        assert phases['update_U']['time'] <= record['time']
+    assert 'elbo' not in profiler.iterations[0]['phases']
+    assert profiler.iterations[1]['phases']['elbo']['calls'] == 1
+    
+    # Export as JSON lines, and as a Chrome trace
+    file_json = str(tmpdir.join('profile.jsonl'))
+    profiler.write_json_lines(file_json)
+    records = [json.loads(line) for line in open(file_json)]
+    assert [record['iteration'] for record in records] == [1,2,3,4]
+    assert records[0]['phases']['update_V']['calls'] == K
+    
+    file_trace = str(tmpdir.join('profile.json'))
+    profiler.write_chrome_trace(file_trace)
+    events = json.load(open(file_trace))['traceEvents']
+    assert len(events) == len(profiler.events)
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events)
+    assert [event['name'] for event in events if event['cat'] == 'iteration'] == \
+        ['iteration 1','iteration 2','iteration 3','iteration 4']
+    assert set(event['args']['iteration'] for event in events) == set([1,2,3,4])
+    
+    
+""" Test profiling only some methods of a Gibbs sampler """
+def test_profile_names():
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    BNMTF.initialise()
+    profiler = Profiler(names=['tauF','muF'],kernels=False)
+    BNMTF.run(3,profiler=profiler)
+    assert len(profiler.iterations) == 3
+    assert set(profiler.iterations[0]['phases'].keys()) == set(['tauF','muF'])
+    assert profiler.iterations[0]['phases']['tauF']['calls'] == K
+    
+    # Without trace=True we do not keep the individual calls
+    assert profiler.events == []
+    with pytest.raises(AssertionError) as error:
+        profiler.write_chrome_trace('unused.json')
+    assert str(error.value) == "No events were recorded for the Chrome trace: use Profiler(trace=True)."
+    
+    
+""" Test that the kernels are restored when the run raises, and that calls of
+    the kernels outside the profiled model are not recorded """
+def test_profile_exception():
+    import BNMTF.code.models.bnmtf_gibbs_optimised as module_gibbs
+    priors = { 'alpha':3, 'beta':1, 'lambdaF':2, 'lambdaS':3, 'lambdaG':4 }
+    BNMTF = bnmtf_gibbs_optimised(R,M,K,L,priors)
+    BNMTF.initialise()
+    def fail():
+        raise Exception("Stopped.")
+    BNMTF.predict_while_running = fail
+    
+    profiler = Profiler()
+    with pytest.raises(Exception) as error:
+        BNMTF.run(3,profiler=profiler)
+    assert str(error.value) == "Stopped."
+    assert module_gibbs.TN_vector_draw.__name__ == 'TN_vector_draw'
+    assert 'tauF' not in vars(BNMTF)
+    
+    profiler = Profiler(names=['tauF'])
+    profiler.attach(BNMTF)
+    module_gibbs.TN_vector_draw(numpy.zeros(2),numpy.ones(2))
+    assert profiler.phases == {}
+    BNMTF.tauF(0)
+    assert profiler.phases.keys() == ['tauF']
+    profiler.detach(BNMTF)
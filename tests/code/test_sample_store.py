@@ -0,0 +1,69 @@
+"""
+Tests for the class storing the samples of the Gibbs samplers.
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+import numpy, pytest, os
+from BNMTF.code.models.sample_store import SampleStore, load_sample_store
+
+
+""" Test storing only the retained samples, in memory or in memory-mapped files """
+def test_retained(tmpdir):
+    iterations, burn_in, thinning = 10, 2, 3 # so index 2,5,8 -> m=3,m=6,m=9
+    for folder in [None, str(tmpdir)]:
+        samples = SampleStore([('U',(2,3)),('tau',())],iterations,burn_in,thinning,folder=folder)
+        for it in range(0,iterations):
+            m = it+1
+            samples.add(it,{'U':numpy.ones((2,3))*m**2,'tau':m**2})
+        samples.flush()
+        
+        assert samples.get('U').shape == (3,2,3)
+        assert numpy.array_equal(samples.get('tau'), [9.,36.,81.])
+        assert numpy.array_equal(samples.mean('U',burn_in,thinning), numpy.ones((2,3))*(9.+36.+81.)/3.)
+        assert samples.mean('tau',burn_in,thinning) == (9.+36.+81.)/3.
+        assert samples.mean('tau',5,3) == (36.+81.)/2.
+        assert numpy.allclose(samples.variance('U',burn_in,thinning), numpy.ones((2,3))*numpy.var([9.,36.,81.]))
+        with pytest.raises(AssertionError):
+            samples.mean('tau',2,1)
+        
+    assert numpy.array_equal(numpy.load(os.path.join(str(tmpdir),'tau.npy')), [9.,36.,81.])
+    
+    
+""" Test storing only the running sums """
+def test_running_sums():
+    iterations, burn_in, thinning = 10, 2, 3
+    samples = SampleStore([('U',(2,3)),('tau',())],iterations,burn_in,thinning,running_sums=True)
+    for it in range(0,iterations):
+        m = it+1
+        samples.add(it,{'U':numpy.ones((2,3))*m**2,'tau':m**2})
+        
+    assert samples.get('U') is None
+    assert numpy.array_equal(samples.mean('U',burn_in,thinning), numpy.ones((2,3))*(9.+36.+81.)/3.)
+    assert samples.mean('tau',burn_in,thinning) == (9.+36.+81.)/3.
+    assert numpy.allclose(samples.variance('tau',burn_in,thinning), numpy.var([9.,36.,81.]))
+    with pytest.raises(AssertionError):
+        samples.mean('U',0,1)
+    with pytest.raises(AssertionError):
+        SampleStore([('U',(2,3))],iterations,burn_in,thinning,running_sums=True,folder='.')
+
+
+""" Test recreating the store from its state halfway, and adding the rest of the samples """
+def test_state(tmpdir):
+    iterations, burn_in, thinning = 10, 2, 3
+    for running_sums,folder in [(False,None),(True,None),(False,str(tmpdir))]:
+        samples = SampleStore([('U',(2,3)),('tau',())],iterations,burn_in,thinning,running_sums,folder)
+        for it in range(0,6):
+            m = it+1
+            samples.add(it,{'U':numpy.ones((2,3))*m**2,'tau':m**2})
+        
+        samples = load_sample_store(samples.state())
+        assert samples.count == 2
+        for it in range(6,iterations):
+            m = it+1
+            samples.add(it,{'U':numpy.ones((2,3))*m**2,'tau':m**2})
+        assert samples.count == 3
+        assert numpy.array_equal(samples.mean('U',burn_in,thinning), numpy.ones((2,3))*(9.+36.+81.)/3.)
+        assert samples.mean('tau',burn_in,thinning) == (9.+36.+81.)/3.
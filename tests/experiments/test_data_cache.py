@@ -0,0 +1,57 @@
+"""
+Test the cache for the drug sensitivity datasets, in data_cache.py, and the
+GDSC loader that uses it.
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+from BNMTF.experiments.data_cache import load_cached
+from BNMTF.experiments.experiments_gdsc.load_data import load_gdsc
+import numpy, os
+
+
+""" Test that we only parse the file again when it changes """
+def test_load_cached(tmpdir):
+    source = str(tmpdir.join('data.txt'))
+    open(source,'w').write('1 2\n3 4\n')
+    parsed = []
+    def parse(location):
+        parsed.append(location)
+        return { 'X' : numpy.loadtxt(location), 'names' : numpy.array(['a','b']) }
+
+    values = load_cached(source,parse)
+    assert os.path.exists(source + '.cache.npz')
+    values_cached = load_cached(source,parse)
+    assert len(parsed) == 1
+    assert numpy.array_equal(values_cached['X'],[[1.,2.],[3.,4.]])
+    assert values_cached['names'].tolist() == ['a','b']
+
+    # Other parse options, or a changed file, invalidate the cache
+    load_cached(source,parse,options=',')
+    assert len(parsed) == 2
+    open(source,'w').write('1 2\n3 5\n')
+    values = load_cached(source,parse)
+    assert len(parsed) == 3
+    assert numpy.array_equal(values['X'],[[1.,2.],[3.,5.]])
+
+    load_cached(source,parse,cache=False)
+    assert len(parsed) == 4
+
+
+""" Test loading a small GDSC file, with and without the cache """
+def test_load_gdsc(tmpdir):
+    source = str(tmpdir.join('gdsc.txt'))
+    open(source,'w').write("Cell Line,Cancer Type,Tissue,drug1,drug2\n" + \
+                           "cl1,type1,tissue1,1.5,\n" + \
+                           "cl2,type2,tissue2,-2.,3.\n")
+    for cache in [False,True,True]:
+        (X,X_min,M,drug_names,cell_lines,cancer_types,tissues) = load_gdsc(location=source,cache=cache)
+        assert numpy.array_equal(X,[[1.5,0.],[-2.,3.]])
+        assert numpy.array_equal(M,[[1.,0.],[1.,1.]])
+        assert numpy.array_equal(X_min,[[4.5,0.],[1.,6.]])
+        assert drug_names == ['drug1','drug2']
+        assert cell_lines == ['cl1','cl2']
+        assert cancer_types == ['type1','type2']
+        assert tissues == ['tissue1','tissue2']
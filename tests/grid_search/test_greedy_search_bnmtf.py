@@ -8,6 +8,8 @@ sys.path.append(project_location)
 
 from BNMTF.code.cross_validation.greedy_search_bnmtf import GreedySearch
 from BNMTF.code.models.bnmtf_vb_optimised import bnmtf_vb_optimised
+from BNMTF.code.models.nmtf_icm import nmtf_icm
+from BNMTF.code.cross_validation.journal import Journal
 import numpy, pytest, random
 
 classifier = bnmtf_vb_optimised
@@ -113,4 +115,51 @@ def test_best_value():
     assert greedysearch.best_value('loglikelihood') == (2,2)
     with pytest.raises(AssertionError) as error:
         greedysearch.all_values('FAIL')
-    assert str(error.value) == "Unrecognised metric name: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric name: FAIL."    
+    
+def test_search_parallel():
+    # Check that we take the same path with the candidates run in parallel, 
+    # speculatively or not, when the search is deterministic
+    I,J = 10,9
+    values_K = [1,2,4,5]
+    values_L = [5,4,3]
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    iterations = 5
+    search_metric = 'BIC'
+    
+    all_performances = []
+    for (P,speculative) in [(1,False),(3,False),(4,True)]:
+        greedysearch = GreedySearch(nmtf_icm,values_K,values_L,R,M,priors,'exp','exp',iterations,P=P,speculative=speculative)
+        greedysearch.search(search_metric,minimum_TN=0.1)
+        all_performances.append(greedysearch.all_performances)
+    assert all_performances[0] == all_performances[1]
+    assert all_performances[0] == all_performances[2]
+    
+def test_search_journal(tmpdir):
+    # Check that we journal the qualities of each (K,L) we try, and skip the ones 
+    # in the journal when running again, sequentially or in parallel
+    I,J = 10,9
+    values_K = [1,2,4,5]
+    values_L = [5,4,3]
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    filename = str(tmpdir.join('journal.txt'))
+    
+    greedysearch = GreedySearch(nmtf_icm,values_K,values_L,R,M,priors,'exp','exp',5,journal=Journal(filename),fold=0)
+    greedysearch.search('BIC',minimum_TN=0.1)
+    lines = open(filename).readlines()
+    assert len(lines) == len(greedysearch.all_values('BIC'))
+    (K,L,BIC) = greedysearch.all_values('BIC')[1]
+    assert Journal(filename).result('search K=%s L=%s' % (K,L),0)['BIC'] == BIC
+    
+    for P in [1,3]:
+        open(filename,'w').writelines(lines[:2])
+        resumed = GreedySearch(nmtf_icm,values_K,values_L,R,M,priors,'exp','exp',5,P=P,journal=Journal(filename),fold=0)
+        resumed.search('BIC',minimum_TN=0.1)
+        assert resumed.all_performances == greedysearch.all_performances
+        assert len(open(filename).readlines()) == len(lines)
@@ -103,4 +103,48 @@ def test_best_value():
     assert gridsearch.best_value('loglikelihood') == (5,3)
     with pytest.raises(AssertionError) as error:
         gridsearch.all_values('FAIL')
-    assert str(error.value) == "Unrecognised metric name: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric name: FAIL."    
+    
+def test_search_parallel():
+    # Check that running the restarts in parallel fills in all cells, reproducibly
+    # given the numpy seed (which is used to draw the seed for each restart)
+    I,J = 10,9
+    values_K = [1,2]
+    values_L = [3,2,1]
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    iterations, restarts = 3, 2
+    
+    all_performances = []
+    for attempt in range(0,2):
+        numpy.random.seed(1)
+        gridsearch_parallel = GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',iterations,restarts,P=3)
+        gridsearch_parallel.search()
+        all_performances.append(gridsearch_parallel.all_performances)
+        
+    for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+        assert all_performances[0][metric].shape == (2,3)
+        assert numpy.isfinite(all_performances[0][metric]).all()
+        assert numpy.array_equal(all_performances[0][metric], all_performances[1][metric])
+    
+    
+def test_search_warm_start():
+    # Check that we can warm start each cell from the previous one
+    I,J = 10,9
+    values_K = [1,2]
+    values_L = [3,2,1]
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaF':5, 'lambdaS':6, 'lambdaG':7 }
+    
+    gridsearch = GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',5,2,warm_start=True,warm_iterations=2)
+    gridsearch.search()
+    for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+        assert numpy.isfinite(gridsearch.all_values(metric)).all()
+    
+    with pytest.raises(AssertionError) as error:
+        GridSearch(classifier,values_K,values_L,R,M,priors,'random','random',5,2,P=2,warm_start=True)
+    assert str(error.value) == "Cannot warm start in parallel."
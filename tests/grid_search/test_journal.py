@@ -0,0 +1,105 @@
+"""
+Test the journal of finished work in journal.py, and resuming a cross-validation from it
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+from BNMTF.code.cross_validation.journal import Journal
+from BNMTF.code.cross_validation.matrix_cross_validation import MatrixCrossValidation
+from BNMTF.code.models.nmf_icm import nmf_icm
+import BNMTF.code.cross_validation.mask as mask
+import numpy, random, json
+
+
+""" Test storing and reading back folds and results, dropping a partially written last line """
+def test_journal(tmpdir):
+    filename = str(tmpdir.join('journal.txt'))
+    random.seed(0)
+    M = numpy.ones((6,5))
+    folds_M = mask.compute_folds_attempts(6,5,3,10,M)
+
+    journal = Journal(filename)
+    folds_test = journal.folds('a',3,lambda: folds_M)
+    assert all(numpy.array_equal(M1,M2) for M1,M2 in zip(folds_test,folds_M))
+    assert journal.result('a',0) is None
+    journal.add_result('a',0,{ 'performances':{ 'MSE':numpy.float64(0.5) } })
+    journal.sub('fold 1 ').add_result('a',2,{ 'exception':'failed' })
+    open(filename,'a').write('{"key": "a", "fo')
+
+    journal = Journal(filename)
+    assert journal.folds('a',3,lambda: None)[1].tolist() == folds_M[1].tolist()
+    assert journal.result('a',0) == { 'performances':{ 'MSE':0.5 } }
+    assert journal.result('a',2) is None
+    assert journal.sub('fold 1 ').result('a',2) == { 'exception':'failed' }
+    journal.add_result('a',1,{ 'performances':{ 'MSE':1. } })
+    lines = open(filename).readlines()
+    assert len(lines) == 4
+    assert json.loads(lines[0]) == { 'key':'a', 'folds_file':'journal.txt.folds0.npy' }
+    assert json.loads(lines[3]) == { 'key':'a', 'fold':1, 'result':{ 'performances':{ 'MSE':1. } } }
+    assert numpy.array_equal(numpy.load(filename+'.folds0.npy'),mask.compute_fold_indices(folds_M))
+
+
+""" Test storing matrices of fold indices in their own .npy files, and reading them back """
+def test_journal_fold_indices(tmpdir):
+    filename = str(tmpdir.join('journal.txt'))
+    fold_indices = [[0,1,-1],[1,0,0]]
+
+    journal = Journal(filename)
+    assert journal.fold_indices('a',lambda: numpy.array(fold_indices)).tolist() == fold_indices
+    assert journal.fold_indices('b',lambda: numpy.array(fold_indices)+1).tolist() == (numpy.array(fold_indices)+1).tolist()
+    assert json.loads(open(filename).readlines()[1]) == { 'key':'b', 'folds_file':'journal.txt.folds1.npy' }
+
+    journal = Journal(filename)
+    assert journal.fold_indices('a',lambda: None).tolist() == fold_indices
+    assert journal.fold_indices('b',lambda: None).dtype == mask.fold_index_dtype
+
+
+# nmf_icm, counting how many models we train
+class counting_nmf_icm(nmf_icm):
+    trained = 0
+    def train(self,*args,**kwargs):
+        counting_nmf_icm.trained += 1
+        return nmf_icm.train(self,*args,**kwargs)
+
+""" Test that resuming the cross-validation from its journal only trains the models of the unfinished folds """
+def test_resume_cross_validation(tmpdir):
+    I,J = 10,9
+    numpy.random.seed(0)
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':1., 'beta':1., 'lambdaU':1., 'lambdaV':1. }
+    parameter_search = [{ 'K':1, 'priors':priors, 'seed':1 }, { 'K':2, 'priors':priors, 'seed':2 }, { 'K':3, 'priors':{} }]
+    train_config = { 'iterations':5, 'init':'random' }
+    file_journal = str(tmpdir.join('journal.txt'))
+
+    def run():
+        crossval = MatrixCrossValidation(
+            method=counting_nmf_icm,X=X,M=M,K=3,parameter_search=parameter_search,train_config=train_config,
+            file_performance=str(tmpdir.join('performances.txt')),file_journal=file_journal)
+        crossval.run()
+        return crossval
+
+    counting_nmf_icm.trained = 0
+    crossval = run()
+    assert counting_nmf_icm.trained == 6
+    lines = open(file_journal).readlines()
+    assert len(lines) == 2 * (1 + 3) + 2
+    assert json.loads(lines[-1])['result'] == { 'exception':"'alpha'" }
+    log = open(str(tmpdir.join('performances.txt'))).read()
+
+    # Keep the first parameters, and the folds and first result of the second
+    open(file_journal,'w').writelines(lines[:6])
+    counting_nmf_icm.trained = 0
+    resumed = run()
+    assert counting_nmf_icm.trained == 2
+    assert resumed.all_performances == crossval.all_performances
+    assert resumed.performances == crossval.performances
+    assert len(open(file_journal).readlines()) == 10
+    assert open(str(tmpdir.join('performances.txt'))).read() == log
+
+    # Running again trains nothing at all
+    counting_nmf_icm.trained = 0
+    run()
+    assert counting_nmf_icm.trained == 0
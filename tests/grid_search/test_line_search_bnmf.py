@@ -8,6 +8,8 @@ sys.path.append(project_location)
 
 from BNMTF.code.cross_validation.line_search_bnmf import LineSearch
 from BNMTF.code.models.bnmf_vb_optimised import bnmf_vb_optimised
+from BNMTF.code.models.bnmf_vb_optimised_batch import bnmf_vb_optimised_batch
+from BNMTF.code.cross_validation.journal import Journal
 import numpy, pytest
 
 classifier = bnmf_vb_optimised
@@ -93,4 +95,108 @@ def test_best_value():
     assert linesearch.best_value('MSE') == 1
     with pytest.raises(AssertionError) as error:
         linesearch.all_values('FAIL')
-    assert str(error.value) == "Unrecognised metric name: FAIL."
\ No newline at end of file
+    assert str(error.value) == "Unrecognised metric name: FAIL."    
+    
+def test_search_batch():
+    # Check that training the restarts at once chooses the same models as training them in turn
+    I,J = 10,9
+    values_K = [1,2,4,5]
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5, 'lambdaV':6 }
+    initUV = 'random'
+    iterations, restarts = 5, 3
+    
+    numpy.random.seed(1)
+    linesearch = LineSearch(classifier,values_K,R,M,priors,initUV,iterations,restarts)
+    linesearch.search()
+    
+    numpy.random.seed(1)
+    linesearch_batch = LineSearch(classifier,values_K,R,M,priors,initUV,iterations,restarts,batch_classifier=bnmf_vb_optimised_batch)
+    linesearch_batch.search()
+    for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+        assert numpy.allclose(linesearch.all_values(metric), linesearch_batch.all_values(metric))
+    
+    with pytest.raises(AssertionError) as error:
+        linesearch_batch.search(burn_in=1,thinning=1)
+    assert str(error.value) == "Can only use the batch classifier for VB."
+    
+def test_search_parallel():
+    # Check that running the restarts in parallel gives the same performances
+    I,J = 10,9
+    values_K = [1,2,4]
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5, 'lambdaV':6 }
+    iterations, restarts = 5, 2
+    
+    linesearch = LineSearch(classifier,values_K,R,M,priors,'exp',iterations,restarts)
+    linesearch.search()
+    linesearch_parallel = LineSearch(classifier,values_K,R,M,priors,'exp',iterations,restarts,P=2)
+    linesearch_parallel.search()
+    assert linesearch_parallel.all_performances == linesearch.all_performances
+    
+    # With random initialisation, the restarts get different seeds drawn from numpy.random
+    all_performances = []
+    for batch_classifier in [None,None,bnmf_vb_optimised_batch]:
+        numpy.random.seed(1)
+        linesearch_parallel = LineSearch(classifier,values_K,R,M,priors,'random',iterations,restarts,batch_classifier=batch_classifier,P=2)
+        linesearch_parallel.search()
+        all_performances.append(linesearch_parallel.all_performances)
+        assert len(linesearch_parallel.all_values('MSE')) == 3
+    assert all_performances[0] == all_performances[1]
+    
+def test_search_warm_start():
+    # Check that we can warm start each next K from the best model for the previous one
+    I,J = 10,9
+    values_K = [1,2,4,3]
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5, 'lambdaV':6 }
+    
+    linesearch = LineSearch(classifier,values_K,R,M,priors,'random',10,2,warm_start=True,warm_iterations=3)
+    assert linesearch.warm_iterations == 3
+    linesearch.search()
+    for metric in ['BIC','AIC','loglikelihood','MSE','ELBO']:
+        assert len(linesearch.all_values(metric)) == 4
+        assert numpy.isfinite(linesearch.all_values(metric)).all()
+    
+    with pytest.raises(AssertionError) as error:
+        LineSearch(classifier,values_K,R,M,priors,'random',10,2,P=2,warm_start=True)
+    assert str(error.value) == "Cannot warm start with the batch classifier or in parallel."
+    
+# bnmf_vb_optimised, counting how many models we construct
+class counting_bnmf_vb_optimised(bnmf_vb_optimised):
+    constructed = 0
+    def __init__(self,*args,**kwargs):
+        counting_bnmf_vb_optimised.constructed += 1
+        bnmf_vb_optimised.__init__(self,*args,**kwargs)
+    
+def test_search_journal(tmpdir):
+    # Check that we journal the qualities of each K, and skip the ones in the journal when running again
+    I,J = 10,9
+    values_K = [1,2,4]
+    numpy.random.seed(0)
+    R = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':3, 'beta':4, 'lambdaU':5, 'lambdaV':6 }
+    iterations, restarts = 5, 2
+    filename = str(tmpdir.join('journal.txt'))
+    
+    linesearch = LineSearch(classifier,values_K,R,M,priors,'exp',iterations,restarts,journal=Journal(filename),fold=1)
+    linesearch.search()
+    lines = open(filename).readlines()
+    assert len(lines) == 3
+    assert Journal(filename).result('search K=2',1) == { metric:linesearch.all_values(metric)[1] for metric in linesearch.all_performances }
+    
+    for P in [1,2]:
+        open(filename,'w').writelines(lines[:2])
+        counting_bnmf_vb_optimised.constructed = 0
+        resumed = LineSearch(counting_bnmf_vb_optimised,values_K,R,M,priors,'exp',iterations,restarts,P=P,journal=Journal(filename),fold=1)
+        resumed.search()
+        assert counting_bnmf_vb_optimised.constructed == (restarts if P == 1 else 0)
+        assert resumed.all_performances == linesearch.all_performances
+        assert len(open(filename).readlines()) == 3
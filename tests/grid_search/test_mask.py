@@ -0,0 +1,117 @@
+"""
+Test the methods for generating masks and cross-validation folds, in mask.py
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+import BNMTF.code.cross_validation.mask as mask
+import numpy, random, pytest
+
+
+""" Test generating masks """
+def test_generate_M():
+    random.seed(0)
+    M = mask.generate_M(10,8,0.25)
+    assert M.shape == (10,8)
+    assert M.sum() == 80 - 20
+    assert set(M.flatten()) == set([0.,1.])
+
+def test_generate_M_from_M():
+    random.seed(0)
+    M = numpy.ones((10,8))
+    M[0,:4] = 0
+    M_train, M_test = mask.generate_M_from_M(M,0.5)
+    assert M_train.sum() == 40
+    assert numpy.array_equal(M_train+M_test,M)
+
+    with pytest.raises(AssertionError) as error:
+        mask.generate_M_from_M(M,0.01)
+    assert str(error.value) == "Specified 0.01 fraction missing, so 0.8 entries missing, but there are already 4 missing by default!"
+
+
+""" Test the simple helper functions """
+def test_helpers():
+    M = numpy.array([[1,0,1],[0,0,1]])
+    X_true = [[1.,2.,3.],[4.,5.,6.]]
+    X_pred = [[1.5,2.5,3.5],[4.5,5.5,6.5]]
+    assert mask.nonzero_indices(M) == [(0,0),(0,2),(1,2)]
+    assert numpy.array_equal(mask.calc_inverse_M(M), [[0.,1.,0.],[1.,1.,0.]])
+    assert mask.recover_predictions(M,X_true,X_pred) == [(2.,2.5),(4.,4.5),(5.,5.5)]
+    assert mask.check_empty_rows_columns(numpy.array(M)) == False
+    assert mask.check_empty_rows_columns(numpy.array([[1,0],[0,1]])) == True
+
+    folds_M = [numpy.array([[1,0],[0,0]]),numpy.array([[0,1],[0,0]]),numpy.array([[0,0],[1,1]])]
+    Ms = mask.compute_Ms(folds_M)
+    assert numpy.array_equal(Ms[0], [[0,1],[1,1]])
+    assert numpy.array_equal(Ms[2], [[1,1],[0,0]])
+
+
+""" Test computing the folds, which split the observed entries """
+def test_compute_folds():
+    random.seed(0)
+    M = numpy.ones((6,5))
+    M[1,1], M[4,2] = 0, 0
+    folds_M = mask.compute_folds(6,5,4,M)
+    assert len(folds_M) == 4
+    assert [fold_M.sum() for fold_M in folds_M] == [7,7,7,7]
+    assert numpy.array_equal(sum(folds_M),M)
+
+def test_compute_folds_attempts():
+    random.seed(0)
+    numpy.random.seed(0)
+    for no_folds in [2,3,5,10]:
+        for attempt in range(0,10):
+            (I,J) = (numpy.random.randint(2,20),numpy.random.randint(2,20))
+            M = (numpy.random.rand(I,J) < 0.7).astype(float)
+            M[:,:2], M[:2,:] = 1, 1
+
+            folds_M = mask.compute_folds_attempts(I,J,no_folds,100,M)
+            assert len(folds_M) == no_folds
+            assert numpy.array_equal(sum(folds_M),M)
+            for M_train in mask.compute_Ms(folds_M):
+                assert mask.check_empty_rows_columns(M_train)
+
+    # Folds have the same sizes as with compute_folds, when there are enough entries
+    M = numpy.ones((50,40))
+    folds_M = mask.compute_folds_attempts(50,40,5,10,M)
+    assert [fold_M.sum() for fold_M in folds_M] == [400,400,400,400,400]
+
+    # Same seed, same folds
+    M = numpy.ones((10,8))
+    random.seed(1)
+    folds_M_1 = mask.compute_folds_attempts(10,8,5,10,M)
+    random.seed(1)
+    folds_M_2 = mask.compute_folds_attempts(10,8,5,10,M)
+    assert all(numpy.array_equal(M1,M2) for M1,M2 in zip(folds_M_1,folds_M_2))
+
+""" Test that we fail straight away if there are no valid folds """
+def test_compute_folds_attempts_fail():
+    M = numpy.ones((5,4))
+    M[2,1:] = 0
+    assert not mask.can_compute_folds(M,3)
+    assert mask.compute_folds_constructive(5,4,3,M) is None
+    with pytest.raises(AssertionError) as error:
+        mask.compute_folds_attempts(5,4,3,10,M)
+    assert str(error.value) == "Failed to generate folds for training and test data, 10 attempts."
+
+    with pytest.raises(AssertionError) as error:
+        mask.compute_folds_attempts(5,4,1,10)
+    assert str(error.value) == "Failed to generate folds for training and test data, 10 attempts."
+
+
+""" Test storing the folds as one matrix of fold indices, and recovering the training and test M's """
+def test_compute_fold_indices():
+    random.seed(0)
+    M = numpy.ones((6,5))
+    M[1,1], M[4,2] = 0, 0
+    folds_test = mask.compute_folds_attempts(6,5,3,10,M)
+    folds_training = mask.compute_Ms(folds_test)
+
+    fold_indices = mask.compute_fold_indices(folds_test)
+    assert fold_indices[1,1] == -1 and fold_indices[4,2] == -1
+    for fold in range(0,3):
+        (train,test) = mask.compute_train_test_M(fold_indices,fold)
+        assert numpy.array_equal(train,folds_training[fold])
+        assert numpy.array_equal(test,folds_test[fold])
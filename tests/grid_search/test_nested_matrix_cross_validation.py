@@ -0,0 +1,74 @@
+"""
+Test the nested cross-validation, in nested_matrix_cross_validation.py
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+from BNMTF.code.cross_validation.nested_matrix_cross_validation import MatrixNestedCrossValidation
+from BNMTF.code.models.nmf_icm import nmf_icm
+import numpy, random
+
+
+""" Test running the outer folds concurrently, giving the same results for the same seeds """
+def test_run(tmpdir):
+    I,J,K = 12,10,3
+    numpy.random.seed(0)
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[3,4] = 0, 0
+    priors = { 'alpha':1., 'beta':1., 'lambdaU':1., 'lambdaV':1. }
+    parameter_search = [{ 'K':1, 'priors':priors, 'seed':1 }, { 'K':2, 'priors':priors, 'seed':2 }, { 'K':3, 'priors':{} }]
+    train_config = { 'iterations':5, 'init':'random' }
+
+    all_performances = []
+    for P in [1,3]:
+        files_nested_performances = [str(tmpdir.join('nested_%s_%s.txt' % (P,i))) for i in range(0,K)]
+        random.seed(1)
+        nested_crossval = MatrixNestedCrossValidation(
+            method=nmf_icm,X=X,M=M,K=K,P=P,parameter_search=parameter_search,train_config=train_config,
+            file_performance=str(tmpdir.join('performances_%s.txt' % P)),files_nested_performances=files_nested_performances)
+        nested_crossval.run()
+        all_performances.append(nested_crossval.all_performances)
+
+        assert len(nested_crossval.all_performances['MSE']) == K
+        for i in range(0,K):
+            assert nested_crossval.crossvals[i].fout.closed
+            lines = open(files_nested_performances[i],'r').readlines()
+            assert len(lines) == 2*2 + 1 + 1
+            assert lines[4].startswith("Tried parameters {'priors': {}, 'K': 3} but got exception")
+            assert lines[5].startswith("Best performances")
+    assert all_performances[0] == all_performances[1]
+
+
+""" Test resuming the nested cross-validation from its journal, after losing the last results """
+def test_run_journal(tmpdir):
+    I,J,K = 12,10,3
+    numpy.random.seed(0)
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':1., 'beta':1., 'lambdaU':1., 'lambdaV':1. }
+    parameter_search = [{ 'K':1, 'priors':priors, 'seed':1 }, { 'K':2, 'priors':priors, 'seed':2 }]
+    train_config = { 'iterations':5, 'init':'random' }
+    file_journal = str(tmpdir.join('journal.txt'))
+
+    def run():
+        nested_crossval = MatrixNestedCrossValidation(
+            method=nmf_icm,X=X,M=M,K=K,P=2,parameter_search=parameter_search,train_config=train_config,
+            file_performance=str(tmpdir.join('performances.txt')),
+            files_nested_performances=[str(tmpdir.join('nested_%s.txt' % i)) for i in range(0,K)],
+            file_journal=file_journal)
+        nested_crossval.run()
+        return nested_crossval
+
+    nested_crossval = run()
+    lines = open(file_journal,'r').readlines()
+    assert len(lines) == (1 + K) + K * 2 * (1 + K)
+    outer_lines = [line for line in lines if line.startswith('{"fold": ') and '"key": "outer"' in line]
+    assert len(outer_lines) == K and lines[-1] in outer_lines
+
+    open(file_journal,'w').writelines(lines[:-5])
+    resumed = run()
+    assert resumed.all_performances == nested_crossval.all_performances
+    assert len(open(file_journal,'r').readlines()) == len(lines)
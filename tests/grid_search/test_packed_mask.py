@@ -0,0 +1,72 @@
+"""
+Test the bit-packed masks and folds, in packed_mask.py
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+from BNMTF.code.cross_validation.packed_mask import PackedMask, PackedFolds
+import BNMTF.code.cross_validation.mask as mask
+import numpy, random, pytest
+
+
+""" Test packing and unpacking masks, and using them as dense ones """
+def test_packed_mask():
+    numpy.random.seed(0)
+    M = (numpy.random.rand(5,7) < 0.6).astype(float)
+    M_packed = PackedMask(M)
+    assert M_packed.shape == (5,7)
+    assert len(M_packed.bits) == 5
+    assert numpy.array_equal(M_packed.dense(),M)
+    assert numpy.array(M_packed,dtype=numpy.float32).dtype == numpy.float32
+    assert numpy.array_equal(numpy.array(M_packed),M)
+    assert numpy.array_equal(PackedMask(M_packed).dense(),M)
+    
+    X = numpy.random.rand(5,7)
+    assert numpy.array_equal(M_packed * X, M * X)
+    assert M_packed.sum() == M.sum()
+    assert numpy.array_equal(M_packed.sum(axis=0),M.sum(axis=0))
+    assert all(numpy.array_equal(a,b) for a,b in zip(numpy.nonzero(M_packed),numpy.nonzero(M)))
+    
+    with pytest.raises(AssertionError) as error:
+        PackedMask(shape=(5,7),bits=numpy.zeros(4,dtype=numpy.uint8))
+    assert str(error.value) == "Expected 5 bytes for a mask of shape (5, 7), but got 4."
+
+
+""" Test the bitwise operations, which keep the padding bits at 0 """
+def test_operations():
+    numpy.random.seed(1)
+    M1 = (numpy.random.rand(3,5) < 0.5).astype(float)
+    M2 = (numpy.random.rand(3,5) < 0.5).astype(float)
+    (M1_packed,M2_packed) = (PackedMask(M1),PackedMask(M2))
+    assert numpy.array_equal(M1_packed.complement().dense(),1-M1)
+    assert M1_packed.complement().sum() == 15 - M1.sum()
+    assert numpy.array_equal(M1_packed.minus(M2_packed).dense(),M1*(1-M2))
+    assert numpy.array_equal((M1_packed & M2_packed).dense(),M1*M2)
+    assert numpy.array_equal((M1_packed | M2_packed).dense(),numpy.maximum(M1,M2))
+    
+    with pytest.raises(AssertionError) as error:
+        M1_packed & PackedMask(numpy.ones((5,3)))
+    assert str(error.value) == "Masks are of different shapes: (3, 5) and (5, 3) respectively."
+
+
+""" Test that the packed folds give the same training and test masks """
+def test_packed_folds():
+    random.seed(0)
+    M = numpy.ones((6,5))
+    M[1,1], M[4,2] = 0, 0
+    fold_indices = mask.compute_fold_indices_attempts(6,5,3,10,M)
+    assert fold_indices.dtype == numpy.int8
+    
+    folds = PackedFolds(fold_indices,3)
+    assert len(folds) == 3
+    for fold,(train,test) in enumerate(folds):
+        (train_M,test_M) = mask.compute_train_test_M(fold_indices,fold)
+        assert numpy.array_equal(train.dense(),train_M)
+        assert numpy.array_equal(test.dense(),test_M)
+        
+    # Same seed, same folds as compute_folds_attempts
+    random.seed(0)
+    folds_M = mask.compute_folds_attempts(6,5,3,10,M)
+    assert numpy.array_equal(mask.compute_fold_indices(folds_M),fold_indices)
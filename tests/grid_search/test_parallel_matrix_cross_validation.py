@@ -0,0 +1,105 @@
+"""
+Test the parallel cross-validation, in parallel_matrix_cross_validation.py
+"""
+
+project_location = "/Users/thomasbrouwer/Documents/Projects/libraries/"
+import sys
+sys.path.append(project_location)
+
+from BNMTF.code.cross_validation.parallel_matrix_cross_validation import ParallelMatrixCrossValidation
+from BNMTF.code.cross_validation.matrix_cross_validation import MatrixCrossValidation
+from BNMTF.code.models.nmf_icm import nmf_icm
+import numpy, random, os, tempfile
+
+
+""" Test that running the folds in parallel, with the data shared through files, gives the same performances """
+def test_run(tmpdir):
+    I,J = 10,9
+    numpy.random.seed(0)
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    M[0,0], M[3,4] = 0, 0
+    priors = { 'alpha':1., 'beta':1., 'lambdaU':1., 'lambdaV':1. }
+    parameter_search = [{ 'K':K, 'priors':priors, 'seed':K } for K in [1,2]]
+    train_config = { 'iterations':5, 'init':'random' }
+
+    random.seed(1)
+    crossval = MatrixCrossValidation(
+        method=nmf_icm,X=X,M=M,K=3,parameter_search=parameter_search,
+        train_config=train_config,file_performance=str(tmpdir.join('sequential.txt')))
+    crossval.run()
+
+    random.seed(1)
+    tempdir = str(tmpdir.mkdir('shared'))
+    tempfile.tempdir = tempdir
+    try:
+        parallel_crossval = ParallelMatrixCrossValidation(
+            method=nmf_icm,X=X,M=M,K=3,parameter_search=parameter_search,
+            train_config=train_config,file_performance=str(tmpdir.join('parallel.txt')),P=2)
+        parallel_crossval.run()
+    finally:
+        tempfile.tempdir = None
+
+    assert len(parallel_crossval.all_performances) == 2
+    assert parallel_crossval.all_performances == crossval.all_performances
+    assert len(parallel_crossval.all_performances.values()[0]['MSE']) == 3
+    # The shared files are cleaned up afterwards
+    assert os.listdir(tempdir) == []
+
+
+""" Test that parameters that raise an exception get logged as such, in order, without stopping the others """
+def test_run_exception(tmpdir):
+    I,J = 10,9
+    numpy.random.seed(0)
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':1., 'beta':1., 'lambdaU':1., 'lambdaV':1. }
+    parameter_search = [{ 'K':1, 'priors':priors }, { 'K':2, 'priors':{} }, { 'K':3, 'priors':priors }]
+    train_config = { 'iterations':2, 'init':'exp' }
+
+    file_performance = str(tmpdir.join('parallel.txt'))
+    crossval = ParallelMatrixCrossValidation(
+        method=nmf_icm,X=X,M=M,K=2,parameter_search=parameter_search,
+        train_config=train_config,file_performance=file_performance,P=4)
+    crossval.run()
+
+    assert crossval.performances['MSE'] == [
+        crossval.average_performances[crossval.JSON(parameter_search[0])]['MSE'],
+        crossval.average_performances[crossval.JSON(parameter_search[2])]['MSE']]
+    assert crossval.all_performances[crossval.JSON(parameter_search[1])] == {}
+    lines = open(file_performance,'r').readlines()
+    assert lines[0].startswith("Tried parameters {'priors': {'alpha'")
+    assert lines[2] == "Tried parameters {'priors': {}, 'K': 2} but got exception: 'alpha'. \n"
+    assert lines[3].startswith("Tried parameters {'priors': {'alpha'")
+
+
+""" Test resuming from a journal, where the folds in the journal are not run again """
+def test_run_journal(tmpdir):
+    I,J = 10,9
+    numpy.random.seed(0)
+    X = numpy.random.rand(I,J)
+    M = numpy.ones((I,J))
+    priors = { 'alpha':1., 'beta':1., 'lambdaU':1., 'lambdaV':1. }
+    parameter_search = [{ 'K':1, 'priors':priors, 'seed':1 }, { 'K':2, 'priors':{} }, { 'K':3, 'priors':priors, 'seed':3 }]
+    train_config = { 'iterations':2, 'init':'random' }
+    file_journal = str(tmpdir.join('journal.txt'))
+
+    def run():
+        crossval = ParallelMatrixCrossValidation(
+            method=nmf_icm,X=X,M=M,K=2,parameter_search=parameter_search,train_config=train_config,
+            file_performance=str(tmpdir.join('parallel.txt')),P=2,file_journal=file_journal)
+        crossval.run()
+        return crossval
+
+    crossval = run()
+    lines = open(file_journal,'r').readlines()
+    assert len(lines) == 3 * (1 + 2)
+    log = open(str(tmpdir.join('parallel.txt')),'r').read()
+
+    # Drop the results of the last parameters, which are then the only ones we run again
+    results = [line for line in lines if '"fold"' in line]
+    open(file_journal,'w').writelines([line for line in lines if '"folds_file"' in line] + results[:4])
+    resumed = run()
+    assert resumed.performances['MSE'] == crossval.performances['MSE']
+    assert open(str(tmpdir.join('parallel.txt')),'r').read() == log
+    assert len(open(file_journal,'r').readlines()) == 3 * (1 + 2)